@@ -0,0 +1,94 @@
+import gzip
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Iterable, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+# Matches the ./data volume mounted in docker-compose.yml
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', os.path.join('data', 'archive'))
+
+
+class ArchiveStore:
+    """Per-user gzip JSONL segments, one file per month of received_at
+
+    Segments are append-only: each compaction batch is written as a new gzip
+    member, and gzip readers transparently stream concatenated members.
+    """
+
+    def __init__(self, root: str = ARCHIVE_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _user_dir(self, telegram_id: str) -> str:
+        # telegram_id is numeric, but never let it escape the archive root
+        return os.path.join(self.root, os.path.basename(str(telegram_id)))
+
+    def append(self, telegram_id: str, records: Iterable[Dict[str, Any]]) -> int:
+        """Append records to their monthly segments; returns how many were written"""
+        by_month: Dict[str, List[Dict[str, Any]]] = {}
+        for record in records:
+            by_month.setdefault(record['received_at'][:7], []).append(record)
+
+        if not by_month:
+            return 0
+
+        user_dir = self._user_dir(telegram_id)
+        os.makedirs(user_dir, exist_ok=True)
+
+        count = 0
+        with self._lock:
+            for month, month_records in by_month.items():
+                path = os.path.join(user_dir, f'{month}.jsonl.gz')
+                with open(path, 'ab') as raw:
+                    with gzip.GzipFile(fileobj=raw, mode='wb') as gz:
+                        for record in month_records:
+                            gz.write(json.dumps(record, ensure_ascii=False).encode('utf-8'))
+                            gz.write(b'\n')
+                    raw.flush()
+                    os.fsync(raw.fileno())
+                count += len(month_records)
+        return count
+
+    def segments(self, telegram_id: str) -> List[str]:
+        """Segment paths, newest month first"""
+        user_dir = self._user_dir(telegram_id)
+        if not os.path.isdir(user_dir):
+            return []
+        names = sorted((name for name in os.listdir(user_dir) if name.endswith('.jsonl.gz')), reverse=True)
+        return [os.path.join(user_dir, name) for name in names]
+
+    def iter_records(self, telegram_id: str) -> Iterator[Dict[str, Any]]:
+        """Stream every archived record, segment by segment"""
+        for path in self.segments(telegram_id):
+            try:
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    for line in f:
+                        if line.strip():
+                            yield json.loads(line)
+            except (OSError, EOFError, ValueError) as e:
+                logger.error(f"Skipping unreadable archive segment {path}: {e}")
+
+    def search(self, telegram_id: str, query: str, limit: int) -> List[Dict[str, Any]]:
+        """Case-insensitive subject/sender match, newest segments first"""
+        needle = query.lower()
+        seen = set()
+        results = []
+
+        for record in self.iter_records(telegram_id):
+            if record['outlook_id'] in seen:
+                continue
+            if needle in (record.get('subject') or '').lower() or needle in (record.get('sender') or '').lower():
+                seen.add(record['outlook_id'])
+                results.append(record)
+                if len(results) >= limit:
+                    break
+
+        results.sort(key=lambda r: r['received_at'], reverse=True)
+        return results
+
+    def delete_user(self, telegram_id: str):
+        for path in self.segments(telegram_id):
+            os.remove(path)
@@ -0,0 +1,293 @@
+import hashlib
+import json
+import logging
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Any, Dict, Iterator, List, Optional
+
+import requests
+
+from cache import LRUCache
+from circuit_breaker import get_breaker
+from metrics import timed_graph_call, TELEGRAM_REQUEST_SECONDS, TELEGRAM_THROTTLED
+from tracing import start_span
+from database import Session, Email, AttachmentFile
+from email_service import EmailService, GRAPH_URL
+
+logger = logging.getLogger(__name__)
+
+# Bot API limit for multipart uploads
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
+ATTACHMENT_WORKERS = int(os.getenv('ATTACHMENT_WORKERS', 4))
+ATTACHMENT_CACHE_SIZE = 1024
+ATTACHMENT_CACHE_TTL = 600
+
+
+class AttachmentError(Exception):
+    """Raised when an attachment cannot be listed or forwarded"""
+
+
+class AttachmentForwarder:
+    """Lists message attachments and streams them from Graph straight into sendDocument"""
+
+    def __init__(self, email_service: EmailService, bot_token: str, workers: int = ATTACHMENT_WORKERS):
+        self.email_service = email_service
+        self.bot_token = bot_token
+        # Uploads can take minutes; keep them off the default to_thread pool
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='attachments')
+        # (telegram_id, email_id) -> attachment metadata list
+        self.metadata_cache = LRUCache(maxsize=ATTACHMENT_CACHE_SIZE, ttl=ATTACHMENT_CACHE_TTL)
+
+    def list_attachments(self, telegram_id: str, email_id: int) -> List[Dict[str, Any]]:
+        """Fetch attachment metadata (never content) for a stored email"""
+        key = (telegram_id, email_id)
+        attachments = self.metadata_cache.get(key)
+        if attachments is not None:
+            return attachments
+
+        outlook_id = self._outlook_id(telegram_id, email_id)
+        access_token = self.email_service.get_valid_token(telegram_id)
+        if not access_token:
+            raise AttachmentError("Not connected")
+
+        try:
+            response = self.email_service._graph_get(
+                access_token,
+                f'{GRAPH_URL}/me/messages/{outlook_id}/attachments',
+                params={'$select': 'id,name,size,contentType,isInline'}
+            )
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error listing attachments of email {email_id} for user {telegram_id}: {e}")
+            raise AttachmentError("Could not list attachments") from e
+
+        attachments = [
+            {
+                'id': item['id'],
+                'name': item.get('name') or 'attachment',
+                'size': item.get('size', 0),
+                'content_type': item.get('contentType') or 'application/octet-stream',
+            }
+            for item in response.json().get('value', [])
+            if not item.get('isInline')
+        ]
+        self.metadata_cache.set(key, attachments)
+        return attachments
+
+    def forward(self, telegram_id: str, email_id: int, index: int, chat_id: int) -> Dict[str, Any]:
+        """Stream one attachment to a chat as a document; returns the sent Telegram message"""
+        attachments = self.list_attachments(telegram_id, email_id)
+        if not 0 <= index < len(attachments):
+            raise AttachmentError("Attachment not found")
+
+        attachment = attachments[index]
+        if attachment['size'] > TELEGRAM_UPLOAD_LIMIT:
+            raise AttachmentError(
+                f"{attachment['name']} is {attachment['size'] // (1024 * 1024)} MB; "
+                f"Telegram bots can only send files up to {TELEGRAM_UPLOAD_LIMIT // (1024 * 1024)} MB"
+            )
+
+        # Already uploaded this exact attachment: no Graph download, no Telegram upload
+        file_id = self._cached_file_id(graph_attachment_id=attachment['id'])
+        if file_id:
+            return self._send_cached_document(chat_id, file_id)
+
+        outlook_id = self._outlook_id(telegram_id, email_id)
+        access_token = self.email_service.get_valid_token(telegram_id)
+        if not access_token:
+            raise AttachmentError("Not connected")
+
+        url = f"{GRAPH_URL}/me/messages/{outlook_id}/attachments/{attachment['id']}/$value"
+        try:
+            # Same content may have been uploaded from another email; only worth a
+            # hashing pass if something of exactly this size was uploaded before.
+            if self._has_size_candidates(attachment['size']):
+                content_hash = self._hash_remote(url, access_token)
+                file_id = self._cached_file_id(content_hash=content_hash)
+                if file_id:
+                    self._remember(attachment, content_hash, file_id)
+                    return self._send_cached_document(chat_id, file_id)
+
+            with self._open_stream(url, access_token) as source:
+                digest = hashlib.sha256()
+                chunks = _hashing(source.iter_content(STREAM_CHUNK_SIZE), digest)
+                message = self._send_document(chat_id, attachment, chunks)
+
+            file_id = _sent_file_id(message)
+            if file_id:
+                self._remember(attachment, digest.hexdigest(), file_id)
+            return message
+
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error forwarding attachment of email {email_id} for user {telegram_id}: {e}")
+            raise AttachmentError("Could not forward attachment") from e
+
+    def _hash_remote(self, url: str, access_token: str) -> str:
+        """SHA-256 of an attachment's content, streamed without buffering it"""
+        digest = hashlib.sha256()
+        with self._open_stream(url, access_token) as source:
+            for chunk in source.iter_content(STREAM_CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _open_stream(self, url: str, access_token: str) -> requests.Response:
+        """Start streaming an attachment, through the shared Graph circuit breaker"""
+        def send():
+            response = requests.get(url, headers={'Authorization': f'Bearer {access_token}'}, stream=True, timeout=30)
+            try:
+                response.raise_for_status()
+            except requests.exceptions.HTTPError:
+                response.close()
+                raise
+            return response
+        return get_breaker('graph').call(timed_graph_call, 'GET', url, send)
+
+    def send_file(self, chat_id: int, fileobj: IO[bytes], name: str, content_type: str,
+                  caption: Optional[str] = None) -> Dict[str, Any]:
+        """Stream a local file to a chat as a document without reading it into memory"""
+        size = fileobj.seek(0, os.SEEK_END)
+        fileobj.seek(0)
+        if size > TELEGRAM_UPLOAD_LIMIT:
+            raise AttachmentError(
+                f"{name} is {size // (1024 * 1024)} MB; "
+                f"Telegram bots can only send files up to {TELEGRAM_UPLOAD_LIMIT // (1024 * 1024)} MB"
+            )
+
+        chunks = iter(lambda: fileobj.read(STREAM_CHUNK_SIZE), b'')
+        try:
+            return self._send_document(chat_id, {'name': name, 'content_type': content_type}, chunks, caption)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error uploading {name} to chat {chat_id}: {e}")
+            raise AttachmentError(f"Could not upload {name}") from e
+
+    def _cached_file_id(self, graph_attachment_id: Optional[str] = None, content_hash: Optional[str] = None) -> Optional[str]:
+        session = Session()
+        try:
+            query = session.query(AttachmentFile.telegram_file_id)
+            if graph_attachment_id:
+                query = query.filter_by(graph_attachment_id=graph_attachment_id)
+            else:
+                query = query.filter_by(content_hash=content_hash)
+            row = query.first()
+            return row.telegram_file_id if row else None
+        finally:
+            session.close()
+
+    def _has_size_candidates(self, size: int) -> bool:
+        session = Session()
+        try:
+            return session.query(AttachmentFile.id).filter_by(size=size).first() is not None
+        finally:
+            session.close()
+
+    def _remember(self, attachment: Dict[str, Any], content_hash: str, file_id: str):
+        session = Session()
+        try:
+            session.add(AttachmentFile(
+                graph_attachment_id=attachment['id'],
+                content_hash=content_hash,
+                size=attachment['size'],
+                telegram_file_id=file_id
+            ))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error caching Telegram file_id for attachment: {e}")
+        finally:
+            session.close()
+
+    def _send_cached_document(self, chat_id: int, file_id: str) -> Dict[str, Any]:
+        result = self._post_bot_api(
+            'sendDocument',
+            json={'chat_id': chat_id, 'document': file_id},
+            timeout=30
+        )
+        if not result.get('ok'):
+            raise AttachmentError(result.get('description', 'Telegram rejected the document'))
+        return result['result']
+
+    def _send_document(self, chat_id: int, attachment: Dict[str, Any], chunks: Iterator[bytes],
+                       caption: Optional[str] = None) -> Dict[str, Any]:
+        boundary = secrets.token_hex(16)
+        fields = {'chat_id': str(chat_id)}
+        if caption:
+            fields['caption'] = caption
+        result = self._post_bot_api(
+            'sendDocument',
+            data=_multipart_stream(boundary, fields, 'document', attachment, chunks),
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+            timeout=(10, 300)
+        )
+        if not result.get('ok'):
+            raise AttachmentError(result.get('description', 'Telegram rejected the upload'))
+        return result['result']
+
+    def _post_bot_api(self, method: str, **kwargs) -> Dict[str, Any]:
+        """Bot API call made outside PTB, recorded alongside the ones PTB makes"""
+        started = time.perf_counter()
+        status = 'error'
+        with start_span(f'telegram.{method}'):
+            try:
+                response = requests.post(f'https://api.telegram.org/bot{self.bot_token}/{method}', **kwargs)
+                status = str(response.status_code)
+                return response.json()
+            finally:
+                TELEGRAM_REQUEST_SECONDS.labels(method, status).observe(time.perf_counter() - started)
+                if status == '429':
+                    TELEGRAM_THROTTLED.labels(method).inc()
+
+    def _outlook_id(self, telegram_id: str, email_id: int) -> str:
+        session = Session()
+        try:
+            row = session.query(Email.outlook_id).filter_by(id=email_id, telegram_id=telegram_id).first()
+        finally:
+            session.close()
+
+        if not row:
+            raise AttachmentError("Email not found")
+        return row.outlook_id
+
+
+def _hashing(chunks: Iterator[bytes], digest) -> Iterator[bytes]:
+    """Pass chunks through while feeding them to a hash"""
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+def _sent_file_id(message: Dict[str, Any]):
+    """file_id of whatever media object Telegram turned the document into"""
+    for kind in ('document', 'animation', 'video', 'audio', 'voice'):
+        if kind in message:
+            return message[kind].get('file_id')
+    return None
+
+
+def _multipart_stream(boundary: str, fields: Dict[str, str], file_field: str,
+                      attachment: Dict[str, Any], chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """Yield a multipart/form-data body, passing file chunks through as they arrive
+
+    requests sends a generator body with chunked transfer encoding, so only one
+    chunk of the file is ever held in memory.
+    """
+    for name, value in fields.items():
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f'{value}\r\n'
+        ).encode()
+
+    filename = json.dumps(attachment['name'], ensure_ascii=False)
+    yield (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{file_field}"; filename={filename}\r\n'
+        f'Content-Type: {attachment["content_type"]}\r\n\r\n'
+    ).encode()
+
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+
+    yield f'\r\n--{boundary}--\r\n'.encode()
@@ -0,0 +1,218 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import requests
+
+from circuit_breaker import CircuitOpenError, outage_retry_after
+from database import Session, BackfillState
+from email_service import EmailService, GRAPH_URL, MESSAGE_SELECT
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS', 4))
+BACKFILL_PAGE_SIZE = int(os.getenv('BACKFILL_PAGE_SIZE', 250))
+BACKFILL_PREFETCH_PAGES = 2
+BACKFILL_MAX_RETRIES = 5
+
+Page = Tuple[Optional[str], List[Dict[str, Any]]]
+
+
+class BackfillManager:
+    """Pages through a user's whole mailbox in the background, resuming from checkpoints"""
+
+    def __init__(self, email_service: EmailService, max_workers: int = BACKFILL_WORKERS):
+        self.email_service = email_service
+        # The pool size is the global budget: at most this many mailboxes page
+        # through Graph at once, independent of how many users asked.
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='backfill')
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def start(self, telegram_id: str) -> bool:
+        """Queue a backfill for a user; returns False if one is already running"""
+        with self._lock:
+            if telegram_id in self._running:
+                return False
+            self._running.add(telegram_id)
+
+        self.executor.submit(self._run, telegram_id)
+        return True
+
+    def resume_pending(self) -> int:
+        """Restart every backfill that was interrupted before completing"""
+        session = Session()
+        try:
+            pending = [
+                row.telegram_id for row in
+                session.query(BackfillState.telegram_id).filter_by(is_complete=False)
+            ]
+        finally:
+            session.close()
+
+        for telegram_id in pending:
+            self.start(telegram_id)
+
+        if pending:
+            logger.info(f"Resuming {len(pending)} interrupted backfills")
+        return len(pending)
+
+    def get_state(self, telegram_id: str) -> Optional[BackfillState]:
+        session = Session()
+        try:
+            return session.query(BackfillState).filter_by(telegram_id=telegram_id).first()
+        finally:
+            session.close()
+
+    def _run(self, telegram_id: str):
+        try:
+            start_link = self._load_checkpoint(telegram_id)
+            if start_link is None:
+                logger.info(f"Backfill already complete for user {telegram_id}")
+                return
+
+            pages = _prefetch(self._fetch_pages(telegram_id, start_link), BACKFILL_PREFETCH_PAGES)
+            for next_link, messages in pages:
+                stored = self.email_service.store_emails_bulk(telegram_id, messages)
+                if stored is None:
+                    # Keep the checkpoint on this page so a resume fetches it again
+                    raise RuntimeError("could not store backfill page")
+                self._save_checkpoint(telegram_id, next_link, stored)
+
+            logger.info(f"Backfill finished for user {telegram_id}")
+
+        except Exception as e:
+            logger.error(f"Backfill failed for user {telegram_id}: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(telegram_id)
+
+    def _fetch_pages(self, telegram_id: str, url: str) -> Iterator[Page]:
+        """Yield (nextLink, messages) for each page until the mailbox is exhausted"""
+        headers = {'Prefer': f'odata.maxpagesize={BACKFILL_PAGE_SIZE}'}
+        # A resumed nextLink already carries the query string
+        params = None if '?' in url else {'$select': MESSAGE_SELECT, '$orderby': 'receivedDateTime desc'}
+
+        while url:
+            data = self._get_page(telegram_id, url, params, headers)
+            url = data.get('@odata.nextLink')
+            params = None
+            yield url, data.get('value', [])
+
+    def _get_page(self, telegram_id: str, url: str, params: Optional[Dict[str, Any]],
+                  headers: Dict[str, str]) -> Dict[str, Any]:
+        for attempt in range(BACKFILL_MAX_RETRIES):
+            # Tokens expire during long backfills, so re-check on every page
+            access_token = self.email_service.get_valid_token(telegram_id)
+            if not access_token:
+                retry_after = outage_retry_after('login')
+                if retry_after is None:
+                    raise RuntimeError("no valid access token")
+                # The open login breaker refused the refresh; wait it out like a Graph outage
+                delay = max(1, int(retry_after))
+                logger.warning(f"Backfill waiting for login for user {telegram_id}, retrying in {delay}s")
+                time.sleep(delay)
+                continue
+
+            try:
+                return self.email_service._graph_get(access_token, url, params=params, headers=headers).json()
+            except requests.exceptions.HTTPError as e:
+                response = e.response
+                if response is None or response.status_code not in (429, 503, 504):
+                    raise
+                delay = int(response.headers.get('Retry-After', 2 ** attempt))
+            except CircuitOpenError as e:
+                # Graph is down for everyone; wait out the breaker instead of probing it
+                delay = max(1, int(e.retry_after))
+            except requests.exceptions.RequestException:
+                delay = 2 ** attempt
+
+            logger.warning(f"Backfill throttled for user {telegram_id}, retrying in {delay}s")
+            time.sleep(delay)
+
+        raise RuntimeError("too many retries fetching backfill page")
+
+    def _load_checkpoint(self, telegram_id: str) -> Optional[str]:
+        """Return the URL to resume from, or None if the backfill has completed"""
+        session = Session()
+        try:
+            state = session.query(BackfillState).filter_by(telegram_id=telegram_id).first()
+            if state is None:
+                state = BackfillState(telegram_id=telegram_id)
+                session.add(state)
+                session.commit()
+
+            if state.is_complete:
+                return None
+            return state.next_link or f'{GRAPH_URL}/me/messages'
+        finally:
+            session.close()
+
+    def _save_checkpoint(self, telegram_id: str, next_link: Optional[str], stored: int):
+        session = Session()
+        try:
+            state = session.query(BackfillState).filter_by(telegram_id=telegram_id).first()
+            state.next_link = next_link
+            state.pages_fetched = (state.pages_fetched or 0) + 1
+            state.messages_stored = (state.messages_stored or 0) + stored
+            state.is_complete = next_link is None
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error saving backfill checkpoint for user {telegram_id}: {e}")
+            raise
+        finally:
+            session.close()
+
+
+def _prefetch(iterable: Iterable, depth: int) -> Iterator:
+    """Run an iterator in a background thread, buffering at most depth items
+
+    Lets the next Graph page download while the current one is being stored,
+    without ever holding more than a couple of pages in memory.
+    """
+    buffer = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        """Hand an item to the consumer; False once it has stopped listening"""
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
+        finally:
+            # Release the Graph iterator's connection even when the consumer quit early
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
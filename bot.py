@@ -5,18 +5,27 @@ from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes
 
+from circuit_breaker import get_breaker, CircuitOpenError
+from logging_setup import setup_logging
+
 # Get from environment
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 REDIRECT_URI = os.getenv("REDIRECT_URI")
 
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Storage for user tokens (in production use database)
 user_tokens = {}
 
+# Last emails each user saw, served while Microsoft is unreachable
+recent_emails = {}
+
+GRAPH_BREAKER = get_breaker('graph')
+LOGIN_BREAKER = get_breaker('login')
+
 # ==================== COMMANDS ====================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -52,18 +61,25 @@ async def inbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     tokens = user_tokens[user_id]
     
-    # Check if token expired
-    if datetime.now() > tokens.get('expires_at', datetime.now()):
-        new_tokens = refresh_access_token(tokens.get('refresh_token'))
-        if new_tokens:
-            user_tokens[user_id] = new_tokens
-            tokens = new_tokens
-        else:
-            await update.message.reply_text("❌ Session expired. Use /connect again")
-            return
+    try:
+        # Check if token expired
+        if datetime.now() > tokens.get('expires_at', datetime.now()):
+            new_tokens = refresh_access_token(tokens.get('refresh_token'))
+            if new_tokens:
+                user_tokens[user_id] = new_tokens
+                tokens = new_tokens
+            else:
+                await update.message.reply_text("❌ Session expired. Use /connect again")
+                return
+        
+        # Fetch emails
+        emails = fetch_emails(tokens['access_token'])
+    except CircuitOpenError as e:
+        await reply_cached(update, user_id, e)
+        return
     
-    # Fetch emails
-    emails = fetch_emails(tokens['access_token'])
+    if emails:
+        recent_emails[user_id] = (datetime.now(), emails)
     
     if not emails:
         await update.message.reply_text("📭 No emails found")
@@ -102,13 +118,17 @@ async def unread(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     tokens = user_tokens[user_id]
     
-    if datetime.now() > tokens.get('expires_at', datetime.now()):
-        new_tokens = refresh_access_token(tokens.get('refresh_token'))
-        if new_tokens:
-            user_tokens[user_id] = new_tokens
-            tokens = new_tokens
-    
-    emails = fetch_emails(tokens['access_token'], unread_only=True)
+    try:
+        if datetime.now() > tokens.get('expires_at', datetime.now()):
+            new_tokens = refresh_access_token(tokens.get('refresh_token'))
+            if new_tokens:
+                user_tokens[user_id] = new_tokens
+                tokens = new_tokens
+        
+        emails = fetch_emails(tokens['access_token'], unread_only=True)
+    except CircuitOpenError as e:
+        await reply_cached(update, user_id, e, unread_only=True)
+        return
     
     if not emails:
         await update.message.reply_text("🎉 No unread emails!")
@@ -127,6 +147,29 @@ async def unread(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(response, parse_mode='Markdown')
 
+async def reply_cached(update: Update, user_id: int, error: CircuitOpenError, unread_only: bool = False):
+    """Degraded mode: answer from the last fetched emails instead of waiting on Microsoft"""
+    fetched_at, emails = recent_emails.get(user_id, (None, []))
+    if unread_only:
+        emails = [email for email in emails if not email.get('isRead')]
+    
+    response = f"⚠️ Outlook is not responding, retrying in {error.retry_after:.0f}s\n"
+    if not fetched_at:
+        await update.message.reply_text(response + "📭 No cached emails yet")
+        return
+    
+    response += f"📦 *Cached as of {fetched_at.strftime('%H:%M:%S')}*\n\n"
+    for i, email in enumerate(emails[:5]):
+        sender_name = email.get('from', {}).get('emailAddress', {}).get('name', 'Unknown')
+        subject = email.get('subject', 'No Subject')
+        if len(subject) > 50:
+            subject = subject[:47] + "..."
+        
+        response += f"*{i+1}. {subject}*\n"
+        response += f"   👤 {sender_name}\n\n"
+    
+    await update.message.reply_text(response, parse_mode='Markdown')
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Help:\n"
@@ -156,18 +199,31 @@ def fetch_emails(access_token: str, limit: int = 10, unread_only: bool = False):
         "Accept": "application/json"
     }
     
-    try:
+    def send():
         response = requests.get(graph_url, headers=headers, params=params, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            return data.get('value', [])
-        else:
-            logger.error(f"Failed to fetch emails: {response.status_code}")
+        response.raise_for_status()
+        return response
+    
+    try:
+        data = GRAPH_BREAKER.call(send).json()
+        return data.get('value', [])
+    except CircuitOpenError:
+        # Let the command fall back to cached emails
+        raise
+    except requests.exceptions.HTTPError as e:
+        logger.error(f"Failed to fetch emails: {e.response.status_code}")
     except Exception as e:
         logger.error(f"Error fetching emails: {e}")
     
     return []
 
+def post_token(token_url: str, data: dict):
+    """POST to the token endpoint; 5xx counts against the login breaker, 4xx does not"""
+    response = requests.post(token_url, data=data, timeout=10)
+    if response.status_code >= 500:
+        response.raise_for_status()
+    return response
+
 def refresh_access_token(refresh_token: str):
     """Refresh expired access token"""
     token_url = "https://login.microsoftonline.com/consumers/oauth2/v2.0/token"
@@ -181,11 +237,13 @@ def refresh_access_token(refresh_token: str):
     }
     
     try:
-        response = requests.post(token_url, data=data, timeout=10)
+        response = LOGIN_BREAKER.call(post_token, token_url, data)
         if response.status_code == 200:
             tokens = response.json()
             tokens['expires_at'] = datetime.now() + timedelta(seconds=tokens.get('expires_in', 3600))
             return tokens
+    except CircuitOpenError:
+        raise
     except Exception as e:
         logger.error(f"Token refresh error: {e}")
     
@@ -208,7 +266,7 @@ def store_user_tokens(user_id: int, code: str):
     }
     
     try:
-        response = requests.post(token_url, data=data, timeout=10)
+        response = LOGIN_BREAKER.call(post_token, token_url, data)
         if response.status_code == 200:
             tokens = response.json()
             tokens['expires_at'] = datetime.now() + timedelta(seconds=tokens.get('expires_in', 3600))
@@ -1,17 +1,46 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-from telegram.constants import ParseMode
+from telegram.constants import ParseMode, ChatAction
 import os
+import asyncio
+import contextvars
 from dotenv import load_dotenv
 from datetime import datetime
 import secrets
+import threading
+from typing import Optional
 
-from database import Session, User
+from database import Session, User, init_db
 from outlook_auth import OutlookAuth
 from email_service import EmailService
+from export import export_to_tempfile, EXPORT_FORMATS
+from backfill import BackfillManager
+from user_cache import user_cache
+from flood_control import FloodControl, SingleFlight
+from update_processor import PerChatUpdateProcessor
+from renderer import ProgressiveMessage, split_blocks
+from render_pool import escape_markdown
+from attachments import AttachmentForwarder, AttachmentError, TELEGRAM_UPLOAD_LIMIT
+from retention import RetentionCompactor
+from stats import get_stats
+from mail_actions import MailActionQueue, ACTION_READ, ACTION_ARCHIVE, ACTION_FLAG
+from threads import get_thread_page, get_conversation_id
+from circuit_breaker import CircuitOpenError, outage_retry_after
+from logging_setup import setup_logging
+from tracing import setup_tracing
+from metrics import instrumented, InstrumentedHTTPXRequest, MetricsExporter, UPDATES_QUEUED, UPDATES_ACTIVE, \
+    MAIL_ACTIONS_PENDING
 
 load_dotenv()
 
+SEARCH_PAGE_SIZE = 10
+INBOX_LIMIT = 10
+# Largest Graph page /inbox asks for; a limit that fits is fetched in a single request
+INBOX_PAGE_SIZE = 50
+BUTTONS_PER_ROW = 5
+SENDER_TOP_LIMIT = 10
+THREAD_PAGE_SIZE = 5
+
 class OutlookEmailBot:
     def __init__(self):
         self.token = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -20,6 +49,16 @@ class OutlookEmailBot:
         
         self.auth = OutlookAuth()
         self.email_service = EmailService()
+        self.backfill = BackfillManager(self.email_service)
+        self.attachments = AttachmentForwarder(self.email_service, self.token)
+        self.retention = RetentionCompactor(self.email_service.archive)
+        self.actions = MailActionQueue(self.email_service)
+        
+        # Request coalescing and per-user rate limiting
+        self.flights = SingleFlight()
+        self.flood_control = FloodControl()
+        # Triage taps are coalesced into Graph batches, so they get a roomier budget
+        self.action_flood_control = FloodControl(capacity=30, refill_rate=5)
         
         # Track active connections
         self.active_connections = {}
@@ -35,6 +74,13 @@ class OutlookEmailBot:
         /connect - Connect your Outlook account (new link each time!)
         /inbox - View your latest emails
         /stored - View stored emails
+        /folders - List mail folders
+        /senders - Top senders
+        /stats - Mailbox statistics
+        /sync - Fetch new mail from all folders
+        /export - Download stored emails
+        /backfill - Import your whole mailbox
+        /retention - Archive old emails automatically
         /help - Show help information
         /disconnect - Disconnect your account
         /status - Check connection status
@@ -53,8 +99,7 @@ class OutlookEmailBot:
         username = update.effective_user.username or update.effective_user.first_name
         
         # Check if already connected
-        session = Session()
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+        user = await asyncio.to_thread(user_cache.get, telegram_id)
         
         if user and user.is_connected:
             keyboard = [
@@ -106,7 +151,7 @@ class OutlookEmailBot:
         📝 *Steps:*
         1. Click the button below *(new unique link)*
         2. Sign in with your Microsoft account
-        3. Grant permission to read emails
+        3. Grant permission to read and manage your emails
         4. You'll be redirected back
         
         ⚠️ *Important:*
@@ -116,7 +161,7 @@ class OutlookEmailBot:
         
         🔒 *Security:*
         • Your password is never stored
-        • We only request read access
+        • Mail write access is only used when you tap ✅ 🗄 🚩 to mark read, archive or flag
         """
         
         await update.message.reply_text(
@@ -163,7 +208,44 @@ class OutlookEmailBot:
             )
             
         elif query.data == "view_inbox":
-            await self.inbox(query, context)
+            await self.inbox(update, context)
+            
+        elif query.data.startswith("body:"):
+            email_id = int(query.data.split(":", 1)[1])
+            await self._send_full_body(query.message, telegram_id, email_id)
+            
+        elif query.data.startswith("threads_page:"):
+            offset = int(query.data.split(":", 1)[1])
+            await self._send_thread_page(query.message, telegram_id, offset)
+            
+        elif query.data.startswith("thread:"):
+            thread_id = int(query.data.split(":", 1)[1])
+            await self._send_thread(query.message, telegram_id, thread_id)
+            
+        elif query.data.startswith("sender:"):
+            sender_id = int(query.data.split(":", 1)[1])
+            await self._send_sender_emails(query.message, telegram_id, sender_id)
+            
+        elif query.data.startswith("atts:"):
+            email_id = int(query.data.split(":", 1)[1])
+            await self._send_attachment_list(query.message, telegram_id, email_id)
+            
+        elif query.data.startswith("att:"):
+            _, email_id, index = query.data.split(":")
+            await self._forward_attachment(query.message, telegram_id, int(email_id), int(index))
+            
+        elif query.data.startswith("search_page:"):
+            search_query = context.user_data.get('search_query')
+            if not search_query:
+                await query.message.reply_text("🔍 Search expired. Use /search <keyword> again.")
+                return
+            
+            offset = int(query.data.split(":", 1)[1])
+            await self._send_search_page(
+                query.message, telegram_id, search_query, offset,
+                folder_id=context.user_data.get('search_folder'),
+                include_archive=context.user_data.get('search_archive', False)
+            )
     
     async def handle_auth_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle OAuth callback from web server"""
@@ -181,16 +263,17 @@ class OutlookEmailBot:
             )
     
     async def inbox(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /inbox command"""
+        """Handle /inbox command - one message, refined in place as pages arrive"""
         telegram_id = str(update.effective_user.id)
         username = update.effective_user.username or update.effective_user.first_name
+        # Also reached from the "View Inbox" button, where there is no update.message
+        message = update.effective_message
         
         # Check connection
-        session = Session()
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+        user = await asyncio.to_thread(user_cache.get, telegram_id)
         
         if not user or not user.is_connected:
-            await update.message.reply_text(
+            await message.reply_text(
                 f"👋 Hello {username}!\n\n"
                 "❌ *Not Connected*\n"
                 "Please use /connect to generate a new link and connect your Outlook account first.",
@@ -198,78 +281,390 @@ class OutlookEmailBot:
             )
             return
         
-        await update.message.reply_text(
-            f"👋 Hello {username}!\n\n"
-            f"📬 *Fetching emails for {user.outlook_email}...*",
-            parse_mode=ParseMode.MARKDOWN
+        progress = ProgressiveMessage(message)
+        
+        # Show what we already have locally while Graph is queried; with nothing
+        # stored a placeholder would only cost an extra send plus an edit
+        cached = await asyncio.to_thread(self.email_service.get_stored_emails, telegram_id, INBOX_LIMIT)
+        if cached:
+            header = f"👋 Hello {username}!\n\n📬 *Fetching emails for {user.outlook_email}...*\n\n"
+            blocks = [header] + [self._stored_email_block(i, email) for i, email in enumerate(cached, 1)]
+            blocks.append("💾 _Showing stored emails while refreshing..._")
+            await progress.render(blocks)
+        
+        # Stream fresh pages; repeated taps share each page fetch already in flight
+        emails = []
+        next_link = None
+        while len(emails) < INBOX_LIMIT:
+            try:
+                page, next_link = await self.flights.do(
+                    (telegram_id, 'inbox', next_link),
+                    lambda link=next_link: asyncio.to_thread(
+                        self.email_service.get_email_page, telegram_id, min(INBOX_LIMIT, INBOX_PAGE_SIZE), 'inbox', link
+                    )
+                )
+            except CircuitOpenError as e:
+                if not emails:
+                    await self._render_degraded(progress, telegram_id, user.outlook_email, cached, e.retry_after)
+                    return
+                # Keep the pages already shown and stop paging
+                next_link = None
+                page = []
+            emails.extend(page)
+            
+            if not emails:
+                break
+            
+            done = not next_link or len(emails) >= INBOX_LIMIT
+            blocks = [self._inbox_header(user.outlook_email, len(emails))]
+            blocks += [self._inbox_email_block(i, email) for i, email in enumerate(emails, 1)]
+            blocks.append(
+                "💾 *Emails are automatically stored locally*\nUse /stored to view all stored emails\n"
+                "📄 Tap a number to read a message, 📎 for attachments, ✅ 🗄 🚩 to mark read, archive or flag"
+                if done else "⏳ _Loading more..._"
+            )
+            reply_markup = self._email_keyboard(
+                [(email.get('email_id'), email['has_attachments']) for email in emails]
+            ) if done else None
+            await progress.render(blocks, reply_markup=reply_markup)
+            
+            if done:
+                break
+        
+        if not emails:
+            # A token refresh refused by an open breaker also ends up here, with no exception
+            retry_after = outage_retry_after('graph', 'login')
+            if retry_after is not None:
+                await self._render_degraded(progress, telegram_id, user.outlook_email, cached, retry_after)
+                return
+            await progress.render([
+                f"📭 *No new emails found* in your inbox.\n"
+                f"Last checked: {datetime.now().strftime('%H:%M:%S')}"
+            ])
+    
+    async def _render_degraded(self, progress: ProgressiveMessage, telegram_id: str,
+                               outlook_email: str, cached, retry_after: float):
+        """Stored emails, clearly marked as stale, while Microsoft is unreachable"""
+        as_of = await asyncio.to_thread(self.email_service.cached_as_of, telegram_id)
+        as_of_text = as_of.strftime('%Y-%m-%d %H:%M') if as_of else 'unknown'
+        
+        blocks = [
+            f"⚠️ *Outlook is not responding* - retrying in {retry_after:.0f}s\n"
+            f"Account: `{outlook_email}`\n"
+            f"📦 *Cached as of {as_of_text}*\n\n"
+        ]
+        blocks += [self._stored_email_block(i, email) for i, email in enumerate(cached, 1)]
+        if not cached:
+            blocks.append("📭 No stored emails yet.")
+        await progress.render(
+            blocks,
+            reply_markup=self._email_keyboard([(email.id, email.has_attachments) for email in cached])
         )
+    
+    @staticmethod
+    def _email_keyboard(entries) -> Optional[InlineKeyboardMarkup]:
+        """One row per listed email: open, attachments, then mark read / archive / flag"""
+        rows = []
+        for i, (email_id, has_attachments) in enumerate(entries, 1):
+            if not email_id:
+                continue
+            row = [InlineKeyboardButton(f"📄 {i}", callback_data=f"body:{email_id}")]
+            if has_attachments:
+                row.append(InlineKeyboardButton("📎", callback_data=f"atts:{email_id}"))
+            row += [
+                InlineKeyboardButton("✅", callback_data=f"act:{ACTION_READ}:{email_id}"),
+                InlineKeyboardButton("🗄", callback_data=f"act:{ACTION_ARCHIVE}:{email_id}"),
+                InlineKeyboardButton("🚩", callback_data=f"act:{ACTION_FLAG}:{email_id}"),
+            ]
+            rows.append(row)
+        
+        return InlineKeyboardMarkup(rows) if rows else None
+    
+    async def handle_action(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Queue a mark read / archive / flag tap; results arrive as one summary per batch"""
+        query = update.callback_query
+        telegram_id = str(query.from_user.id)
+        _, action, email_id = query.data.split(":")
+        
+        labels = {ACTION_READ: "Marking as read", ACTION_ARCHIVE: "Archiving", ACTION_FLAG: "Flagging"}
+        await query.answer(f"{labels[action]}...")
+        
+        await self.actions.enqueue(
+            telegram_id, int(email_id), action,
+            notify=lambda summary: query.message.reply_text(summary)
+        )
+    
+    async def _send_full_body(self, message, telegram_id: str, email_id: int):
+        """Fetch (or reuse) a full message body and send it"""
+        body = await asyncio.to_thread(self.email_service.get_full_body, telegram_id, email_id)
+        if body is None:
+            await message.reply_text("❌ Could not load this message. It may have been deleted.")
+            return
+        
+        for chunk in split_blocks([body]):
+            await message.reply_text(chunk, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+    
+    async def _send_attachment_list(self, message, telegram_id: str, email_id: int):
+        """List an email's attachments with one forward button each"""
+        try:
+            attachments = await asyncio.to_thread(self.attachments.list_attachments, telegram_id, email_id)
+        except AttachmentError as e:
+            await message.reply_text(f"❌ {e}")
+            return
         
-        # Get emails
-        emails = self.email_service.get_emails(telegram_id, limit=5)
+        if not attachments:
+            await message.reply_text("📎 This email has no downloadable attachments.")
+            return
+        
+        keyboard = []
+        for i, attachment in enumerate(attachments):
+            size_kb = max(1, attachment['size'] // 1024)
+            label = f"📎 {attachment['name'][:40]} ({size_kb} KB)"
+            if attachment['size'] > TELEGRAM_UPLOAD_LIMIT:
+                label = f"⛔ {attachment['name'][:40]} (too large)"
+            keyboard.append([InlineKeyboardButton(label, callback_data=f"att:{email_id}:{i}")])
+        
+        await message.reply_text(
+            f"📎 *Attachments ({len(attachments)})*\nTap one to receive it here.",
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    
+    async def _forward_attachment(self, message, telegram_id: str, email_id: int, index: int):
+        """Stream an attachment from Outlook into this chat"""
+        await message.chat.send_action(ChatAction.UPLOAD_DOCUMENT)
+        
+        loop = asyncio.get_running_loop()
+        try:
+            # Unlike to_thread, run_in_executor does not carry the trace context over by itself
+            await loop.run_in_executor(
+                self.attachments.executor,
+                contextvars.copy_context().run,
+                self.attachments.forward, telegram_id, email_id, index, message.chat_id
+            )
+        except AttachmentError as e:
+            await message.reply_text(f"❌ {e}")
+    
+    @staticmethod
+    def _inbox_header(outlook_email: str, count: int) -> str:
+        response = f"📧 *Latest Emails ({count})*\n"
+        response += f"Account: `{outlook_email}`\n"
+        response += f"Time: {datetime.now().strftime('%H:%M:%S')}\n\n"
+        return response
+    
+    @staticmethod
+    def _inbox_email_block(i: int, email) -> str:
+        attachments = "📎 " if email['has_attachments'] else ""
+        read_status = "✅ " if email['is_read'] else "🆕 "
+        
+        block = f"{read_status}*{i}. {email['subject']}*\n"
+        block += f"   👤 *From:* {email['sender']}\n"
+        block += f"   📝 {email['preview']}\n"
+        block += f"   🕒 {email['date'][:10]} {email['date'][11:16]}\n"
+        block += f"   {attachments}\n\n"
+        return block
+    
+    @staticmethod
+    def _stored_email_block(i: int, email) -> str:
+        attachments = "📎 " if email.has_attachments else ""
+        read_status = "✅ " if email.is_read else "🆕 "
+        
+        block = f"{read_status}*{i}. {email.subject[:50]}...*\n"
+        block += f"   👤 *From:* {email.sender}\n"
+        block += f"   🕒 {email.received_at.strftime('%Y-%m-%d %H:%M')}\n"
+        block += f"   {attachments}\n\n"
+        return block
+    
+    async def stored(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /stored command - show stored conversations, or emails from one folder"""
+        telegram_id = str(update.effective_user.id)
+        
+        if not context.args:
+            if await self._send_thread_page(update.message, telegram_id, offset=0):
+                return
+        
+        folder = None
+        if context.args and context.args != ['all']:
+            folder = await self._resolve_folder(update.message, telegram_id, ' '.join(context.args))
+            if not folder:
+                return
+        
+        emails = await asyncio.to_thread(
+            self.email_service.get_stored_emails, telegram_id, limit=10, folder_id=folder['id'] if folder else None
+        )
         
         if not emails:
             await update.message.reply_text(
-                f"📭 *No new emails found* in your inbox.\n"
-                f"Last checked: {datetime.now().strftime('%H:%M:%S')}",
+                "📭 *No stored emails found.*\n"
+                "Use /inbox or /sync to fetch and store emails first.",
                 parse_mode=ParseMode.MARKDOWN
             )
             return
         
-        # Display emails
-        response = f"📧 *Latest Emails ({len(emails)})*\n"
-        response += f"Account: `{user.outlook_email}`\n"
-        response += f"Time: {datetime.now().strftime('%H:%M:%S')}\n\n"
+        title = f"💾 *Stored Emails in {folder['path']}*" if folder else "💾 *Stored Emails*"
+        response = f"{title} ({len(emails)})\n\n"
         
         for i, email in enumerate(emails, 1):
-            attachments = "📎 " if email['has_attachments'] else ""
-            read_status = "✅ " if email['is_read'] else "🆕 "
-            
-            response += f"{read_status}*{i}. {email['subject']}*\n"
-            response += f"   👤 *From:* {email['sender']}\n"
-            response += f"   📝 {email['preview']}\n"
-            response += f"   🕒 {email['date'][:10]} {email['date'][11:16]}\n"
-            response += f"   {attachments}\n\n"
+            response += self._stored_email_block(i, email)
         
-        response += "💾 *Emails are automatically stored locally*\n"
-        response += "Use /stored to view all stored emails"
+        response += "🔍 Use /search <keyword> to find specific emails\n"
+        response += "📄 Tap a number to read a message, 📎 for attachments, ✅ 🗄 🚩 to mark read, archive or flag"
         
         await update.message.reply_text(
             response,
             parse_mode=ParseMode.MARKDOWN,
-            disable_web_page_preview=True
+            disable_web_page_preview=True,
+            reply_markup=self._email_keyboard([(email.id, email.has_attachments) for email in emails])
         )
     
-    async def stored(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /stored command - show stored emails"""
+    async def senders(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /senders command - show who sends the most stored mail"""
         telegram_id = str(update.effective_user.id)
         
-        emails = self.email_service.get_stored_emails(telegram_id, limit=10)
-        
-        if not emails:
+        top = await asyncio.to_thread(self.email_service.senders.top_senders, telegram_id, SENDER_TOP_LIMIT)
+        if not top:
             await update.message.reply_text(
                 "📭 *No stored emails found.*\n"
-                "Use /inbox to fetch and store emails first.",
+                "Use /inbox or /sync to fetch and store emails first.",
                 parse_mode=ParseMode.MARKDOWN
             )
             return
         
-        response = f"💾 *Stored Emails ({len(emails)})*\n\n"
+        response = "👥 *Top Senders*\n\n"
+        for i, sender in enumerate(top, 1):
+            name = f"{sender.display_name} " if sender.display_name else ""
+            response += f"*{i}.* {escape_markdown(name)}`{sender.address}` ({sender.count})\n"
+        response += "\nTap a number to list that sender's emails"
         
-        for i, email in enumerate(emails, 1):
-            attachments = "📎 " if email.has_attachments else ""
-            read_status = "✅ " if email.is_read else "🆕 "
-            
-            response += f"{read_status}*{i}. {email.subject[:50]}...*\n"
-            response += f"   👤 *From:* {email.sender}\n"
-            response += f"   🕒 {email.received_at.strftime('%Y-%m-%d %H:%M')}\n"
-            response += f"   {attachments}\n\n"
+        buttons = [InlineKeyboardButton(str(i), callback_data=f"sender:{sender.id}") for i, sender in enumerate(top, 1)]
+        rows = [buttons[i:i + BUTTONS_PER_ROW] for i in range(0, len(buttons), BUTTONS_PER_ROW)]
         
-        response += "🔍 Use /search <keyword> to find specific emails"
+        await update.message.reply_text(
+            response,
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=InlineKeyboardMarkup(rows)
+        )
+    
+    async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /stats command - mailbox statistics from the counter tables"""
+        telegram_id = str(update.effective_user.id)
+        
+        stats = await asyncio.to_thread(get_stats, telegram_id)
+        if not stats:
+            await update.message.reply_text(
+                "📭 *No statistics available.*\n"
+                "Use /inbox or /sync to fetch and store emails first.",
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return
+        
+        response = "📊 *Mailbox Statistics*\n\n"
+        response += f"📧 Total: {stats.total}\n"
+        response += f"🆕 Unread: {stats.unread}\n"
+        response += f"📎 With attachments: {stats.with_attachments}\n"
+        if stats.first_received_at:
+            response += (
+                f"🗓 {stats.first_received_at.strftime('%Y-%m-%d')} → "
+                f"{stats.last_received_at.strftime('%Y-%m-%d')}\n"
+            )
+        
+        if stats.daily:
+            response += "\n*Last 7 days:*\n"
+            for day, count in stats.daily:
+                response += f"   {day.strftime('%a %d')}: {count}\n"
+        
+        if stats.top_senders:
+            response += "\n*Top senders:*\n"
+            for address, count in stats.top_senders:
+                response += f"   `{address}` ({count})\n"
         
         await update.message.reply_text(
+            response,
+            parse_mode=ParseMode.MARKDOWN
+        )
+    
+    async def _send_sender_emails(self, message, telegram_id: str, sender_id: int):
+        """List stored emails from one sender"""
+        sender = await asyncio.to_thread(self.email_service.senders.get, sender_id)
+        emails = await asyncio.to_thread(
+            self.email_service.get_stored_emails, telegram_id, limit=10, sender_id=sender_id
+        )
+        
+        if not sender or not emails:
+            await message.reply_text("📭 No stored emails from this sender.")
+            return
+        
+        response = f"👤 *Emails from* `{sender.address}`\n\n"
+        for i, email in enumerate(emails, 1):
+            response += self._stored_email_block(i, email)
+        
+        await message.reply_text(
             response,
             parse_mode=ParseMode.MARKDOWN,
-            disable_web_page_preview=True
+            disable_web_page_preview=True,
+            reply_markup=self._email_keyboard([(email.id, email.has_attachments) for email in emails])
+        )
+    
+    async def _send_thread_page(self, message, telegram_id: str, offset: int) -> bool:
+        """Send one page of conversations; False if the user has no threads yet"""
+        threads, has_more = await asyncio.to_thread(get_thread_page, telegram_id, offset, THREAD_PAGE_SIZE)
+        if not threads:
+            return False
+        
+        response = "💬 *Stored Conversations*\n\n"
+        for i, thread in enumerate(threads, offset + 1):
+            unread = f"🆕 {thread.unread_count} " if thread.unread_count else "✅ "
+            response += f"{unread}*{i}. {escape_markdown((thread.subject or 'No Subject')[:50])}*\n"
+            response += f"   💬 {thread.message_count} messages · 👤 {escape_markdown(thread.latest_sender or '')}\n"
+            if len(thread.participants) > 1:
+                response += f"   👥 {len(thread.participants)} participants\n"
+            response += f"   🕒 {thread.latest_received_at.strftime('%Y-%m-%d %H:%M')}\n\n"
+        response += "Tap a number to open a conversation · `/stored all` lists single emails"
+        
+        buttons = [
+            InlineKeyboardButton(str(i), callback_data=f"thread:{thread.id}")
+            for i, thread in enumerate(threads, offset + 1)
+        ]
+        rows = [buttons[i:i + BUTTONS_PER_ROW] for i in range(0, len(buttons), BUTTONS_PER_ROW)]
+        
+        navigation = []
+        if offset:
+            navigation.append(InlineKeyboardButton(
+                "⬅️ Previous", callback_data=f"threads_page:{max(0, offset - THREAD_PAGE_SIZE)}"
+            ))
+        if has_more:
+            navigation.append(InlineKeyboardButton("➡️ Next", callback_data=f"threads_page:{offset + THREAD_PAGE_SIZE}"))
+        if navigation:
+            rows.append(navigation)
+        
+        await message.reply_text(
+            response,
+            parse_mode=ParseMode.MARKDOWN,
+            disable_web_page_preview=True,
+            reply_markup=InlineKeyboardMarkup(rows)
+        )
+        return True
+    
+    async def _send_thread(self, message, telegram_id: str, thread_id: int):
+        """List the stored messages of one conversation"""
+        conversation_id = await asyncio.to_thread(get_conversation_id, telegram_id, thread_id)
+        emails = await asyncio.to_thread(
+            self.email_service.get_stored_emails, telegram_id, limit=10, conversation_id=conversation_id
+        ) if conversation_id else []
+        
+        if not emails:
+            await message.reply_text("📭 This conversation has no stored emails.")
+            return
+        
+        response = "💬 *Conversation*\n\n"
+        for i, email in enumerate(emails, 1):
+            response += self._stored_email_block(i, email)
+        
+        await message.reply_text(
+            response,
+            parse_mode=ParseMode.MARKDOWN,
+            disable_web_page_preview=True,
+            reply_markup=self._email_keyboard([(email.id, email.has_attachments) for email in emails])
         )
     
     async def status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -277,8 +672,7 @@ class OutlookEmailBot:
         telegram_id = str(update.effective_user.id)
         username = update.effective_user.username or update.effective_user.first_name
         
-        session = Session()
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+        user = await asyncio.to_thread(user_cache.get, telegram_id)
         
         if user and user.is_connected:
             # Check token expiry
@@ -322,7 +716,7 @@ class OutlookEmailBot:
             🔗 *To get started:*
             1. Use /connect to generate a unique link
             2. Click the link and sign in
-            3. Grant permission to read emails
+            3. Grant permission to read and manage your emails
             4. Start managing emails in Telegram!
             
             🔒 *We never store your password*
@@ -338,14 +732,9 @@ class OutlookEmailBot:
         telegram_id = str(update.effective_user.id)
         username = update.effective_user.username or update.effective_user.first_name
         
-        session = Session()
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+        email = await asyncio.to_thread(self._remove_user, telegram_id)
         
-        if user:
-            email = user.outlook_email
-            session.delete(user)
-            session.commit()
-            
+        if email is not None:
             # Remove from active connections
             if telegram_id in self.active_connections:
                 del self.active_connections[telegram_id]
@@ -366,6 +755,27 @@ class OutlookEmailBot:
                 parse_mode=ParseMode.MARKDOWN
             )
     
+    def _remove_user(self, telegram_id: str) -> Optional[str]:
+        """Delete a user's account and stored mail; returns their Outlook address, or None if not connected"""
+        session = Session()
+        try:
+            user = session.query(User).filter_by(telegram_id=telegram_id).first()
+            if not user:
+                return None
+            
+            email = user.outlook_email or ''
+            session.delete(user)
+            session.commit()
+            user_cache.invalidate(telegram_id)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        
+        self.email_service.delete_user_data(telegram_id)
+        return email
+    
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /help command"""
         help_text = f"""
@@ -380,8 +790,15 @@ class OutlookEmailBot:
         
         📧 *Email Management:*
         • `/inbox` - View latest emails (auto-stores them)
-        • `/stored` - View locally stored emails
-        • `/search <keyword>` - Search emails
+        • `/stored [folder|all]` - View stored conversations, or emails
+        • `/search <keyword> [folder:<name>] [archive:yes]` - Search emails
+        • `/folders` - List mail folders
+        • `/senders` - Who sends you the most mail
+        • `/stats` - Mailbox statistics
+        • `/sync` - Fetch new mail from every folder
+        • `/export [jsonl|csv]` - Download all stored emails
+        • `/backfill` - Import your full mailbox history
+        • `/retention [days rows|off]` - Archive emails past a limit
         
         ℹ️ *Information:*
         • `/help` - This help message
@@ -392,7 +809,7 @@ class OutlookEmailBot:
         • Links expire in 10 minutes
         • Old links automatically invalidated
         • Your password is never stored
-        • Read-only email access
+        • Mail is only changed when you tap ✅ 🗄 🚩
         
         💡 *Tip:* Use /connect anytime to generate a fresh link!
         """
@@ -404,69 +821,323 @@ class OutlookEmailBot:
     
     async def search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /search command"""
-        if not context.args:
+        terms = [arg for arg in context.args if not arg.lower().startswith(('folder:', 'archive:'))]
+        if not terms:
             await update.message.reply_text(
                 "🔍 *Search Usage:*\n"
                 "`/search keyword` - Search emails by subject or sender\n"
+                "`/search keyword folder:Name` - Search a single folder\n"
+                "`/search keyword archive:yes` - Include archived emails\n"
                 "Example: `/search invoice`",
                 parse_mode=ParseMode.MARKDOWN
             )
             return
         
         telegram_id = str(update.effective_user.id)
-        query = ' '.join(context.args)
         
-        emails = self.email_service.search_emails(telegram_id, query)
+        folder_id = None
+        folder_args = [arg.split(':', 1)[1] for arg in context.args if arg.lower().startswith('folder:')]
+        include_archive = any(arg.lower() == 'archive:yes' for arg in context.args)
+        if folder_args:
+            folder = await self._resolve_folder(update.message, telegram_id, folder_args[0])
+            if not folder:
+                return
+            folder_id = folder['id']
+        
+        query = ' '.join(terms)
+        context.user_data['search_query'] = query
+        context.user_data['search_folder'] = folder_id
+        context.user_data['search_archive'] = include_archive
+        
+        await self._send_search_page(
+            update.message, telegram_id, query, offset=0,
+            folder_id=folder_id, include_archive=include_archive
+        )
+    
+    async def _send_search_page(self, message, telegram_id: str, query: str, offset: int, folder_id=None,
+                                include_archive: bool = False):
+        """Send one page of search results (cached after the first page)"""
+        emails = await asyncio.to_thread(
+            self.email_service.search_emails,
+            telegram_id, query, limit=SEARCH_PAGE_SIZE, offset=offset,
+            folder_id=folder_id, include_archive=include_archive
+        )
         
         if not emails:
-            await update.message.reply_text(
+            await message.reply_text(
                 f"🔍 *No results found for:* `{query}`\n"
                 "Try different keywords or check /inbox first.",
                 parse_mode=ParseMode.MARKDOWN
             )
             return
         
-        response = f"🔍 *Search Results for '{query}'* ({len(emails)} found)\n\n"
+        # Results are not cached while Graph is unreachable, so count at least this page
+        total = max(
+            self.email_service.count_search_results(telegram_id, query, folder_id, include_archive),
+            offset + len(emails)
+        )
+        response = f"🔍 *Search Results for '{query}'* ({total} found)\n\n"
         
-        for i, email in enumerate(emails, 1):
+        for i, email in enumerate(emails, offset + 1):
             attachments = "📎 " if email.has_attachments else ""
-            response += f"*{i}. {email.subject[:60]}...*\n"
+            archived = "🗄 " if email.id is None else ""
+            response += f"{archived}*{i}. {email.subject[:60]}...*\n"
             response += f"   👤 *From:* {email.sender}\n"
             response += f"   🕒 {email.received_at.strftime('%Y-%m-%d')}\n"
             response += f"   {attachments}\n\n"
         
-        await update.message.reply_text(
+        reply_markup = None
+        next_offset = offset + SEARCH_PAGE_SIZE
+        if next_offset < total:
+            keyboard = [[InlineKeyboardButton("➡️ Next", callback_data=f"search_page:{next_offset}")]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await message.reply_text(
             response,
             parse_mode=ParseMode.MARKDOWN,
-            disable_web_page_preview=True
+            disable_web_page_preview=True,
+            reply_markup=reply_markup
+        )
+    
+    async def _resolve_folder(self, message, telegram_id: str, name: str):
+        """Look up a folder by name, replying with the folder list if not found"""
+        folder = await asyncio.to_thread(self.email_service.find_folder, telegram_id, name)
+        if not folder:
+            await message.reply_text(
+                f"📁 *Folder not found:* `{name}`\n"
+                "Use /folders to list your folders.",
+                parse_mode=ParseMode.MARKDOWN
+            )
+        return folder
+    
+    async def folders(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /folders command - list mail folders"""
+        telegram_id = str(update.effective_user.id)
+        
+        folders = await asyncio.to_thread(self.email_service.get_folders, telegram_id)
+        if not folders:
+            await update.message.reply_text(
+                "📁 *No folders found.*\n"
+                "Make sure your account is connected with /connect.",
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return
+        
+        response = f"📁 *Mail Folders ({len(folders)})*\n\n"
+        for folder in folders:
+            depth = folder['path'].count('/')
+            response += f"{'   ' * depth}• {folder['name']} ({folder['unread']}/{folder['total']})\n"
+        
+        response += "\nUse `/stored <folder>` or `/search <keyword> folder:<folder>`"
+        
+        await update.message.reply_text(
+            response,
+            parse_mode=ParseMode.MARKDOWN
+        )
+    
+    async def sync(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /sync command - fetch new mail from every folder"""
+        telegram_id = str(update.effective_user.id)
+        
+        await update.message.reply_text("🔄 Syncing all folders...")
+        
+        count = await self.flights.do(
+            (telegram_id, 'sync'),
+            lambda: asyncio.to_thread(self.email_service.sync_folders, telegram_id)
+        )
+        
+        retry_after = outage_retry_after('graph', 'login')
+        if retry_after is not None:
+            await update.message.reply_text(
+                f"⚠️ *Outlook is not responding*\n"
+                f"{count} new emails stored before it stopped. Try /sync again in {retry_after:.0f}s.\n"
+                f"Stored emails are still available with /stored and /search.",
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return
+        
+        await update.message.reply_text(
+            f"✅ *Sync complete*\n"
+            f"{count} new emails stored.",
+            parse_mode=ParseMode.MARKDOWN
+        )
+    
+    async def export(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /export command - send stored emails as a compressed file"""
+        telegram_id = str(update.effective_user.id)
+        fmt = context.args[0].lower() if context.args else 'jsonl'
+        
+        if fmt not in EXPORT_FORMATS:
+            await update.message.reply_text(
+                "📦 *Export Usage:*\n"
+                "`/export` - JSONL (default)\n"
+                "`/export csv` - CSV",
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return
+        
+        await update.message.reply_text("📦 Preparing your export...")
+        
+        fileobj, count = await asyncio.to_thread(export_to_tempfile, telegram_id, fmt)
+        try:
+            if not count:
+                await update.message.reply_text(
+                    "📭 *No stored emails to export.*\n"
+                    "Use /inbox to fetch and store emails first.",
+                    parse_mode=ParseMode.MARKDOWN
+                )
+                return
+            
+            filename = f"emails_{datetime.utcnow().strftime('%Y%m%d')}.{fmt}.gz"
+            await update.message.chat.send_action(ChatAction.UPLOAD_DOCUMENT)
+            loop = asyncio.get_running_loop()
+            # Streamed from disk in chunks, like attachments, instead of read whole by PTB
+            await loop.run_in_executor(
+                self.attachments.executor,
+                contextvars.copy_context().run,
+                self.attachments.send_file,
+                update.message.chat_id, fileobj, filename, 'application/gzip', f"📦 {count} emails exported"
+            )
+        except AttachmentError as e:
+            await update.message.reply_text(f"❌ {e}")
+        finally:
+            fileobj.close()
+    
+    async def backfill_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /backfill command - import the whole mailbox in the background"""
+        telegram_id = str(update.effective_user.id)
+        
+        user = await asyncio.to_thread(user_cache.get, telegram_id)
+        
+        if not user or not user.is_connected:
+            await update.message.reply_text(
+                "❌ *Not Connected*\n"
+                "Please use /connect to connect your Outlook account first.",
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return
+        
+        state = await asyncio.to_thread(self.backfill.get_state, telegram_id)
+        if state and state.is_complete:
+            await update.message.reply_text(
+                f"✅ *Mailbox import complete*\n"
+                f"{state.messages_stored} emails stored.",
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return
+        
+        started = self.backfill.start(telegram_id)
+        progress = f"{state.messages_stored} emails stored so far." if state else "Starting..."
+        
+        await update.message.reply_text(
+            f"📥 *Mailbox import {'started' if started else 'in progress'}*\n"
+            f"{progress}\n\n"
+            "You can keep using the bot meanwhile. Run /backfill again to check progress.",
+            parse_mode=ParseMode.MARKDOWN
+        )
+    
+    async def retention_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /retention command - show or set how long emails stay in the hot table"""
+        telegram_id = str(update.effective_user.id)
+        
+        if context.args:
+            args = [arg.lower() for arg in context.args]
+            if args == ['off']:
+                max_age_days, max_rows = None, None
+            elif len(args) == 2 and all(arg.isdigit() for arg in args):
+                max_age_days, max_rows = (int(arg) or None for arg in args)
+            else:
+                await update.message.reply_text(
+                    "🗄 *Retention Usage:*\n"
+                    "`/retention` - Show your policy\n"
+                    "`/retention <days> <rows>` - Archive emails older than days or beyond rows (0 = no limit)\n"
+                    "`/retention off` - Keep everything\n"
+                    "Example: `/retention 365 5000`",
+                    parse_mode=ParseMode.MARKDOWN
+                )
+                return
+            
+            await asyncio.to_thread(self.retention.set_policy, telegram_id, max_age_days, max_rows)
+        
+        policy = await asyncio.to_thread(self.retention.get_policy, telegram_id)
+        hot_rows = await asyncio.to_thread(self.retention.hot_row_count, telegram_id)
+        
+        age = f"{policy['max_age_days']} days" if policy['max_age_days'] else "no limit"
+        rows = f"{policy['max_rows']} emails" if policy['max_rows'] else "no limit"
+        await update.message.reply_text(
+            f"🗄 *Retention Policy*\n"
+            f"Max age: {age}\n"
+            f"Max stored: {rows}\n"
+            f"Currently stored: {hot_rows}\n\n"
+            "Older emails are moved to the archive. Search them with `/search <keyword> archive:yes`",
+            parse_mode=ParseMode.MARKDOWN
         )
     
     def run(self):
         """Start the bot"""
-        app = Application.builder().token(self.token).build()
+        self.update_processor = PerChatUpdateProcessor()
+        app = Application.builder()\
+            .token(self.token)\
+            .concurrent_updates(self.update_processor)\
+            .request(InstrumentedHTTPXRequest(connection_pool_size=256))\
+            .build()
+        
+        def limit(callback, flood_control=self.flood_control):
+            # Timed inside flood control, so dropped updates do not skew latencies
+            return flood_control.limit(instrumented(callback.__name__, callback))
         
         # Add handlers
-        app.add_handler(CommandHandler("start", self.start))
-        app.add_handler(CommandHandler("connect", self.connect))
-        app.add_handler(CommandHandler("inbox", self.inbox))
-        app.add_handler(CommandHandler("stored", self.stored))
-        app.add_handler(CommandHandler("status", self.status))
-        app.add_handler(CommandHandler("disconnect", self.disconnect))
-        app.add_handler(CommandHandler("help", self.help_command))
-        app.add_handler(CommandHandler("search", self.search))
+        app.add_handler(CommandHandler("start", limit(self.start)))
+        app.add_handler(CommandHandler("connect", limit(self.connect)))
+        app.add_handler(CommandHandler("inbox", limit(self.inbox)))
+        app.add_handler(CommandHandler("stored", limit(self.stored)))
+        app.add_handler(CommandHandler("status", limit(self.status)))
+        app.add_handler(CommandHandler("disconnect", limit(self.disconnect)))
+        app.add_handler(CommandHandler("help", limit(self.help_command)))
+        app.add_handler(CommandHandler("search", limit(self.search)))
+        app.add_handler(CommandHandler("export", limit(self.export)))
+        app.add_handler(CommandHandler("backfill", limit(self.backfill_command)))
+        app.add_handler(CommandHandler("folders", limit(self.folders)))
+        app.add_handler(CommandHandler("senders", limit(self.senders)))
+        app.add_handler(CommandHandler("stats", limit(self.stats)))
+        app.add_handler(CommandHandler("sync", limit(self.sync)))
+        app.add_handler(CommandHandler("retention", limit(self.retention_command)))
         
         # Callback handlers
-        app.add_handler(CallbackQueryHandler(self.handle_callback))
+        app.add_handler(CallbackQueryHandler(limit(self.handle_action, self.action_flood_control), pattern=r'^act:'))
+        app.add_handler(CallbackQueryHandler(limit(self.handle_callback)))
         
         # Message handler for auth callback
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_auth_callback))
+        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented('handle_auth_callback', self.handle_auth_callback)))
+        
+        # Pick up backfills interrupted by a restart
+        self.backfill.resume_pending()
+        
+        # Intern sender addresses of emails stored before the senders table existed
+        threading.Thread(target=self.email_service.senders.migrate_legacy, name='sender-migration', daemon=True).start()
+        
+        # Move emails past their retention policy into the archive
+        self.retention.start()
+        
+        # Queue depths are read when a snapshot is taken; the callback server serves them at /metrics
+        UPDATES_QUEUED.set_function(lambda: self.update_processor.metrics()['queued'])
+        UPDATES_ACTIVE.set_function(lambda: self.update_processor.metrics()['active'])
+        MAIL_ACTIONS_PENDING.set_function(lambda: len(self.actions))
+        MetricsExporter('bot').start()
         
         print("🤖 Outlook Email Bot is running...")
         print("🔗 Each /connect command generates a UNIQUE link!")
         print("📧 Use /connect to get started")
         
-        app.run_polling(allowed_updates=Update.ALL_TYPES)
+        try:
+            app.run_polling(allowed_updates=Update.ALL_TYPES)
+        finally:
+            # Render workers are separate processes; do not leave them behind
+            self.email_service.render_pool.shutdown()
 
 if __name__ == "__main__":
+    setup_logging()
+    setup_tracing()
+    init_db()
     bot = OutlookEmailBot()
     bot.run()
@@ -1,8 +1,11 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import os
 from dotenv import load_dotenv
-from database import Session, User
+from database import Session, User, init_db
 from outlook_auth import OutlookAuth
+from metrics import REGISTRY, load_snapshots, render
+from tracing import start_span, current_traceparent, setup_tracing
+from logging_setup import setup_logging
 from datetime import datetime
 import requests
 
@@ -13,6 +16,16 @@ auth = OutlookAuth()
 
 @app.route('/callback')
 def callback():
+    """Trace the OAuth callback, continuing the caller's trace if one was sent"""
+    state = request.args.get('state')
+    traceparent = request.headers.get('traceparent') or auth.state_traceparent(state)
+    with start_span('http.callback', {'http.route': '/callback'}, traceparent=traceparent, root=True):
+        response = app.make_response(_handle_callback())
+        if current_traceparent():
+            response.headers['traceparent'] = current_traceparent()
+        return response
+
+def _handle_callback():
     """Handle OAuth callback from Microsoft"""
     code = request.args.get('code')
     state = request.args.get('state')
@@ -56,6 +69,16 @@ def health():
     """Health check endpoint"""
     return jsonify({"status": "healthy", "timestamp": datetime.utcnow().isoformat()})
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics of this server and the bot process"""
+    snapshots = load_snapshots()
+    snapshots['callback_server'] = REGISTRY.snapshot()
+    return Response(render(snapshots), mimetype='text/plain; version=0.0.4')
+
 if __name__ == "__main__":
+    setup_logging()
+    setup_tracing()
+    init_db()
     port = int(os.getenv('PORT', 8000))
     app.run(host='0.0.0.0', port=port, debug=True)
@@ -0,0 +1,140 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Consecutive infrastructure failures that open a breaker, and how long it stays open
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', 30))
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of calling an endpoint whose breaker is open"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} circuit open, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures; once the timeout passes, a single probe decides"""
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        """True while calls are being refused (open, or half-open with a probe out)"""
+        with self._lock:
+            if self.state == STATE_OPEN:
+                return time.monotonic() < self.opened_at + self.reset_timeout
+            return self.state == STATE_HALF_OPEN and self._probe_in_flight
+
+    def retry_after(self) -> float:
+        with self._lock:
+            return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def before_call(self):
+        """Admit a call or raise CircuitOpenError"""
+        with self._lock:
+            if self.state == STATE_CLOSED:
+                return
+
+            now = time.monotonic()
+            if self.state == STATE_OPEN:
+                if now < self.opened_at + self.reset_timeout:
+                    raise CircuitOpenError(self.name, self.opened_at + self.reset_timeout - now)
+                self.state = STATE_HALF_OPEN
+                self._probe_in_flight = False
+
+            # Half-open: exactly one caller probes, everyone else keeps failing fast
+            if self._probe_in_flight:
+                raise CircuitOpenError(self.name, self.reset_timeout)
+            self._probe_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != STATE_CLOSED:
+                logger.info(f"Circuit {self.name} closed again")
+            self.state = STATE_CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == STATE_HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != STATE_OPEN:
+                    logger.warning(f"Circuit {self.name} opened after {self.failures} failures")
+                self.state = STATE_OPEN
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if is_outage(e):
+                self.record_failure()
+            else:
+                # The endpoint answered; the request itself was the problem
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+
+def is_outage(error: Exception) -> bool:
+    """Whether an error says the endpoint is down, as opposed to rejecting this request
+
+    429 is deliberately excluded: Graph throttles per mailbox, and one busy
+    user must not cut everyone else off.
+    """
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500
+    return False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Process-wide breaker for an endpoint, created on first use"""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+def all_breakers() -> List[CircuitBreaker]:
+    with _breakers_lock:
+        return list(_breakers.values())
+
+
+def outage_retry_after(*names: str) -> Optional[float]:
+    """Seconds until the first of these breakers may close, or None if all are usable"""
+    waits = [breaker.retry_after() for breaker in map(get_breaker, names) if breaker.is_open]
+    return min(waits) if waits else None
@@ -1,15 +1,24 @@
-from sqlalchemy import create_engine, Column, String, Integer, DateTime, Text, Boolean
+from sqlalchemy import create_engine, inspect, func, select, case, update, tuple_, Column, String, Integer, DateTime, Date, Text, Boolean, \
+    LargeBinary, Index, ForeignKey, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, deferred
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
 import os
+import zlib
 from dotenv import load_dotenv
+from partitioning import create_partitioned_table
+from metrics import instrument_engine
+from tracing import trace_engine
+from profiler import profile_engine
 
 load_dotenv()
 
 Base = declarative_base()
-engine = create_engine(os.getenv('DATABASE_URL'))
-Session = sessionmaker(bind=engine)
+# Bound by init_db(); importing this module never connects or runs DDL
+engine = None
+Session = sessionmaker()
 
 class User(Base):
     __tablename__ = 'users'
@@ -29,20 +38,326 @@ class User(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class Sender(Base):
+    __tablename__ = 'senders'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # Lowercased so every spelling of an address interns to one row
+    address = Column(String, unique=True, nullable=False)
+    display_name = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 class Email(Base):
     __tablename__ = 'emails'
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     telegram_id = Column(String)
     outlook_id = Column(String, unique=True)
+    # Legacy inline address; new rows reference senders via sender_id instead
     sender = Column(String)
+    sender_id = Column(Integer, ForeignKey('senders.id'), nullable=True)
     recipient = Column(String)
     subject = Column(Text)
-    body = Column(Text)
+    # Legacy plain-text body; new rows store body_z instead
+    body = deferred(Column(Text))
+    # LONGBLOB on MySQL, whose BLOB caps large HTML bodies at 64 KB
+    body_z = deferred(Column(LargeBinary().with_variant(mysql.LONGBLOB(), 'mysql'), nullable=True))
     received_at = Column(DateTime)
     is_read = Column(Boolean, default=False)
     has_attachments = Column(Boolean, default=False)
+    folder_id = Column(String, nullable=True, index=True)
+    conversation_id = Column(String, nullable=True, index=True)
     stored_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Serves per-user newest-first listing and retention cutoffs
+        Index('ix_emails_telegram_received', 'telegram_id', 'received_at'),
+        # Per-sender listing, newest first
+        Index('ix_emails_telegram_sender', 'telegram_id', 'sender_id', 'received_at'),
+    )
+
+# Sender address as a column: interned for new rows, inline for legacy ones
+email_sender = func.coalesce(
+    select(Sender.address).where(Sender.id == Email.sender_id).correlate(Email).scalar_subquery(),
+    Email.sender
+).label('sender')
+
+# Compressed body header: codec byte + kind byte, then the payload
+BODY_CODEC_ZLIB = b'z'
+BODY_CODEC_RAW = b'n'
+BODY_KIND_PREVIEW = b'p'
+BODY_KIND_TEXT = b't'
+BODY_KIND_HTML = b'h'
+BODY_COMPRESS_MIN = 64
+
+def compress_body(text: str, kind: bytes = BODY_KIND_PREVIEW) -> bytes:
+    """Encode a body for body_z; tiny bodies are stored raw, where zlib would only add bytes"""
+    data = text.encode('utf-8')
+    if len(data) < BODY_COMPRESS_MIN:
+        return BODY_CODEC_RAW + kind + data
+    return BODY_CODEC_ZLIB + kind + zlib.compress(data, 6)
+
+def decompress_body(blob: Optional[bytes]) -> Tuple[bytes, str]:
+    """Decode body_z into (kind, text)"""
+    if not blob:
+        return BODY_KIND_PREVIEW, ''
+    
+    codec, kind, payload = blob[:1], blob[1:2], blob[2:]
+    if codec == BODY_CODEC_ZLIB:
+        payload = zlib.decompress(payload)
+    return kind, payload.decode('utf-8')
+
+class BackfillState(Base):
+    __tablename__ = 'backfill_state'
+    
+    telegram_id = Column(String, primary_key=True)
+    next_link = Column(Text, nullable=True)
+    pages_fetched = Column(Integer, default=0)
+    messages_stored = Column(Integer, default=0)
+    is_complete = Column(Boolean, default=False)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class FolderSyncState(Base):
+    __tablename__ = 'folder_sync_state'
+    
+    telegram_id = Column(String, primary_key=True)
+    folder_id = Column(String, primary_key=True)
+    last_received_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class AttachmentFile(Base):
+    __tablename__ = 'attachment_files'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    graph_attachment_id = Column(String, index=True)
+    content_hash = Column(String(64), index=True)
+    size = Column(Integer, index=True)
+    telegram_file_id = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class RetentionPolicy(Base):
+    __tablename__ = 'retention_policies'
+    
+    telegram_id = Column(String, primary_key=True)
+    max_age_days = Column(Integer, nullable=True)
+    max_rows = Column(Integer, nullable=True)
+    last_compacted_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ArchivedEmail(Base):
+    """Tombstone for an email moved to the archive, so it is never stored again"""
+    __tablename__ = 'archived_emails'
+    
+    outlook_id = Column(String, primary_key=True)
+    telegram_id = Column(String, index=True, nullable=False)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+class PartitionCutoff(Base):
+    """Everything received before dropped_before left the table with its dropped partitions"""
+    __tablename__ = 'partition_cutoffs'
+    
+    table_name = Column(String, primary_key=True)
+    dropped_before = Column(DateTime, nullable=False)
+
+class MailboxStats(Base):
+    __tablename__ = 'mailbox_stats'
+    
+    telegram_id = Column(String, primary_key=True)
+    total = Column(Integer, default=0, nullable=False)
+    unread = Column(Integer, default=0, nullable=False)
+    with_attachments = Column(Integer, default=0, nullable=False)
+    first_received_at = Column(DateTime, nullable=True)
+    last_received_at = Column(DateTime, nullable=True)
+    # Set once the counters include every email; rows created by ingest alone may not
+    backfilled_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-# Create tables
-Base.metadata.create_all(engine)
+class MailboxDailyCount(Base):
+    __tablename__ = 'mailbox_daily_counts'
+    
+    telegram_id = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, default=0, nullable=False)
+
+class MailboxSenderCount(Base):
+    __tablename__ = 'mailbox_sender_counts'
+    
+    telegram_id = Column(String, primary_key=True)
+    sender_id = Column(Integer, ForeignKey('senders.id'), primary_key=True)
+    count = Column(Integer, default=0, nullable=False)
+    
+    __table_args__ = (
+        Index('ix_mailbox_sender_counts_top', 'telegram_id', 'count'),
+    )
+
+_UPSERT_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+def upsert_counters(session, model, keys: Dict[str, Any], increments: Dict[str, Any],
+                    bounds: Optional[Dict[str, Tuple[Any, str]]] = None,
+                    latest: Optional[Tuple[str, Dict[str, Any]]] = None,
+                    on_insert: Optional[Dict[str, Any]] = None):
+    """Atomically fold values into a counter row, creating it if missing
+    
+    increments are added to the stored values. bounds maps column -> (value,
+    'min' | 'max') for columns keeping the smallest/largest value seen. latest
+    is (order_column, values): values replace the stored ones only when the
+    incoming order_column is not older. on_insert values are only written
+    when the row is created.
+    """
+    bounds = bounds or {}
+    order_column, latest_values = latest or (None, {})
+    table = model.__table__
+    dialect = session.get_bind().dialect.name
+    
+    values = {**keys, **(on_insert or {}), **latest_values, **increments}
+    values.update({column: value for column, (value, _) in bounds.items()})
+    if 'updated_at' in table.c:
+        values['updated_at'] = datetime.utcnow()
+    
+    def merged(column, incoming):
+        current = table.c[column]
+        if column in increments:
+            return current + incoming(column)
+        if column in latest_values:
+            newer = incoming(order_column) >= func.coalesce(table.c[order_column], incoming(order_column))
+            return case((newer, incoming(column)), else_=current)
+        if column == 'updated_at':
+            return incoming(column)
+        # NULL-safe least/greatest across dialects
+        pick = bounds[column][1]
+        if dialect == 'sqlite':
+            combine = func.min if pick == 'min' else func.max
+        else:
+            combine = func.least if pick == 'min' else func.greatest
+        return combine(func.coalesce(current, incoming(column)), incoming(column))
+    
+    # MySQL applies assignments left to right, so "latest" columns must be
+    # compared before the order column itself is overwritten
+    changed = [column for column in values if column not in keys and column not in (on_insert or {})]
+    changed.sort(key=lambda column: column not in latest_values or column == order_column)
+    
+    if dialect in _UPSERT_INSERTS:
+        stmt = _UPSERT_INSERTS[dialect](table).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={column: merged(column, lambda c: stmt.excluded[c]) for column in changed}
+        )
+    elif dialect == 'mysql':
+        stmt = mysql.insert(table).values(**values)
+        stmt = stmt.on_duplicate_key_update(
+            [(column, merged(column, lambda c: stmt.inserted[c])) for column in changed]
+        )
+    else:
+        conditions = [table.c[column] == value for column, value in keys.items()]
+        result = session.execute(
+            update(table).where(*conditions)
+            .values({column: merged(column, lambda c: values[c]) for column in changed})
+        )
+        if result.rowcount:
+            return
+        stmt = table.insert().values(**values)
+    
+    session.execute(stmt)
+
+def insert_ignore(session, model, rows: List[Dict[str, Any]], index_elements: List[str]):
+    """Insert rows in one statement, skipping those whose key already exists"""
+    if not rows:
+        return
+
+    table = model.__table__
+    dialect = session.get_bind().dialect.name
+
+    if dialect in _UPSERT_INSERTS:
+        stmt = _UPSERT_INSERTS[dialect](table).values(rows).on_conflict_do_nothing(index_elements=index_elements)
+    elif dialect == 'mysql':
+        stmt = mysql.insert(table).values(rows).prefix_with('IGNORE')
+    else:
+        conditions = [tuple(row[column] for column in index_elements) for row in rows]
+        key = tuple_(*(table.c[column] for column in index_elements))
+        present = {tuple(row) for row in session.execute(select(*key.clauses).where(key.in_(conditions)))}
+        rows = [row for row in rows if tuple(row[column] for column in index_elements) not in present]
+        if not rows:
+            return
+        stmt = table.insert().values(rows)
+
+    session.execute(stmt)
+
+class Thread(Base):
+    __tablename__ = 'threads'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    telegram_id = Column(String, nullable=False)
+    conversation_id = Column(String, nullable=False)
+    subject = Column(Text)
+    latest_outlook_id = Column(String)
+    latest_sender = Column(String)
+    latest_received_at = Column(DateTime)
+    message_count = Column(Integer, default=0, nullable=False)
+    unread_count = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('telegram_id', 'conversation_id', name='uq_threads_conversation'),
+        # One range scan renders a page of threads, newest activity first
+        Index('ix_threads_telegram_latest', 'telegram_id', 'latest_received_at'),
+    )
+
+class ThreadParticipant(Base):
+    __tablename__ = 'thread_participants'
+    
+    telegram_id = Column(String, primary_key=True)
+    conversation_id = Column(String, primary_key=True)
+    address = Column(String, primary_key=True)
+
+def _add_missing_columns():
+    """Add nullable columns and indexes introduced after a table was first created
+    
+    On MySQL, binary columns created as BLOB are also widened to the LONGBLOB
+    they are now declared as.
+    """
+    inspector = inspect(engine)
+    
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        
+        existing = {column['name']: column['type'] for column in inspector.get_columns(table.name)}
+        with engine.begin() as conn:
+            for column in table.columns:
+                column_type = column.type.compile(dialect=engine.dialect)
+                if column.name not in existing:
+                    conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+                elif engine.dialect.name == 'mysql' and column_type == 'LONGBLOB' \
+                        and existing[column.name].compile(dialect=engine.dialect) != column_type:
+                    conn.exec_driver_sql(f'ALTER TABLE {table.name} MODIFY COLUMN {column.name} {column_type} NULL')
+        
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(engine)
+
+def init_db(url: Optional[str] = None):
+    """Create the engine, bind Session and bring the schema up to date
+    
+    Called once by each entry point rather than on import, so processes that
+    only import this module (render pool workers) never touch the database.
+    """
+    global engine
+    if engine is not None:
+        return engine
+    
+    engine = create_engine(url or os.getenv('DATABASE_URL'))
+    instrument_engine(engine)
+    trace_engine(engine)
+    profile_engine(engine)
+    Session.configure(bind=engine)
+    
+    # Create tables; emails is created partitioned first when EMAIL_PARTITIONING is set
+    create_partitioned_table(engine, Email.__table__)
+    Base.metadata.create_all(engine)
+    _add_missing_columns()
+    return engine
@@ -1,27 +1,160 @@
 import requests
 from datetime import datetime, timedelta
-from database import Session, Email, User
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from database import Session, Email, ArchivedEmail, User, Sender, FolderSyncState, email_sender, compress_body, decompress_body, \
+    BODY_KIND_TEXT, BODY_KIND_HTML, BODY_KIND_PREVIEW, BackfillState, RetentionPolicy, Thread, ThreadParticipant, \
+    MailboxStats, MailboxDailyCount, MailboxSenderCount
 from outlook_auth import OutlookAuth
-from typing import List, Dict, Any
+from cache import LRUCache, ByteLRUCache
+from user_cache import user_cache
+from render_pool import RenderPool, escape_markdown
+from archive import ArchiveStore
+from senders import SenderDirectory, sender_of
+from partitioning import ingest_lock, partition_cutoff
+from stats import record_ingest
+from threads import record_threads
+from circuit_breaker import get_breaker, CircuitOpenError
+from metrics import timed_graph_call
+from tracing import start_span
+from logging_setup import LogAggregator
+from typing import Iterator, List, Dict, Any, NamedTuple, Optional, Set, Tuple
 import logging
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+GRAPH_URL = 'https://graph.microsoft.com/v1.0'
+
+MESSAGE_SELECT = 'id,subject,sender,toRecipients,bodyPreview,receivedDateTime,hasAttachments,isRead,parentFolderId,conversationId'
+
+# Hybrid search tuning
+SEARCH_MAX_RESULTS = 50
+SEARCH_CACHE_SIZE = 512
+SEARCH_CACHE_TTL = 300
+
+# Folder tree cache: folders rarely change, enumerating them costs several Graph calls
+FOLDER_CACHE_SIZE = 1024
+FOLDER_CACHE_TTL = 3600
+FOLDER_SYNC_PAGE_SIZE = 50
+# Bounds one sync of a long-idle folder; the cursor resumes from there next time
+FOLDER_SYNC_MAX_PAGES = 20
+
+# A concurrent writer (live fetch vs. backfill) can insert the same message between
+# our existence check and commit; the batch is re-checked and retried this often
+STORE_CONFLICT_RETRIES = 3
+
+# Rendered full message bodies, keyed by outlook_id
+BODY_CACHE_BYTES = 16 * 1024 * 1024
+
+GRAPH_BREAKER = get_breaker('graph')
+
+# Per-message and per-page lines swamp the log during backfills; count them instead
+STORED_LOG = LogAggregator(logger, "Stored {total} new emails for {keys} users")
+FETCHED_LOG = LogAggregator(logger, "Fetched {total} emails from Graph for {keys} users")
+
+class EmailSummary(NamedTuple):
+    """Detached, immutable row for list views (no ORM identity or instrumentation)"""
+    id: Optional[int]
+    outlook_id: str
+    sender: str
+    subject: str
+    received_at: datetime
+    is_read: bool
+    has_attachments: bool
+    folder_id: Optional[str]
+
+SUMMARY_COLUMNS = (
+    Email.id,
+    Email.outlook_id,
+    email_sender,
+    Email.subject,
+    Email.received_at,
+    Email.is_read,
+    Email.has_attachments,
+    Email.folder_id,
+)
+
 class EmailService:
     def __init__(self):
         self.auth = OutlookAuth()
+        
+        # (telegram_id, normalized query) -> merged result list
+        self.search_cache = LRUCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+        
+        # telegram_id -> flattened mail folder tree
+        self.folder_cache = LRUCache(maxsize=FOLDER_CACHE_SIZE, ttl=FOLDER_CACHE_TTL)
+        
+        # outlook_id -> rendered full body text
+        self.body_cache = ByteLRUCache(max_bytes=BODY_CACHE_BYTES)
+        self.render_pool = RenderPool()
+        self.archive = ArchiveStore()
+        self.senders = SenderDirectory()
+        
+        # telegram_id -> when the inbox last came back from Graph (shown in degraded mode)
+        self.last_synced = LRUCache(maxsize=FOLDER_CACHE_SIZE)
     
     def get_valid_token(self, telegram_id: str) -> Optional[str]:
         """Get valid access token, refreshing if necessary"""
-        session = Session()
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+        with start_span('token.acquire') as span:
+            profile = user_cache.get(telegram_id)
+            
+            if not profile or not profile.access_token:
+                return None
+            
+            if profile.expires_at and datetime.utcnow() <= profile.expires_at:
+                return profile.access_token
+            
+            if span:
+                span.set_attribute('refreshed', True)
+            try:
+                return self._refresh_user_token(telegram_id)
+            except CircuitOpenError as e:
+                logger.warning(f"Cannot refresh token for user {telegram_id}: {e}")
+                return None
+    
+    def cached_as_of(self, telegram_id: str) -> Optional[datetime]:
+        """When local data was last refreshed from Graph, for "cached as of" markers"""
+        synced = self.last_synced.get(telegram_id)
+        if synced:
+            return synced
         
-        if not user or not user.access_token:
-            return None
+        session = Session()
+        try:
+            return session.query(func.max(Email.stored_at)).filter(Email.telegram_id == telegram_id).scalar()
+        finally:
+            session.close()
+    
+    def delete_user_data(self, telegram_id: str):
+        """Remove everything stored for a user: emails, archive, counters and sync state"""
+        session = Session()
+        try:
+            for model in (Email, ArchivedEmail, Thread, ThreadParticipant, MailboxStats, MailboxDailyCount,
+                          MailboxSenderCount, FolderSyncState, BackfillState, RetentionPolicy):
+                session.query(model).filter(model.telegram_id == telegram_id).delete(synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
         
-        # Check if token needs refresh
-        if datetime.utcnow() > user.expires_at:
+        self.archive.delete_user(telegram_id)
+        self.folder_cache.pop(telegram_id)
+        self.last_synced.pop(telegram_id)
+        logger.info(f"Deleted stored data for user {telegram_id}")
+    
+    def _refresh_user_token(self, telegram_id: str) -> Optional[str]:
+        """Refresh an expired access token and invalidate the cached profile"""
+        session = Session()
+        try:
+            user = session.query(User).filter_by(telegram_id=telegram_id).first()
+            if not user or not user.refresh_token:
+                return None
+            
+            # Another worker may have refreshed it already
+            if user.expires_at and datetime.utcnow() <= user.expires_at:
+                return user.access_token
+            
             logger.info(f"Refreshing token for user {telegram_id}")
             result = self.auth.refresh_token(user.refresh_token)
             
@@ -31,53 +164,93 @@ class EmailService:
                 user.expires_at = datetime.utcnow() + timedelta(seconds=result.get('expires_in', 3600))
                 session.commit()
                 logger.info(f"Token refreshed for user {telegram_id}")
-            else:
-                logger.error(f"Token refresh failed for user {telegram_id}")
-                return None
-        
-        return user.access_token
+                return result['access_token']
+            
+            logger.error(f"Token refresh failed for user {telegram_id}")
+            return None
+        finally:
+            session.close()
+            user_cache.invalidate(telegram_id)
+    
+    def get_emails(self, telegram_id: str, limit: int = 10, folder_id: str = 'inbox') -> List[Dict[str, Any]]:
+        """Fetch emails from an Outlook folder (inbox by default)"""
+        emails, _ = self.get_email_page(telegram_id, limit, folder_id)
+        return emails
     
-    def get_emails(self, telegram_id: str, limit: int = 10) -> List[Dict[str, Any]]:
-        """Fetch emails from Outlook"""
+    def get_email_page(self, telegram_id: str, page_size: int = 10, folder_id: str = 'inbox',
+                       next_link: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Fetch and store one page of a folder, newest first; pass next_link to continue"""
         access_token = self.get_valid_token(telegram_id)
         if not access_token:
             logger.error(f"No valid token for user {telegram_id}")
-            return []
-        
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Prefer': 'outlook.body-content-type="text"'
-        }
+            return [], None
         
         try:
-            # Get emails
-            params = {
-                '$top': limit,
-                '$orderby': 'receivedDateTime desc',
-                '$select': 'id,subject,sender,toRecipients,bodyPreview,receivedDateTime,hasAttachments,isRead'
-            }
-            
-            response = requests.get(
-                'https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages',
-                headers=headers,
-                params=params,
-                timeout=30
-            )
-            
-            response.raise_for_status()
+            if next_link:
+                # nextLink already carries $top/$orderby/$select
+                response = self._graph_get(access_token, next_link)
+            else:
+                params = {
+                    '$top': page_size,
+                    '$orderby': 'receivedDateTime desc',
+                    '$select': MESSAGE_SELECT
+                }
+                response = self._graph_get(
+                    access_token,
+                    f'{GRAPH_URL}/me/mailFolders/{folder_id}/messages',
+                    params=params
+                )
             
-            emails = response.json().get('value', [])
+            data = response.json()
+            emails = data.get('value', [])
             
             # Store emails in database
-            for email in emails:
-                self.store_email(telegram_id, email)
+            self.store_emails_bulk(telegram_id, emails)
             
-            logger.info(f"Fetched {len(emails)} emails for user {telegram_id}")
-            return self._format_emails(emails)
+            formatted = self._format_emails(emails)
+            local_ids = self._local_ids(telegram_id, [email['id'] for email in emails])
+            for email, item in zip(emails, formatted):
+                item['email_id'] = local_ids.get(email['id'])
             
+            FETCHED_LOG.add(telegram_id, len(emails))
+            self.last_synced.set(telegram_id, datetime.utcnow())
+            return formatted, data.get('@odata.nextLink')
+            
+        except CircuitOpenError:
+            # Callers switch to degraded mode instead of reporting an empty inbox
+            raise
         except requests.exceptions.RequestException as e:
             logger.error(f"Error fetching emails for user {telegram_id}: {e}")
-            return []
+            return [], None
+    
+    def _graph_get(self, access_token: str, url: str, params: Optional[Dict[str, Any]] = None,
+                   headers: Optional[Dict[str, str]] = None, timeout: int = 30) -> requests.Response:
+        """Perform an authenticated GET against Microsoft Graph"""
+        request_headers = {'Authorization': f'Bearer {access_token}'}
+        if headers:
+            request_headers.update(headers)
+        
+        def send():
+            response = requests.get(url, headers=request_headers, params=params, timeout=timeout)
+            response.raise_for_status()
+            return response
+        
+        # Fails fast with CircuitOpenError while Graph is known to be down
+        return GRAPH_BREAKER.call(timed_graph_call, 'GET', url, send)
+    
+    def _graph_post(self, access_token: str, url: str, json: Dict[str, Any],
+                    headers: Optional[Dict[str, str]] = None, timeout: int = 30) -> requests.Response:
+        """Perform an authenticated JSON POST against Microsoft Graph"""
+        request_headers = {'Authorization': f'Bearer {access_token}'}
+        if headers:
+            request_headers.update(headers)
+        
+        def send():
+            response = requests.post(url, headers=request_headers, json=json, timeout=timeout)
+            response.raise_for_status()
+            return response
+        
+        return GRAPH_BREAKER.call(timed_graph_call, 'POST', url, send)
     
     def _format_emails(self, emails: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """Format emails for Telegram display"""
@@ -91,6 +264,7 @@ class EmailService:
             is_read = email.get('isRead', False)
             
             formatted.append({
+                'outlook_id': email['id'],
                 'sender': sender,
                 'subject': subject,
                 'preview': preview,
@@ -106,43 +280,147 @@ class EmailService:
         session = Session()
         
         try:
-            # Check if email already exists
-            existing = session.query(Email).filter_by(outlook_id=email_data['id']).first()
-            if existing:
-                return
-            
-            # Parse received date
-            received_str = email_data['receivedDateTime'].replace('Z', '+00:00')
-            received_date = datetime.fromisoformat(received_str)
-            
-            # Create email record
-            email = Email(
-                telegram_id=telegram_id,
-                outlook_id=email_data['id'],
-                sender=email_data['sender']['emailAddress']['address'],
-                recipient=telegram_id,
-                subject=email_data.get('subject', 'No Subject'),
-                body=email_data.get('bodyPreview', ''),
-                received_at=received_date,
-                has_attachments=email_data.get('hasAttachments', False),
-                is_read=email_data.get('isRead', False)
-            )
-            
-            session.add(email)
-            session.commit()
-            logger.info(f"Stored email {email_data['id']} for user {telegram_id}")
+            with ingest_lock(session, telegram_id):
+                # Check if email already exists, here or in the archive
+                if self._known_outlook_ids(session, [email_data]):
+                    return
+                
+                address, name = sender_of(email_data)
+                sender_ids = self.senders.ids_for(session, {address: name})
+                email = self._build_email(telegram_id, email_data, sender_ids)
+                session.add(email)
+                record_ingest(session, telegram_id, [email])
+                record_threads(session, telegram_id, [email], self.senders.interned_addresses(sender_ids))
+                session.commit()
+            STORED_LOG.add(telegram_id)
             
         except Exception as e:
             session.rollback()
             logger.error(f"Error storing email for user {telegram_id}: {e}")
+        finally:
+            session.close()
     
-    def get_stored_emails(self, telegram_id: str, limit: int = 20) -> List[Email]:
-        """Retrieve stored emails from database"""
+    def store_emails_bulk(self, telegram_id: str, emails: List[Dict[str, Any]]) -> Optional[int]:
+        """Store a batch of emails with one existence check and one commit
+        
+        Returns the number of new emails, or None if the batch could not be stored.
+        """
+        if not emails:
+            return 0
+        
+        for attempt in range(STORE_CONFLICT_RETRIES):
+            session = Session()
+            try:
+                # Partitioned tables cannot enforce a unique outlook_id, so the check-then-insert is locked
+                with ingest_lock(session, telegram_id):
+                    existing = self._known_outlook_ids(session, emails)
+                    
+                    fresh = []
+                    for email_data in emails:
+                        if email_data['id'] in existing:
+                            continue
+                        existing.add(email_data['id'])
+                        fresh.append(email_data)
+                    
+                    sender_ids = self.senders.ids_for(session, dict(sender_of(email_data) for email_data in fresh))
+                    new_emails = [self._build_email(telegram_id, email_data, sender_ids) for email_data in fresh]
+                    
+                    session.add_all(new_emails)
+                    record_ingest(session, telegram_id, new_emails)
+                    record_threads(session, telegram_id, new_emails, self.senders.interned_addresses(sender_ids))
+                    session.commit()
+                STORED_LOG.add(telegram_id, len(new_emails))
+                return len(new_emails)
+                
+            except IntegrityError as e:
+                # Someone else stored part of this batch first; the next pass skips those rows
+                session.rollback()
+                logger.warning(f"Conflict bulk storing emails for user {telegram_id}, retrying: {e.orig}")
+            except Exception as e:
+                session.rollback()
+                logger.error(f"Error bulk storing emails for user {telegram_id}: {e}")
+                return None
+            finally:
+                session.close()
+        
+        logger.error(f"Gave up bulk storing emails for user {telegram_id} after {STORE_CONFLICT_RETRIES} conflicts")
+        return None
+    
+    def _known_outlook_ids(self, session, emails: List[Dict[str, Any]]) -> Set[str]:
+        """ids of Graph messages already stored, or archived or dropped by retention and not to be stored again"""
+        outlook_ids = [email_data['id'] for email_data in emails]
+        known = {
+            row.outlook_id for row in
+            session.query(Email.outlook_id).filter(Email.outlook_id.in_(outlook_ids))
+        }
+        known.update(
+            row.outlook_id for row in
+            session.query(ArchivedEmail.outlook_id).filter(ArchivedEmail.outlook_id.in_(outlook_ids))
+        )
+        
+        # Whole months dropped with their partitions leave no per-email tombstones
+        cutoff = partition_cutoff(session)
+        if cutoff is not None:
+            known.update(
+                email_data['id'] for email_data in emails
+                if self._parse_received(email_data['receivedDateTime']) < cutoff
+            )
+        return known
+    
+    def _local_ids(self, telegram_id: str, outlook_ids: List[str]) -> Dict[str, int]:
+        """Map outlook_ids to local Email ids (used for compact callback data)"""
+        if not outlook_ids:
+            return {}
+        
+        session = Session()
+        try:
+            rows = session.query(Email.outlook_id, Email.id)\
+                .filter(Email.telegram_id == telegram_id, Email.outlook_id.in_(outlook_ids))
+            return {row.outlook_id: row.id for row in rows}
+        finally:
+            session.close()
+    
+    def _build_email(self, telegram_id: str, email_data: Dict[str, Any], sender_ids: Dict[str, int]) -> Email:
+        """Map a Graph message resource onto an Email record"""
+        received_date = self._parse_received(email_data['receivedDateTime'])
+        address, _ = sender_of(email_data)
+        sender_id = sender_ids.get(address)
+        
+        return Email(
+            telegram_id=telegram_id,
+            outlook_id=email_data['id'],
+            # Only keep the inline address when it could not be interned (empty)
+            sender=None if sender_id else address,
+            sender_id=sender_id,
+            recipient=telegram_id,
+            subject=email_data.get('subject') or 'No Subject',
+            body_z=compress_body(email_data.get('bodyPreview', '')),
+            received_at=received_date,
+            has_attachments=email_data.get('hasAttachments', False),
+            is_read=email_data.get('isRead', False),
+            folder_id=email_data.get('parentFolderId'),
+            conversation_id=email_data.get('conversationId')
+        )
+    
+    @staticmethod
+    def _parse_received(value: str) -> datetime:
+        """Parse Graph's receivedDateTime into a naive UTC datetime"""
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    
+    def get_stored_emails(self, telegram_id: str, limit: int = 20, folder_id: Optional[str] = None,
+                          sender_id: Optional[int] = None, conversation_id: Optional[str] = None) -> List[EmailSummary]:
+        """Retrieve stored emails from database, optionally from a single folder, sender or conversation"""
         session = Session()
         try:
-            emails = session.query(Email).filter_by(telegram_id=telegram_id)\
-                .order_by(Email.received_at.desc())\
-                .limit(limit).all()
+            query = session.query(*SUMMARY_COLUMNS).filter(Email.telegram_id == telegram_id)
+            if folder_id:
+                query = query.filter(Email.folder_id == folder_id)
+            if sender_id:
+                query = query.filter(Email.sender_id == sender_id)
+            if conversation_id:
+                query = query.filter(Email.conversation_id == conversation_id)
+            
+            emails = [EmailSummary(*row) for row in query.order_by(Email.received_at.desc()).limit(limit)]
             
             logger.info(f"Retrieved {len(emails)} stored emails for user {telegram_id}")
             return emails
@@ -150,19 +428,355 @@ class EmailService:
         except Exception as e:
             logger.error(f"Error retrieving stored emails for user {telegram_id}: {e}")
             return []
+        finally:
+            session.close()
+    
+    def search_emails(self, telegram_id: str, query: str, limit: int = 10, offset: int = 0,
+                      folder_id: Optional[str] = None, include_archive: bool = False) -> List[EmailSummary]:
+        """Search emails by subject or sender, falling back to Graph when local results are thin"""
+        normalized = self._normalize_query(query)
+        if not normalized:
+            # Would match everything locally and send Graph an empty $search
+            return []
+        
+        key = (telegram_id, normalized, folder_id, include_archive)
+        results = self.search_cache.get(key)
+        
+        if results is None:
+            results = self._search_local(telegram_id, query, SEARCH_MAX_RESULTS, folder_id)
+            degraded = False
+            
+            # Only the first page decides whether the server is consulted; later
+            # pages are always served from the cached merged list.
+            if len(results) < limit:
+                server_results = self._search_server(telegram_id, query, folder_id)
+                degraded = server_results is None
+                results = self._merge_results(results, server_results or [])
+            
+            if include_archive:
+                results = self._merge_results(self._search_archive(telegram_id, query, folder_id), results)
+            
+            # Local-only results stand in while Graph is unreachable; the next search retries it
+            if not degraded:
+                self.search_cache.set(key, results)
+        
+        page = results[offset:offset + limit]
+        logger.info(f"Found {len(results)} emails matching '{query}' for user {telegram_id}")
+        return page
     
-    def search_emails(self, telegram_id: str, query: str, limit: int = 10) -> List[Email]:
-        """Search emails by subject or sender"""
+    def count_search_results(self, telegram_id: str, query: str, folder_id: Optional[str] = None,
+                             include_archive: bool = False) -> int:
+        """Number of cached results for a query (0 if not searched yet)"""
+        results = self.search_cache.get((telegram_id, self._normalize_query(query), folder_id, include_archive))
+        return len(results) if results else 0
+    
+    @staticmethod
+    def _normalize_query(query: str) -> str:
+        return ' '.join(query.lower().split())
+    
+    def _search_local(self, telegram_id: str, query: str, limit: int,
+                      folder_id: Optional[str] = None) -> List[EmailSummary]:
+        """Search the local emails table"""
         session = Session()
         try:
-            emails = session.query(Email).filter_by(telegram_id=telegram_id)\
-                .filter((Email.subject.ilike(f'%{query}%')) | (Email.sender.ilike(f'%{query}%')))\
-                .order_by(Email.received_at.desc())\
-                .limit(limit).all()
+            # Match addresses once in the (small) senders table, then filter emails by id
+            matching_senders = session.query(Sender.id).filter(Sender.address.ilike(f'%{query}%'))
+            emails = session.query(*SUMMARY_COLUMNS).filter(Email.telegram_id == telegram_id)\
+                .filter(
+                    Email.subject.ilike(f'%{query}%')
+                    | Email.sender_id.in_(matching_senders.scalar_subquery())
+                    | Email.sender.ilike(f'%{query}%')
+                )
+            if folder_id:
+                emails = emails.filter(Email.folder_id == folder_id)
             
-            logger.info(f"Found {len(emails)} emails matching '{query}' for user {telegram_id}")
-            return emails
+            return [EmailSummary(*row) for row in emails.order_by(Email.received_at.desc()).limit(limit)]
             
         except Exception as e:
             logger.error(f"Error searching emails for user {telegram_id}: {e}")
             return []
+        finally:
+            session.close()
+    
+    def _search_server(self, telegram_id: str, query: str,
+                       folder_id: Optional[str] = None) -> Optional[List[EmailSummary]]:
+        """Run Graph $search (all folders unless one is given) and write hits back through the ingest path
+        
+        Returns None when Graph could not be asked (no token, request failed, circuit open).
+        """
+        access_token = self.get_valid_token(telegram_id)
+        if not access_token:
+            return None
+        
+        params = {
+            '$search': '"{}"'.format(query.replace('"', '')),
+            '$top': SEARCH_MAX_RESULTS,
+            '$select': MESSAGE_SELECT
+        }
+        url = f'{GRAPH_URL}/me/mailFolders/{folder_id}/messages' if folder_id else f'{GRAPH_URL}/me/messages'
+        
+        try:
+            response = self._graph_get(access_token, url, params=params)
+            messages = response.json().get('value', [])
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error searching Graph for user {telegram_id}: {e}")
+            return None
+        
+        self.store_emails_bulk(telegram_id, messages)
+        
+        logger.info(f"Graph search returned {len(messages)} emails for user {telegram_id}")
+        local_ids = self._local_ids(telegram_id, [message['id'] for message in messages])
+        return [self._summarize(message, local_ids.get(message['id'])) for message in messages]
+    
+    def _summarize(self, email_data: Dict[str, Any], email_id: Optional[int]) -> EmailSummary:
+        """Build a list-view record straight from a Graph message"""
+        return EmailSummary(
+            id=email_id,
+            outlook_id=email_data['id'],
+            sender=sender_of(email_data)[0],
+            subject=email_data.get('subject') or 'No Subject',
+            received_at=self._parse_received(email_data['receivedDateTime']),
+            is_read=email_data.get('isRead', False),
+            has_attachments=email_data.get('hasAttachments', False),
+            folder_id=email_data.get('parentFolderId')
+        )
+    
+    def _search_archive(self, telegram_id: str, query: str, folder_id: Optional[str] = None) -> List[EmailSummary]:
+        """Scan archived segments; hits have no local id since they left the emails table"""
+        try:
+            records = self.archive.search(telegram_id, query.strip(), SEARCH_MAX_RESULTS)
+        except OSError as e:
+            logger.error(f"Error searching archive for user {telegram_id}: {e}")
+            return []
+        
+        return [
+            EmailSummary(
+                id=None,
+                outlook_id=record['outlook_id'],
+                sender=record['sender'],
+                subject=record['subject'],
+                received_at=datetime.fromisoformat(record['received_at']),
+                is_read=record['is_read'],
+                has_attachments=record['has_attachments'],
+                folder_id=record['folder_id']
+            )
+            for record in records
+            if not folder_id or record['folder_id'] == folder_id
+        ]
+    
+    @staticmethod
+    def _merge_results(local: List[EmailSummary], server: List[EmailSummary]) -> List[EmailSummary]:
+        """Merge local and server hits, deduplicated by outlook_id, newest first"""
+        merged = {email.outlook_id: email for email in server}
+        merged.update({email.outlook_id: email for email in local})
+        
+        results = sorted(merged.values(), key=lambda e: e.received_at, reverse=True)
+        return results[:SEARCH_MAX_RESULTS]
+    
+    def get_folders(self, telegram_id: str, refresh: bool = False) -> List[Dict[str, Any]]:
+        """Return the user's flattened mail folder tree, cached per user"""
+        if not refresh:
+            folders = self.folder_cache.get(telegram_id)
+            if folders is not None:
+                return folders
+        
+        access_token = self.get_valid_token(telegram_id)
+        if not access_token:
+            return []
+        
+        try:
+            folders = self._list_folders(access_token, f'{GRAPH_URL}/me/mailFolders', '')
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error listing folders for user {telegram_id}: {e}")
+            return []
+        
+        self.folder_cache.set(telegram_id, folders)
+        logger.info(f"Cached {len(folders)} folders for user {telegram_id}")
+        return folders
+    
+    def _list_folders(self, access_token: str, url: str, parent_path: str) -> List[Dict[str, Any]]:
+        """Walk a folder level and its children depth-first"""
+        params = {'$top': 100, '$select': 'id,displayName,parentFolderId,childFolderCount,totalItemCount,unreadItemCount'}
+        folders = []
+        
+        while url:
+            data = self._graph_get(access_token, url, params=params).json()
+            for folder in data.get('value', []):
+                path = f"{parent_path}/{folder['displayName']}" if parent_path else folder['displayName']
+                folders.append({
+                    'id': folder['id'],
+                    'name': folder['displayName'],
+                    'path': path,
+                    'total': folder.get('totalItemCount', 0),
+                    'unread': folder.get('unreadItemCount', 0)
+                })
+                if folder.get('childFolderCount'):
+                    folders.extend(self._list_folders(
+                        access_token, f"{GRAPH_URL}/me/mailFolders/{folder['id']}/childFolders", path
+                    ))
+            url = data.get('@odata.nextLink')
+            params = None
+        
+        return folders
+    
+    def find_folder(self, telegram_id: str, name: str) -> Optional[Dict[str, Any]]:
+        """Resolve a folder by path or display name (case-insensitive)"""
+        name = name.strip('/').lower()
+        folders = self.get_folders(telegram_id)
+        
+        for key in ('path', 'name'):
+            for folder in folders:
+                if folder[key].lower() == name:
+                    return folder
+        return None
+    
+    def sync_folders(self, telegram_id: str) -> int:
+        """Fetch mail newer than each folder's sync cursor, across all folders"""
+        folders = self.get_folders(telegram_id)
+        if not folders:
+            return 0
+        
+        session = Session()
+        try:
+            cursors = {
+                state.folder_id: state for state in
+                session.query(FolderSyncState).filter_by(telegram_id=telegram_id)
+            }
+            
+            total = 0
+            for folder in folders:
+                state = cursors.get(folder['id'])
+                if state is None:
+                    state = FolderSyncState(telegram_id=telegram_id, folder_id=folder['id'])
+                    session.add(state)
+                
+                for messages in self._folder_pages_since(telegram_id, folder['id'], state.last_received_at):
+                    stored = self.store_emails_bulk(telegram_id, messages)
+                    if stored is None:
+                        # Leave the cursor before this page so the next sync retries it
+                        break
+                    total += stored
+                    state.last_received_at = max(
+                        [self._parse_received(m['receivedDateTime']) for m in messages]
+                        + ([state.last_received_at] if state.last_received_at else [])
+                    )
+                    session.commit()
+            
+            session.commit()
+            if not GRAPH_BREAKER.is_open:
+                self.last_synced.set(telegram_id, datetime.utcnow())
+            logger.info(f"Synced {total} new emails across {len(folders)} folders for user {telegram_id}")
+            return total
+            
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error syncing folders for user {telegram_id}: {e}")
+            return 0
+        finally:
+            session.close()
+    
+    def _folder_pages_since(self, telegram_id: str, folder_id: str,
+                            since: Optional[datetime]) -> Iterator[List[Dict[str, Any]]]:
+        """Yield pages of a folder's messages received since the cursor, oldest first
+        
+        Without a cursor only the newest page is fetched; older mail is the backfill's job.
+        """
+        access_token = self.get_valid_token(telegram_id)
+        if not access_token:
+            return
+        
+        url = f'{GRAPH_URL}/me/mailFolders/{folder_id}/messages'
+        params = {'$top': FOLDER_SYNC_PAGE_SIZE, '$select': MESSAGE_SELECT}
+        if since:
+            # ge, not gt: a page can end mid-second, and already stored messages are skipped anyway
+            params['$filter'] = f"receivedDateTime ge {since.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+            params['$orderby'] = 'receivedDateTime asc'
+        else:
+            params['$orderby'] = 'receivedDateTime desc'
+        
+        for _ in range(FOLDER_SYNC_MAX_PAGES if since else 1):
+            try:
+                data = self._graph_get(access_token, url, params=params).json()
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Error syncing folder {folder_id} for user {telegram_id}: {e}")
+                return
+            
+            messages = data.get('value', [])
+            if messages:
+                yield messages
+            
+            # The nextLink already carries the query string
+            url, params = data.get('@odata.nextLink'), None
+            if not url:
+                return
+    
+    def get_full_body(self, telegram_id: str, email_id: int) -> Optional[str]:
+        """Fetch a message's full body on demand, caching the rendered result"""
+        session = Session()
+        try:
+            email = session.query(Email.outlook_id, Email.subject, email_sender, Email.received_at, Email.body_z)\
+                .filter_by(id=email_id, telegram_id=telegram_id).first()
+        finally:
+            session.close()
+        
+        if not email:
+            return None
+        
+        rendered = self.body_cache.get(email.outlook_id)
+        if rendered is not None:
+            return rendered
+        
+        kind, content = decompress_body(email.body_z)
+        if kind == BODY_KIND_PREVIEW:
+            body = self._fetch_body(telegram_id, email.outlook_id)
+            if body is None:
+                return None
+            content_type = body.get('contentType', 'text')
+            content = body.get('content', '')
+            self._store_full_body(email_id, content, content_type)
+        else:
+            content_type = 'html' if kind == BODY_KIND_HTML else 'text'
+        
+        # Large (usually HTML) bodies are converted in the render process pool
+        text = self.render_pool.render(content, content_type)
+        rendered = (
+            f"📄 *{escape_markdown(email.subject or '')}*\n"
+            f"👤 From: {escape_markdown(email.sender or '')}\n"
+            f"🕒 {email.received_at.strftime('%Y-%m-%d %H:%M')}\n\n"
+            f"{text}"
+        )
+        self.body_cache.set(email.outlook_id, rendered)
+        return rendered
+    
+    def _fetch_body(self, telegram_id: str, outlook_id: str) -> Optional[Dict[str, Any]]:
+        access_token = self.get_valid_token(telegram_id)
+        if not access_token:
+            return None
+        
+        try:
+            response = self._graph_get(
+                access_token,
+                f'{GRAPH_URL}/me/messages/{outlook_id}',
+                # No text Prefer header: HTML bodies come back as HTML for the render pool to convert
+                params={'$select': 'body'}
+            )
+            return response.json().get('body', {})
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error fetching body of email {outlook_id} for user {telegram_id}: {e}")
+            return None
+    
+    def _store_full_body(self, email_id: int, content: str, content_type: str):
+        """Keep the fetched body compressed so it is never downloaded twice"""
+        kind = BODY_KIND_HTML if content_type.lower() == 'html' else BODY_KIND_TEXT
+        session = Session()
+        try:
+            session.query(Email).filter_by(id=email_id).update(
+                {Email.body_z: compress_body(content, kind), Email.body: None},
+                synchronize_session=False
+            )
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error storing full body of email {email_id}: {e}")
+        finally:
+            session.close()
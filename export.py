@@ -0,0 +1,120 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+import logging
+import sys
+import tempfile
+from datetime import datetime
+from typing import IO, Iterator, Tuple
+
+from database import Session, Email, email_sender, decompress_body, init_db
+from logging_setup import setup_logging
+from tracing import setup_tracing
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('jsonl', 'csv')
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_COLUMNS = (
+    Email.outlook_id,
+    email_sender,
+    Email.recipient,
+    Email.subject,
+    Email.body_z,
+    Email.received_at,
+    Email.is_read,
+    Email.has_attachments,
+)
+EXPORT_FIELDS = ['body' if column.key == 'body_z' else column.key for column in EXPORT_COLUMNS]
+_BODY_INDEX = EXPORT_FIELDS.index('body')
+
+
+def iter_email_rows(telegram_id: str) -> Iterator[Tuple]:
+    """Stream a user's emails as plain tuples using a server-side cursor"""
+    session = Session()
+    try:
+        query = session.query(*EXPORT_COLUMNS, Email.body)\
+            .filter(Email.telegram_id == telegram_id)\
+            .order_by(Email.received_at)\
+            .yield_per(EXPORT_BATCH_SIZE)
+
+        for row in query:
+            # Decompress one row at a time; legacy rows still carry plain body
+            values = list(row[:-1])
+            values[_BODY_INDEX] = decompress_body(row.body_z)[1] if row.body_z else (row.body or '')
+            yield tuple(values)
+    finally:
+        session.close()
+
+
+def _serialize(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def export_emails(telegram_id: str, fileobj: IO[bytes], fmt: str = 'jsonl') -> int:
+    """Write a user's emails to fileobj as gzip-compressed JSONL or CSV"""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+
+    count = 0
+    with gzip.GzipFile(fileobj=fileobj, mode='wb') as gz:
+        text = io.TextIOWrapper(gz, encoding='utf-8', newline='')
+
+        if fmt == 'csv':
+            writer = csv.writer(text)
+            writer.writerow(EXPORT_FIELDS)
+
+        for row in iter_email_rows(telegram_id):
+            values = [_serialize(value) for value in row]
+            if fmt == 'csv':
+                writer.writerow(values)
+            else:
+                text.write(json.dumps(dict(zip(EXPORT_FIELDS, values)), ensure_ascii=False))
+                text.write('\n')
+            count += 1
+
+        text.flush()
+        text.detach()
+
+    logger.info(f"Exported {count} emails for user {telegram_id} as {fmt}")
+    return count
+
+
+def export_to_tempfile(telegram_id: str, fmt: str = 'jsonl') -> Tuple[IO[bytes], int]:
+    """Export into a temporary file on disk, rewound and ready to upload"""
+    tmp = tempfile.TemporaryFile()
+    try:
+        count = export_emails(telegram_id, tmp, fmt)
+    except Exception:
+        tmp.close()
+        raise
+    tmp.seek(0)
+    return tmp, count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a user's stored emails")
+    parser.add_argument('telegram_id', help='Telegram user id whose emails to export')
+    parser.add_argument('--format', choices=EXPORT_FORMATS, default='jsonl')
+    parser.add_argument('--output', '-o', help='Output file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    if args.output:
+        with open(args.output, 'wb') as fileobj:
+            count = export_emails(args.telegram_id, fileobj, args.format)
+    else:
+        count = export_emails(args.telegram_id, sys.stdout.buffer, args.format)
+
+    print(f"✅ Exported {count} emails", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    setup_logging()
+    setup_tracing()
+    init_db()
+    main()
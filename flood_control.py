@@ -0,0 +1,117 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Per-user command budget: bursts of BUCKET_CAPACITY, then one every 1/BUCKET_REFILL_RATE seconds
+BUCKET_CAPACITY = 5
+BUCKET_REFILL_RATE = 0.5
+MAX_TRACKED_USERS = 10000
+# Identical calls within this many seconds of a finished one reuse its result
+FLIGHT_REUSE_TTL = 5
+MAX_RECENT_FLIGHTS = 1024
+
+_MISSING = object()
+
+
+class SingleFlight:
+    """Coalesce calls with the same key into one execution
+
+    Concurrent callers wait for the call in flight. Callers arriving shortly
+    after it succeeded reuse its result: updates from one chat run one after
+    another, so repeated taps there never overlap the first call.
+    """
+
+    def __init__(self, reuse_ttl: float = FLIGHT_REUSE_TTL):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._recent = LRUCache(maxsize=MAX_RECENT_FLIGHTS, ttl=reuse_ttl)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """Run func for key, or share the identical call running or just finished"""
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        recent = self._recent.get(key, _MISSING)
+        if recent is not _MISSING:
+            return recent
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await func()
+            future.set_result(result)
+            self._recent.set(key, result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved so a failure nobody else waited on is not logged
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+
+class TokenBucket:
+    def __init__(self, capacity: float = BUCKET_CAPACITY, refill_rate: float = BUCKET_REFILL_RATE):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def consume(self, tokens: float = 1) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+class FloodControl:
+    """Per-user token buckets; excess commands are dropped without a reply"""
+
+    def __init__(self, capacity: float = BUCKET_CAPACITY, refill_rate: float = BUCKET_REFILL_RATE):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._buckets = LRUCache(maxsize=MAX_TRACKED_USERS)
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def allow(self, telegram_id: str) -> bool:
+        with self._lock:
+            bucket = self._buckets.get(telegram_id)
+            if bucket is None:
+                bucket = TokenBucket(self.capacity, self.refill_rate)
+                self._buckets.set(telegram_id, bucket)
+
+            if bucket.consume():
+                return True
+
+            self.dropped += 1
+            return False
+
+    def limit(self, handler: Callable) -> Callable:
+        """Wrap a telegram handler so flooding users are silently ignored"""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            user = update.effective_user
+            if user and not self.allow(str(user.id)):
+                logger.warning(f"Dropping update from user {user.id}: rate limit exceeded")
+                if update.callback_query:
+                    await update.callback_query.answer()
+                return
+            return await handler(update, context)
+
+        return wrapper
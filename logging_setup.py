@@ -0,0 +1,217 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 'json' for one object per line, 'text' for the classic human-readable format
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+# Per-logger budget for records below ERROR: sustained rate per second, and burst
+LOG_RATE_LIMIT = float(os.getenv('LOG_RATE_LIMIT', 50))
+LOG_RATE_BURST = float(os.getenv('LOG_RATE_BURST', 200))
+# "logger=rate,..." keeps that fraction of a logger's INFO and DEBUG records
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')
+# How often aggregated counters and suppression counts are written out
+LOG_AGGREGATE_INTERVAL = float(os.getenv('LOG_AGGREGATE_INTERVAL', 60))
+
+TEXT_FORMAT = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+logger = logging.getLogger(__name__)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, including fields passed via extra="""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and key not in entry:
+                entry[key] = value
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Merges args and renders tracebacks up front, leaving formatting to the listener"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _parse_sample_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, rate = item.partition('=')
+        try:
+            rates[name.strip()] = float(rate)
+        except ValueError:
+            logger.warning(f"Ignoring bad LOG_SAMPLE_RATES entry {item!r}")
+    return rates
+
+
+class VolumeFilter(logging.Filter):
+    """Samples and rate-limits chatty loggers before records reach the queue
+
+    Errors and aggregator summaries always pass. A record can ask for its own sampling with
+    extra={'sample_rate': 0.01}.
+    """
+
+    def __init__(self, rate: float = LOG_RATE_LIMIT, burst: float = LOG_RATE_BURST,
+                 sample_rates: Optional[Dict[str, float]] = None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_rates = sample_rates or {}
+        # logger name -> [tokens, last refill]
+        self._buckets: Dict[str, List[float]] = {}
+        self.suppressed: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR or getattr(record, 'aggregated', False):
+            return True
+
+        sample_rate = getattr(record, 'sample_rate', None)
+        if sample_rate is None and record.levelno <= logging.INFO:
+            sample_rate = self.sample_rates.get(record.name)
+        if sample_rate is not None and random.random() >= sample_rate:
+            return False
+
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(record.name)
+            if bucket is None:
+                bucket = self._buckets[record.name] = [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                self.suppressed[record.name] += 1
+                return False
+            bucket[0] -= 1
+        return True
+
+    def take_suppressed(self) -> Counter:
+        with self._lock:
+            suppressed, self.suppressed = self.suppressed, Counter()
+        return suppressed
+
+
+class LogAggregator:
+    """Counts a repetitive event and logs one summary per interval instead of a line per item
+
+    The message is formatted with total (events) and keys (distinct keys, e.g. users).
+    """
+
+    def __init__(self, target: logging.Logger, message: str, interval: float = LOG_AGGREGATE_INTERVAL):
+        self.target = target
+        self.message = message
+        self.interval = interval
+        self._counts: Counter = Counter()
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        _aggregators.append(self)
+
+    def add(self, key: str = '', count: int = 1):
+        with self._lock:
+            self._counts[key] += count
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if time.monotonic() - self._started >= self.interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            elapsed = time.monotonic() - self._started
+            self._started = time.monotonic()
+        if counts:
+            total = sum(counts.values())
+            self.target.info(
+                self.message.format(total=total, keys=len(counts)) + f" in the last {elapsed:.0f}s",
+                extra={'aggregated': True, 'count': total}
+            )
+
+
+_aggregators: List[LogAggregator] = []
+_listener: Optional[logging.handlers.QueueListener] = None
+_volume_filter: Optional[VolumeFilter] = None
+_stopped = threading.Event()
+
+
+def setup_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT):
+    """Route all logging through a queue so callers never block on output
+
+    Replaces any handlers already on the root logger. Safe to call twice.
+    """
+    global _listener, _volume_filter
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    records: queue.Queue = queue.Queue(-1)
+    _volume_filter = VolumeFilter(sample_rates=_parse_sample_rates(LOG_SAMPLE_RATES))
+    handler = _QueueHandler(records)
+    handler.addFilter(_volume_filter)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    threading.Thread(target=_flush_loop, name='log-aggregator', daemon=True).start()
+    atexit.register(_shutdown)
+
+
+def _flush_periodic():
+    for aggregator in list(_aggregators):
+        aggregator.flush_if_due()
+    if _volume_filter is not None:
+        for name, count in _volume_filter.take_suppressed().items():
+            logger.warning(f"Suppressed {count} log records from {name} (over {LOG_RATE_LIMIT:.0f}/s)",
+                           extra={'suppressed_logger': name, 'count': count})
+
+
+def _flush_loop():
+    while not _stopped.wait(min(5.0, LOG_AGGREGATE_INTERVAL)):
+        _flush_periodic()
+
+
+def _shutdown():
+    _stopped.set()
+    for aggregator in list(_aggregators):
+        aggregator.flush()
+    if _listener is not None:
+        # Drains whatever is still queued
+        _listener.stop()
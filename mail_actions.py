@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import os
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Set, Tuple
+
+import requests
+
+from database import Session, Email
+from email_service import EmailService, GRAPH_URL
+from stats import record_read_changes
+from threads import record_thread_reads
+
+logger = logging.getLogger(__name__)
+
+# Actions arriving within this window of the first one share a Graph round trip
+ACTION_FLUSH_WINDOW = float(os.getenv('ACTION_FLUSH_WINDOW', 1.5))
+# Graph accepts at most 20 requests per $batch
+GRAPH_BATCH_LIMIT = 20
+
+ACTION_READ = 'read'
+ACTION_ARCHIVE = 'archive'
+ACTION_FLAG = 'flag'
+ACTIONS = (ACTION_READ, ACTION_ARCHIVE, ACTION_FLAG)
+
+ACTION_LABELS = {
+    ACTION_READ: '✅ {} marked read',
+    ACTION_ARCHIVE: '🗄 {} archived',
+    ACTION_FLAG: '🚩 {} flagged',
+}
+
+
+class MailActionQueue:
+    """Coalesces per-user message actions and applies them with Graph $batch requests"""
+
+    def __init__(self, email_service: EmailService, window: float = ACTION_FLUSH_WINDOW):
+        self.email_service = email_service
+        self.window = window
+        # telegram_id -> email_id -> requested actions
+        self._pending: Dict[str, Dict[int, Set[str]]] = {}
+        self._notify: Dict[str, Callable[[str], Awaitable[Any]]] = {}
+        self._flushers: Dict[str, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        """Actions waiting for their batch"""
+        return sum(len(actions) for pending in self._pending.values() for actions in pending.values())
+
+    async def enqueue(self, telegram_id: str, email_id: int, action: str,
+                      notify: Callable[[str], Awaitable[Any]]):
+        """Queue an action; notify receives one summary per flushed batch"""
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown mail action: {action}")
+
+        if action == ACTION_READ:
+            # Optimistic: lists reflect the change before Graph confirms it
+            await asyncio.to_thread(self._set_read, telegram_id, [email_id], True)
+
+        self._pending.setdefault(telegram_id, {}).setdefault(email_id, set()).add(action)
+        self._notify[telegram_id] = notify
+        if telegram_id not in self._flushers:
+            self._flushers[telegram_id] = asyncio.create_task(self._flush_later(telegram_id))
+
+    async def _flush_later(self, telegram_id: str):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            # Anything queued from here on opens a new window
+            self._flushers.pop(telegram_id, None)
+
+        pending = self._pending.pop(telegram_id, {})
+        notify = self._notify.pop(telegram_id, None)
+        if not pending:
+            return
+
+        try:
+            summary = await asyncio.to_thread(self._apply, telegram_id, pending)
+        except Exception as e:
+            logger.error(f"Error applying mail actions for user {telegram_id}: {e}")
+            await asyncio.to_thread(self._revert_reads, telegram_id, pending)
+            summary = "❌ Could not update your mailbox. Please try again."
+
+        if notify:
+            try:
+                await notify(summary)
+            except Exception as e:
+                logger.error(f"Error reporting mail actions to user {telegram_id}: {e}")
+
+    def _apply(self, telegram_id: str, pending: Dict[int, Set[str]]) -> str:
+        outlook_ids = self._outlook_ids(telegram_id, list(pending))
+        access_token = self.email_service.get_valid_token(telegram_id)
+        if not access_token:
+            self._revert_reads(telegram_id, pending)
+            return "❌ Not connected. Use /connect to link your Outlook account."
+
+        # One PATCH per message carries both read and flag; the move runs after it
+        batches: List[List[Dict[str, Any]]] = [[]]
+        for email_id, actions in pending.items():
+            outlook_id = outlook_ids.get(email_id)
+            if not outlook_id:
+                continue
+
+            requests_for_email = []
+            patch = {}
+            if ACTION_READ in actions:
+                patch['isRead'] = True
+            if ACTION_FLAG in actions:
+                patch['flag'] = {'flagStatus': 'flagged'}
+            if patch:
+                requests_for_email.append({
+                    'id': f'{email_id}-patch',
+                    'method': 'PATCH',
+                    'url': f'/me/messages/{outlook_id}',
+                    'body': patch,
+                    'headers': {'Content-Type': 'application/json'},
+                })
+            if ACTION_ARCHIVE in actions:
+                move = {
+                    'id': f'{email_id}-move',
+                    'method': 'POST',
+                    'url': f'/me/messages/{outlook_id}/move',
+                    'body': {'destinationId': 'archive'},
+                    'headers': {'Content-Type': 'application/json'},
+                }
+                if patch:
+                    move['dependsOn'] = [f'{email_id}-patch']
+                requests_for_email.append(move)
+
+            # A message's requests must share a batch for dependsOn to apply
+            if len(batches[-1]) + len(requests_for_email) > GRAPH_BATCH_LIMIT:
+                batches.append([])
+            batches[-1].extend(requests_for_email)
+
+        responses = {}
+        for batch in batches:
+            if batch:
+                responses.update(self._send_batch(telegram_id, access_token, batch))
+
+        done = Counter()
+        failed_reads = []
+        failures = 0
+        forbidden = False
+        for email_id, actions in pending.items():
+            patch_status, _ = responses.get(f'{email_id}-patch', (None, None))
+            move_status, moved = responses.get(f'{email_id}-move', (None, None))
+
+            for action in actions:
+                status = move_status if action == ACTION_ARCHIVE else patch_status
+                if status is not None and status < 300:
+                    done[action] += 1
+                    continue
+                failures += 1
+                forbidden = forbidden or status == 403
+                if action == ACTION_READ:
+                    failed_reads.append(email_id)
+
+            if move_status is not None and move_status < 300 and moved:
+                self._record_move(telegram_id, email_id, moved)
+
+        if failed_reads:
+            self._set_read(telegram_id, failed_reads, False)
+
+        logger.info(
+            f"Applied {sum(done.values())} mail actions for user {telegram_id} "
+            f"in {len([b for b in batches if b])} batch requests ({failures} failed)"
+        )
+
+        parts = [ACTION_LABELS[action].format(count) for action, count in done.items()]
+        summary = ' · '.join(parts)
+        if failures:
+            summary += f"\n⚠️ {failures} action{'s' if failures != 1 else ''} failed"
+        if forbidden:
+            summary += "\n🔐 Use /connect again to allow the bot to change your mail"
+        return summary.strip()
+
+    def _send_batch(self, telegram_id: str, access_token: str,
+                    batch: List[Dict[str, Any]]) -> Dict[str, Tuple[int, Dict[str, Any]]]:
+        """POST one $batch; returns request id -> (status, body)"""
+        try:
+            response = self.email_service._graph_post(access_token, f'{GRAPH_URL}/$batch', {'requests': batch})
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Graph batch of {len(batch)} requests failed for user {telegram_id}: {e}")
+            return {}
+
+        return {
+            item['id']: (item.get('status', 500), item.get('body') or {})
+            for item in response.json().get('responses', [])
+        }
+
+    def _outlook_ids(self, telegram_id: str, email_ids: List[int]) -> Dict[int, str]:
+        session = Session()
+        try:
+            rows = session.query(Email.id, Email.outlook_id)\
+                .filter(Email.telegram_id == telegram_id, Email.id.in_(email_ids))
+            return {row.id: row.outlook_id for row in rows}
+        finally:
+            session.close()
+
+    def _set_read(self, telegram_id: str, email_ids: List[int], is_read: bool):
+        """Flip is_read locally, keeping the stats and thread counters in step"""
+        session = Session()
+        try:
+            rows = session.query(Email.id, Email.conversation_id)\
+                .filter(Email.telegram_id == telegram_id, Email.id.in_(email_ids))\
+                .filter(Email.is_read.isnot(True) if is_read else Email.is_read.is_(True))\
+                .all()
+            if not rows:
+                return
+
+            session.query(Email).filter(Email.id.in_([row.id for row in rows]))\
+                .update({Email.is_read: is_read}, synchronize_session=False)
+
+            delta = 1 if is_read else -1
+            record_read_changes(session, telegram_id, delta * len(rows))
+            for conversation_id, count in Counter(row.conversation_id for row in rows if row.conversation_id).items():
+                record_thread_reads(session, telegram_id, conversation_id, delta * count)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error updating read state for user {telegram_id}: {e}")
+        finally:
+            session.close()
+
+    def _revert_reads(self, telegram_id: str, pending: Dict[int, Set[str]]):
+        self._set_read(telegram_id, [email_id for email_id, actions in pending.items() if ACTION_READ in actions], False)
+
+    def _record_move(self, telegram_id: str, email_id: int, moved: Dict[str, Any]):
+        """A moved message gets a new id in its new folder; follow it locally"""
+        session = Session()
+        try:
+            email = session.query(Email).filter_by(id=email_id, telegram_id=telegram_id).first()
+            if email:
+                email.outlook_id = moved.get('id', email.outlook_id)
+                email.folder_id = moved.get('parentFolderId', email.folder_id)
+                session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error recording move of email {email_id} for user {telegram_id}: {e}")
+        finally:
+            session.close()
@@ -0,0 +1,407 @@
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import requests
+from sqlalchemy import event
+from telegram.request import HTTPXRequest
+
+from circuit_breaker import all_breakers
+from tracing import start_span
+
+logger = logging.getLogger(__name__)
+
+# The bot and the callback server are separate processes; the bot drops
+# snapshots here and the callback server's /metrics serves them all.
+METRICS_DIR = os.getenv('METRICS_DIR', '/tmp/outlook-bot-metrics')
+METRICS_EXPORT_INTERVAL = float(os.getenv('METRICS_EXPORT_INTERVAL', 10))
+# Snapshots of processes that stopped writing are dropped after this long
+METRICS_STALE_AFTER = 300
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+GRAPH_ID_SEGMENT = re.compile(r'^[A-Za-z0-9_\-=]{20,}$')
+
+Labels = Tuple[str, ...]
+Sample = Tuple[str, Dict[str, str], float]
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Labels, Any] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: Any):
+        key = tuple(str(value) for value in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_dict(self, key: Labels) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            children = list(self._children.items())
+        return [sample for key, child in children for sample in child.samples(self.name, self._label_dict(key))]
+
+
+class _CounterValue:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: Dict[str, str]) -> List[Sample]:
+        return [(name, labels, self.value)]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class _GaugeValue:
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def samples(self, name: str, labels: Dict[str, str]) -> List[Sample]:
+        return [(name, labels, self.value)]
+
+
+class Gauge(_Metric):
+    """Set directly, or computed at collection time via set_function"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function: Optional[Callable[[], Any]] = None
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], Any]):
+        """function returns a number, or {label values: number} for labelled gauges"""
+        self._function = function
+
+    def samples(self) -> List[Sample]:
+        if self._function is None:
+            return super().samples()
+        try:
+            value = self._function()
+        except Exception as e:
+            logger.warning(f"Could not collect gauge {self.name}: {e}")
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [(self.name, self._label_dict(key), float(v)) for key, v in value.items()]
+
+
+class _HistogramValue:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def samples(self, name: str, labels: Dict[str, str]) -> List[Sample]:
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append((f'{name}_bucket', {**labels, 'le': repr(float(bound))}, cumulative))
+        samples.append((f'{name}_bucket', {**labels, 'le': '+Inf'}, count))
+        samples.append((f'{name}_count', labels, count))
+        samples.append((f'{name}_sum', labels, total))
+        return samples
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """JSON-serialisable copy of every family, as written to METRICS_DIR"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {
+            metric.name: {'type': metric.kind, 'help': metric.documentation, 'samples': metric.samples()}
+            for metric in metrics
+        }
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+HANDLER_SECONDS = histogram('bot_handler_duration_seconds', 'Telegram handler latency', ['handler', 'outcome'])
+UPDATE_WAIT_SECONDS = histogram('bot_update_queue_wait_seconds', 'Time updates wait for a worker slot')
+GRAPH_REQUEST_SECONDS = histogram('graph_request_duration_seconds', 'Microsoft Graph call latency',
+                                  ['endpoint', 'method', 'status'])
+TOKEN_REQUESTS = counter('oauth_token_requests_total', 'Token requests to the identity platform', ['grant', 'outcome'])
+DB_QUERY_SECONDS = histogram('db_query_duration_seconds', 'Database statement time', ['operation'])
+TELEGRAM_REQUEST_SECONDS = histogram('telegram_request_duration_seconds', 'Telegram Bot API call latency',
+                                     ['method', 'status'])
+TELEGRAM_THROTTLED = counter('telegram_throttled_requests_total', 'Telegram Bot API calls answered with 429', ['method'])
+UPDATES_QUEUED = gauge('bot_updates_queued', 'Updates waiting for a worker slot')
+UPDATES_ACTIVE = gauge('bot_updates_active', 'Updates being handled')
+MAIL_ACTIONS_PENDING = gauge('mail_actions_pending', 'Triage actions waiting for their Graph batch')
+CIRCUIT_BREAKER_OPEN = gauge('circuit_breaker_open', 'Whether an endpoint breaker is refusing calls', ['name'])
+
+CIRCUIT_BREAKER_OPEN.set_function(
+    lambda: {(breaker.name,): 1 if breaker.is_open else 0 for breaker in all_breakers()}
+)
+
+
+def graph_endpoint(url: str) -> str:
+    """Low-cardinality Graph route: no host, query string or message/folder ids"""
+    path = url.split('?', 1)[0].split('/v1.0', 1)[-1]
+    return '/'.join('{id}' if GRAPH_ID_SEGMENT.match(segment) else segment for segment in path.split('/'))
+
+
+def timed_graph_call(method: str, url: str, send: Callable[[], requests.Response]) -> requests.Response:
+    """Run one Graph request, recording its latency by route and status, and a trace span"""
+    endpoint = graph_endpoint(url)
+    started = time.perf_counter()
+    status = 'error'
+    with start_span('graph.request', {'http.method': method, 'graph.endpoint': endpoint}) as span:
+        try:
+            response = send()
+            status = str(response.status_code)
+            return response
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None:
+                status = str(e.response.status_code)
+            raise
+        finally:
+            GRAPH_REQUEST_SECONDS.labels(endpoint, method, status).observe(time.perf_counter() - started)
+            if span:
+                span.set_attribute('http.status_code', status)
+
+
+def instrumented(name: str, handler: Callable[..., Any]) -> Callable[..., Any]:
+    """Wrap an async Telegram handler to record its latency"""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = await handler(update, context)
+            outcome = 'ok'
+            return result
+        finally:
+            HANDLER_SECONDS.labels(name, outcome).observe(time.perf_counter() - started)
+    return wrapper
+
+
+def instrument_engine(engine):
+    """Time every statement on an engine, by SQL verb"""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        DB_QUERY_SECONDS.labels(_operation(statement)).observe(time.perf_counter() - started)
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        started = context.connection.info.get('query_started') if context.connection else None
+        if started:
+            started.pop()
+
+
+def _operation(statement: str) -> str:
+    words = statement.lstrip().split(None, 1)
+    return words[0].upper() if words else 'UNKNOWN'
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest that records Bot API latency and 429 responses"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> Tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        status = 'error'
+        with start_span(f'telegram.{api_method}') as span:
+            try:
+                status_code, payload = await super().do_request(url, method, *args, **kwargs)
+                status = str(status_code)
+                return status_code, payload
+            finally:
+                TELEGRAM_REQUEST_SECONDS.labels(api_method, status).observe(time.perf_counter() - started)
+                if status == '429':
+                    TELEGRAM_THROTTLED.labels(api_method).inc()
+                if span:
+                    span.set_attribute('http.status_code', status)
+
+
+class MetricsExporter:
+    """Periodically writes this process's registry to METRICS_DIR"""
+
+    def __init__(self, process: str, directory: str = METRICS_DIR, interval: float = METRICS_EXPORT_INTERVAL):
+        self.process = process
+        self.directory = directory
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='metrics-exporter', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                logger.error(f"Error writing metrics snapshot: {e}")
+
+    def write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{self.process}.json')
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(REGISTRY.snapshot(), f)
+        # Readers never see a half-written snapshot
+        os.replace(tmp_path, path)
+
+
+def load_snapshots(directory: str = METRICS_DIR) -> Dict[str, Dict[str, Any]]:
+    """Fresh snapshots written by other processes, keyed by process name"""
+    snapshots = {}
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return snapshots
+
+    now = time.time()
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > METRICS_STALE_AFTER:
+                continue
+            with open(path) as f:
+                snapshots[name[:-len('.json')]] = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping metrics snapshot {name}: {e}")
+    return snapshots
+
+
+def render(snapshots: Dict[str, Dict[str, Any]]) -> str:
+    """Prometheus text exposition of several processes' snapshots, one family block each"""
+    families: Dict[str, Dict[str, Any]] = {}
+    for process, snapshot in sorted(snapshots.items()):
+        for name, family in snapshot.items():
+            merged = families.setdefault(name, {'type': family['type'], 'help': family['help'], 'samples': []})
+            merged['samples'].extend(
+                (sample_name, {'process': process, **labels}, value)
+                for sample_name, labels, value in family['samples']
+            )
+
+    lines = []
+    for name, family in sorted(families.items()):
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        lines.extend(_sample_line(*sample) for sample in family['samples'])
+    return '\n'.join(lines) + '\n'
+
+
+def _sample_line(name: str, labels: Dict[str, str], value: float) -> str:
+    if labels:
+        pairs = ','.join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+        return f'{name}{{{pairs}}} {_format_value(value)}'
+    return f'{name} {_format_value(value)}'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
@@ -8,6 +8,8 @@ from telebot import types
 from urllib.parse import urlencode, unquote
 import socket
 
+from logging_setup import setup_logging, LogAggregator
+
 # ---------------- CONFIG ----------------
 TELEGRAM_BOT_TOKEN = "8509627011:AAEh_FVpaAY-_f7_9LPO1x7__zbHY00ymsM"
 ADMIN_CHAT_ID = "5805230405"
@@ -54,11 +56,10 @@ MONITOR_RUNNING = threading.Event()
 BOT_STOPPED = threading.Event()
 
 # ---------------- Logging ----------------
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s"
-)
+setup_logging()
 logger = logging.getLogger("shein_autobuyer")
+# One summary line instead of two lines per request
+REQUEST_LOG = LogAggregator(logger, "Made {total} HTTP requests to {keys} hosts")
 
 # Initialize bot with better error handling
 try:
@@ -176,18 +177,20 @@ def req(method, url, headers=None, cookies=None, body=None, params=None, allow_r
     time.sleep(random.uniform(0.5, 1.5))
     
     try:
-        logger.info(f"Making {method} request to {url}")
-        
         if method == "GET":
             r = sess.get(url, headers=headers, cookies=cookies, params=params, allow_redirects=allow_redirects, timeout=timeout)
         else:
             r = sess.post(url, headers=headers, cookies=cookies, data=body, params=params, allow_redirects=allow_redirects, timeout=timeout)
             
-        logger.info(f"Response status: {r.status_code}")
-        
         data = safe_json(r)
         ok = (200 <= r.status_code < 300)
         
+        REQUEST_LOG.add(urllib.parse.urlsplit(url).netloc)
+        if ok:
+            logger.debug(f"{method} {url} -> {r.status_code}")
+        else:
+            logger.warning(f"{method} {url} -> {r.status_code}")
+        
         if return_resp:
             return r, data, ok
         return r, data, ok
@@ -7,15 +7,26 @@ import hashlib
 import json
 import base64
 from database import Session, User
+from circuit_breaker import get_breaker, CircuitOpenError
+from metrics import timed_graph_call, TOKEN_REQUESTS
+from tracing import start_span, current_traceparent
 from typing import Optional, Dict, Any
 
+GRAPH_BREAKER = get_breaker('graph')
+LOGIN_BREAKER = get_breaker('login')
+
+# AADSTS65001: the user or admin has not consented to a requested scope
+CONSENT_REQUIRED_CODE = 65001
+
 class OutlookAuth:
     def __init__(self):
         self.client_id = os.getenv('OUTLOOK_CLIENT_ID')
         self.client_secret = os.getenv('OUTLOOK_CLIENT_SECRET')
         self.tenant_id = os.getenv('OUTLOOK_TENANT_ID')
         self.redirect_uri = os.getenv('OUTLOOK_REDIRECT_URI')
-        self.scopes = ['User.Read', 'Mail.Read', 'Mail.Send', 'offline_access']
+        self.scopes = ['User.Read', 'Mail.ReadWrite', 'Mail.Send', 'offline_access']
+        # Accounts connected before Mail.ReadWrite was requested keep refreshing with these
+        self.legacy_scopes = ['User.Read', 'Mail.Read', 'Mail.Send', 'offline_access']
         
         self.authority = f"https://login.microsoftonline.com/{self.tenant_id}"
         self.app = msal.ConfidentialClientApplication(
@@ -31,6 +42,11 @@ class OutlookAuth:
         """Generate UNIQUE Outlook authentication URL each time"""
         # Generate unique state
         state = secrets.token_urlsafe(32)
+        # Carried in the state itself so the callback server, a separate process,
+        # can continue the trace of the /connect that issued it
+        traceparent = current_traceparent()
+        if traceparent:
+            state = f'{state}.{traceparent}'
         
         # Generate PKCE code verifier and challenge
         code_verifier = secrets.token_urlsafe(64)
@@ -88,33 +104,40 @@ class OutlookAuth:
             self.auth_states[state]['used'] = True
             
             # Exchange code for token with PKCE
-            result = self.app.acquire_token_by_authorization_code(
-                code,
-                scopes=self.scopes,
-                redirect_uri=self.redirect_uri,
-                code_verifier=state_data['code_verifier']
-            )
+            with start_span('oauth.token', {'grant': 'authorization_code'}):
+                result = LOGIN_BREAKER.call(
+                    self.app.acquire_token_by_authorization_code,
+                    code,
+                    scopes=self.scopes,
+                    redirect_uri=self.redirect_uri,
+                    code_verifier=state_data['code_verifier']
+                )
             
             # Remove state after use
             del self.auth_states[state]
             
+            TOKEN_REQUESTS.labels('authorization_code', _token_outcome(result)).inc()
             return result
             
         except Exception as e:
             print(f"❌ Token exchange error: {e}")
+            TOKEN_REQUESTS.labels('authorization_code', 'error').inc()
             return None
     
     def get_user_info(self, access_token: str) -> Dict[str, Any]:
         """Get user email from Microsoft Graph"""
         headers = {'Authorization': f'Bearer {access_token}'}
-        try:
+        def send():
             response = requests.get(
                 'https://graph.microsoft.com/v1.0/me',
                 headers=headers,
                 timeout=10
             )
             response.raise_for_status()
-            return response.json()
+            return response
+        
+        try:
+            return GRAPH_BREAKER.call(timed_graph_call, 'GET', 'https://graph.microsoft.com/v1.0/me', send).json()
         except requests.exceptions.RequestException as e:
             print(f"❌ Error getting user info: {e}")
             return {}
@@ -122,15 +145,37 @@ class OutlookAuth:
     def refresh_token(self, refresh_token: str) -> Optional[Dict[str, Any]]:
         """Refresh access token"""
         try:
-            result = self.app.acquire_token_by_refresh_token(
-                refresh_token,
-                scopes=self.scopes
-            )
+            with start_span('oauth.token', {'grant': 'refresh_token'}):
+                result = LOGIN_BREAKER.call(
+                    self.app.acquire_token_by_refresh_token,
+                    refresh_token,
+                    scopes=self.scopes
+                )
+                if _lacks_scope_consent(result):
+                    # Grant lacks Mail.ReadWrite; stay read-only until the user reconnects
+                    result = LOGIN_BREAKER.call(
+                        self.app.acquire_token_by_refresh_token,
+                        refresh_token,
+                        scopes=self.legacy_scopes
+                    )
+            TOKEN_REQUESTS.labels('refresh_token', _token_outcome(result)).inc()
             return result
+        except CircuitOpenError:
+            # Not a refresh failure: the identity platform is down, so keep the user's tokens
+            TOKEN_REQUESTS.labels('refresh_token', 'circuit_open').inc()
+            raise
         except Exception as e:
             print(f"❌ Token refresh error: {e}")
+            TOKEN_REQUESTS.labels('refresh_token', 'error').inc()
             return None
     
+    @staticmethod
+    def state_traceparent(state: Optional[str]) -> Optional[str]:
+        """traceparent embedded in a state by get_auth_url, if it was traced"""
+        # token_urlsafe never produces '.', so anything after one is the traceparent
+        _, dot, traceparent = (state or '').partition('.')
+        return traceparent if dot else None
+    
     def validate_state(self, state: str, telegram_id: str) -> bool:
         """Validate if state belongs to user"""
         if state not in self.auth_states:
@@ -145,3 +190,23 @@ class OutlookAuth:
             return True
         
         return False
+
+
+def _token_outcome(result: Optional[Dict[str, Any]]) -> str:
+    return 'success' if result and 'access_token' in result else 'failure'
+
+
+def _lacks_scope_consent(result: Optional[Dict[str, Any]]) -> bool:
+    """Whether a token error means the grant does not cover the requested scopes
+
+    Expired, revoked or otherwise invalid refresh tokens (invalid_grant
+    without a consent code) fail the same way for any scope set.
+    """
+    if not result or 'error' not in result:
+        return False
+    return (
+        result['error'] == 'invalid_scope'
+        or result.get('suberror') == 'consent_required'
+        or CONSENT_REQUIRED_CODE in (result.get('error_codes') or [])
+        or f'AADSTS{CONSENT_REQUIRED_CODE}' in (result.get('error_description') or '')
+    )
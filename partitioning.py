@@ -0,0 +1,300 @@
+import contextlib
+import logging
+import os
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import String, Table, Text, text
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Opt-in: only Postgres and MySQL support declarative range partitioning
+PARTITIONING_ENABLED = os.getenv('EMAIL_PARTITIONING', '').lower() in ('1', 'true', 'yes', 'monthly')
+PARTITION_MONTHS_BACK = int(os.getenv('EMAIL_PARTITION_MONTHS_BACK', 12))
+PARTITION_MONTHS_AHEAD = int(os.getenv('EMAIL_PARTITION_MONTHS_AHEAD', 3))
+# Whole months older than this are dropped outright (0 = never drop)
+PARTITION_RETENTION_MONTHS = int(os.getenv('EMAIL_PARTITION_RETENTION_MONTHS', 0))
+
+SUPPORTED_DIALECTS = ('postgresql', 'mysql')
+PARTITION_KEY = 'received_at'
+# Per table, the end of the newest dropped month (database.PartitionCutoff)
+CUTOFF_TABLE = 'partition_cutoffs'
+INGEST_LOCK_PREFIX = 'emails_ingest:'
+INGEST_LOCK_TIMEOUT = 30
+
+
+def _month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1)
+
+
+def _add_months(value: datetime, months: int) -> datetime:
+    index = value.year * 12 + value.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def _partition_name(month: datetime, prefix: str) -> str:
+    return f'{prefix}p{month.year:04d}_{month.month:02d}'
+
+
+def _parse_partition_month(name: str, prefix: str) -> Optional[datetime]:
+    """Month a partition holds, from its name; None for default/overflow partitions"""
+    suffix = name[len(prefix) + 1:] if name.startswith(prefix + 'p') else ''
+    try:
+        return datetime.strptime(suffix, '%Y_%m')
+    except ValueError:
+        return None
+
+
+def partitioning_enabled(engine: Engine) -> bool:
+    return PARTITIONING_ENABLED and engine.dialect.name in SUPPORTED_DIALECTS
+
+
+def _column_ddl(column, engine: Engine) -> str:
+    dialect = engine.dialect
+    if column.primary_key and column.autoincrement:
+        if dialect.name == 'postgresql':
+            return f'{column.name} INTEGER GENERATED BY DEFAULT AS IDENTITY'
+        return f'{column.name} INTEGER NOT NULL AUTO_INCREMENT'
+
+    column_type = column.type
+    if isinstance(column_type, String) and not isinstance(column_type, Text) \
+            and column_type.length is None and dialect.name == 'mysql':
+        # MySQL needs a length for VARCHAR; Graph ids and addresses fit comfortably
+        column_type = String(255)
+
+    ddl = f'{column.name} {column_type.compile(dialect=dialect)}'
+    if column.name == PARTITION_KEY:
+        ddl += ' NOT NULL'
+    return ddl
+
+
+def create_partitioned_table(engine: Engine, table: Table) -> bool:
+    """Create table partitioned by month of received_at, if it does not exist yet
+
+    Must run before metadata.create_all(), which then leaves the table alone.
+    The partition key has to be part of every unique key, so the primary key
+    becomes (id, received_at) and outlook_id is only unique per received_at.
+    Ingest de-duplicates by outlook_id before inserting, under ingest_lock().
+    """
+    if not partitioning_enabled(engine):
+        return False
+
+    with engine.begin() as conn:
+        if engine.dialect.has_table(conn, table.name):
+            if not _is_partitioned(conn, engine, table.name):
+                logger.warning(f"Table {table.name} already exists unpartitioned; "
+                               f"migrate it manually to enable partitioning")
+            return False
+
+        columns = ',\n    '.join(_column_ddl(column, engine) for column in table.columns)
+        keys = (
+            f'PRIMARY KEY (id, {PARTITION_KEY}),\n'
+            f'    UNIQUE (outlook_id, {PARTITION_KEY})'
+        )
+
+        this_month = _month_start(datetime.utcnow())
+        months = [_add_months(this_month, n) for n in range(-PARTITION_MONTHS_BACK, PARTITION_MONTHS_AHEAD + 1)]
+
+        if engine.dialect.name == 'postgresql':
+            conn.exec_driver_sql(
+                f'CREATE TABLE {table.name} (\n    {columns},\n    {keys}\n) '
+                f'PARTITION BY RANGE ({PARTITION_KEY})'
+            )
+            # Anything outside the monthly ranges (old backfills, clock skew) lands here
+            conn.exec_driver_sql(f'CREATE TABLE {table.name}_default PARTITION OF {table.name} DEFAULT')
+            for month in months:
+                _create_pg_partition(conn, table.name, month)
+        else:
+            # The first range also holds everything older than it
+            partitions = ',\n    '.join(
+                f"PARTITION {_partition_name(month, '')} VALUES LESS THAN ('{_add_months(month, 1):%Y-%m-%d}')"
+                for month in months
+            )
+            conn.exec_driver_sql(
+                f'CREATE TABLE {table.name} (\n    {columns},\n    {keys}\n) '
+                f'PARTITION BY RANGE COLUMNS ({PARTITION_KEY}) (\n    {partitions},\n'
+                f'    PARTITION pmax VALUES LESS THAN (MAXVALUE)\n)'
+            )
+
+    logger.info(f"Created {table.name} partitioned by month of {PARTITION_KEY} ({len(months)} partitions)")
+    return True
+
+
+@contextlib.contextmanager
+def ingest_lock(session, telegram_id: str):
+    """Serialize a user's email inserts while the table is partitioned
+
+    Partitioned, outlook_id has no unique constraint of its own, so two
+    writers for the same user (a backfill next to a live /inbox) could both
+    pass the existing-id check and store a message twice. Holding this lock
+    from the check until commit closes that gap. Unpartitioned tables rely
+    on the unique constraint instead, and this is a no-op.
+    """
+    engine = session.get_bind()
+    if not partitioning_enabled(engine):
+        yield
+        return
+
+    key = f'{INGEST_LOCK_PREFIX}{telegram_id}'
+    if engine.dialect.name == 'postgresql':
+        # Released automatically when the transaction ends
+        session.execute(text('SELECT pg_advisory_xact_lock(hashtext(:key))'), {'key': key})
+        yield
+        return
+
+    # MySQL named locks belong to a connection, not a transaction, so hold it
+    # on one of its own that stays open until the session has committed
+    with engine.connect() as conn:
+        acquired = conn.execute(text('SELECT GET_LOCK(:key, :timeout)'),
+                                {'key': key, 'timeout': INGEST_LOCK_TIMEOUT}).scalar()
+        if acquired != 1:
+            raise TimeoutError(f"Timed out waiting for the ingest lock of user {telegram_id}")
+        try:
+            yield
+        finally:
+            conn.execute(text('SELECT RELEASE_LOCK(:key)'), {'key': key})
+
+
+def _is_partitioned(conn, engine: Engine, table_name: str) -> bool:
+    if engine.dialect.name == 'postgresql':
+        return conn.execute(text(
+            "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+            "WHERE c.relname = :name AND pg_table_is_visible(c.oid)"
+        ), {'name': table_name}).first() is not None
+    return bool(_list_partitions(conn, engine, table_name))
+
+
+def _list_partitions(conn, engine: Engine, table_name: str) -> List[str]:
+    if engine.dialect.name == 'postgresql':
+        rows = conn.execute(text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :name AND pg_table_is_visible(p.oid)"
+        ), {'name': table_name})
+    else:
+        rows = conn.execute(text(
+            "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name AND PARTITION_NAME IS NOT NULL"
+        ), {'name': table_name})
+    return [row[0] for row in rows]
+
+
+def _create_pg_partition(conn, table_name: str, month: datetime):
+    conn.exec_driver_sql(
+        f"CREATE TABLE IF NOT EXISTS {_partition_name(month, table_name + '_')} PARTITION OF {table_name} "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{_add_months(month, 1):%Y-%m-%d}')"
+    )
+
+
+def ensure_future_partitions(engine: Engine, table_name: str = 'emails',
+                             months_ahead: int = PARTITION_MONTHS_AHEAD) -> List[str]:
+    """Create partitions for the coming months; returns the names created"""
+    this_month = _month_start(datetime.utcnow())
+    wanted = [_add_months(this_month, n) for n in range(months_ahead + 1)]
+    created = []
+
+    with engine.begin() as conn:
+        prefix = table_name + '_' if engine.dialect.name == 'postgresql' else ''
+        existing = set(_list_partitions(conn, engine, table_name))
+        missing = [month for month in wanted if _partition_name(month, prefix) not in existing]
+        if not missing:
+            return created
+
+        if engine.dialect.name == 'postgresql':
+            for month in missing:
+                try:
+                    with conn.begin_nested():
+                        _create_pg_partition(conn, table_name, month)
+                    created.append(_partition_name(month, prefix))
+                except Exception as e:
+                    # Fails if the default partition already holds rows for that month
+                    logger.error(f"Could not create partition for {month:%Y-%m} on {table_name}: {e}")
+        else:
+            # Split the MAXVALUE overflow partition; only ranges past the newest one can be added
+            existing_months = [_parse_partition_month(name, prefix) for name in existing]
+            latest = max((month for month in existing_months if month), default=None)
+            missing = [month for month in missing if latest is None or month > latest]
+            if missing:
+                partitions = ', '.join(
+                    f"PARTITION {_partition_name(month, '')} VALUES LESS THAN ('{_add_months(month, 1):%Y-%m-%d}')"
+                    for month in missing
+                )
+                conn.exec_driver_sql(
+                    f'ALTER TABLE {table_name} REORGANIZE PARTITION pmax INTO '
+                    f'({partitions}, PARTITION pmax VALUES LESS THAN (MAXVALUE))'
+                )
+                created.extend(_partition_name(month, '') for month in missing)
+
+    if created:
+        logger.info(f"Created partitions {', '.join(created)} on {table_name}")
+    return created
+
+
+def drop_partitions_before(engine: Engine, cutoff: datetime, table_name: str = 'emails') -> List[str]:
+    """Drop every monthly partition that ends on or before cutoff; returns the names dropped
+
+    This is a metadata operation regardless of how many rows the partitions hold.
+    Instead of a tombstone per row, the end of the newest dropped month is
+    recorded once in partition_cutoffs, and ingest skips anything received
+    before it (see partition_cutoff), so later fetches do not store it again.
+    Rows in the default (Postgres) or overflow (MySQL) partition are never dropped.
+    """
+    dropped = []
+    dropped_before = None
+    with engine.begin() as conn:
+        prefix = table_name + '_' if engine.dialect.name == 'postgresql' else ''
+        for name in sorted(_list_partitions(conn, engine, table_name)):
+            month = _parse_partition_month(name, prefix)
+            if month is None or _add_months(month, 1) > cutoff:
+                continue
+
+            if engine.dialect.name == 'postgresql':
+                conn.exec_driver_sql(f'ALTER TABLE {table_name} DETACH PARTITION {name}')
+                conn.exec_driver_sql(f'DROP TABLE {name}')
+            else:
+                conn.exec_driver_sql(f'ALTER TABLE {table_name} DROP PARTITION {name}')
+            dropped.append(name)
+            dropped_before = max(filter(None, (dropped_before, _add_months(month, 1))))
+
+        if dropped_before is not None:
+            _record_cutoff(conn, engine, table_name, dropped_before)
+
+    if dropped:
+        logger.info(f"Dropped partitions {', '.join(dropped)} from {table_name}")
+    return dropped
+
+
+def _record_cutoff(conn, engine: Engine, table_name: str, dropped_before: datetime):
+    """Move a table's dropped-before mark forward, never back"""
+    if engine.dialect.name == 'postgresql':
+        upsert = (
+            f"ON CONFLICT (table_name) DO UPDATE SET dropped_before = "
+            f"GREATEST({CUTOFF_TABLE}.dropped_before, EXCLUDED.dropped_before)"
+        )
+    else:
+        upsert = "ON DUPLICATE KEY UPDATE dropped_before = GREATEST(dropped_before, VALUES(dropped_before))"
+    conn.execute(text(
+        f"INSERT INTO {CUTOFF_TABLE} (table_name, dropped_before) VALUES (:table_name, :dropped_before) {upsert}"
+    ), {'table_name': table_name, 'dropped_before': dropped_before})
+
+
+def partition_cutoff(session, table_name: str = 'emails') -> Optional[datetime]:
+    """Emails received before this were dropped with their partitions and must not be stored again"""
+    if not partitioning_enabled(session.get_bind()):
+        return None
+    return session.execute(
+        text(f"SELECT dropped_before FROM {CUTOFF_TABLE} WHERE table_name = :table_name"),
+        {'table_name': table_name}
+    ).scalar()
+
+
+def maintain_partitions(engine: Engine, table_name: str = 'emails'):
+    """Periodic upkeep: pre-create upcoming months and drop expired ones"""
+    if not partitioning_enabled(engine):
+        return
+
+    ensure_future_partitions(engine, table_name)
+    if PARTITION_RETENTION_MONTHS:
+        cutoff = _add_months(_month_start(datetime.utcnow()), -PARTITION_RETENTION_MONTHS)
+        drop_partitions_before(engine, cutoff, table_name)
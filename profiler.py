@@ -0,0 +1,205 @@
+import contextlib
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+QUERY_PROFILING = os.getenv('QUERY_PROFILING', '').lower() in ('1', 'true', 'yes')
+# Statements slower than this are logged with their query plan
+QUERY_SLOW_MS = float(os.getenv('QUERY_SLOW_MS', 200))
+# A single update running more statements than this is flagged
+QUERY_COUNT_WARN = int(os.getenv('QUERY_COUNT_WARN', 50))
+# The same statement repeated this often in one update is probably an N+1 loop
+QUERY_REPEAT_WARN = int(os.getenv('QUERY_REPEAT_WARN', 10))
+QUERY_REPORT_INTERVAL = 300
+QUERY_REPORT_TOP = 10
+# Each slow statement shape is EXPLAINed at most once per interval
+EXPLAIN_INTERVAL = 600
+STATEMENT_LOG_CHARS = 200
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PARAM = re.compile(r'%\(\w+\)s|%s|:\w+|\?')
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_VALUES = re.compile(r'(\(\?(?:, \?)*\))(?:\s*,\s*\1)+')
+_SPACE = re.compile(r'\s+')
+
+
+def normalize(statement: str) -> str:
+    """Statement shape with literals, parameters and IN/VALUES lists collapsed"""
+    shape = _STRING.sub('?', statement)
+    shape = _PARAM.sub('?', shape)
+    shape = _NUMBER.sub('?', shape)
+    shape = _SPACE.sub(' ', shape).strip()
+    shape = _VALUES.sub(r'\1...', shape)
+    return _LIST.sub('(?...)', shape)
+
+
+class StatementStats(NamedTuple):
+    statement: str
+    count: int
+    total_ms: float
+    max_ms: float
+
+
+class RequestProfile:
+    """Statements run on behalf of one update, including those in worker threads"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.count = 0
+        self.total_ms = 0.0
+        self.shapes: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, shape: str, elapsed_ms: float):
+        with self._lock:
+            self.count += 1
+            self.total_ms += elapsed_ms
+            self.shapes[shape] += 1
+
+
+class QueryProfiler:
+    """Aggregates statement timings process-wide and per update"""
+
+    def __init__(self):
+        self._stats: Dict[str, List[float]] = {}
+        self._explained: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._last_report = time.monotonic()
+
+    def record(self, engine, statement: str, parameters, elapsed_ms: float, executemany: bool):
+        shape = normalize(statement)
+        with self._lock:
+            stats = self._stats.get(shape)
+            if stats is None:
+                stats = self._stats[shape] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += elapsed_ms
+            stats[2] = max(stats[2], elapsed_ms)
+
+        profile = _current_profile.get()
+        if profile is not None:
+            profile.record(shape, elapsed_ms)
+
+        if elapsed_ms >= QUERY_SLOW_MS:
+            plan = None if executemany else self._explain_once(engine, shape, statement, parameters)
+            where = f" during {profile.name}" if profile else ""
+            logger.warning(
+                f"Slow query{where} ({elapsed_ms:.0f}ms): {shape[:STATEMENT_LOG_CHARS]}"
+                + (f"\n{plan}" if plan else "")
+            )
+
+        self._maybe_report()
+
+    def _explain_once(self, engine, shape: str, statement: str, parameters) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._explained.get(shape, -EXPLAIN_INTERVAL) < EXPLAIN_INTERVAL:
+                return None
+            self._explained[shape] = now
+
+        if statement.lstrip().split(None, 1)[0].upper() not in ('SELECT', 'UPDATE', 'DELETE'):
+            return None
+
+        prefix = 'EXPLAIN QUERY PLAN ' if engine.dialect.name == 'sqlite' else 'EXPLAIN '
+        # A separate connection: the statement's own cursor still holds its results
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(prefix + statement, parameters)
+            return '\n'.join('  ' + ' | '.join(str(value) for value in row) for row in cursor.fetchall())
+        except Exception as e:
+            return f"  (EXPLAIN failed: {e})"
+        finally:
+            connection.close()
+
+    def top(self, limit: int = QUERY_REPORT_TOP) -> List[StatementStats]:
+        """Statement shapes with the most total time"""
+        with self._lock:
+            rows = [StatementStats(shape, *stats) for shape, stats in self._stats.items()]
+        return sorted(rows, key=lambda row: row.total_ms, reverse=True)[:limit]
+
+    def _maybe_report(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_report < QUERY_REPORT_INTERVAL:
+                return
+            self._last_report = now
+
+        lines = [
+            f"  {row.total_ms:9.1f}ms {row.count:7}x max {row.max_ms:7.1f}ms  {row.statement[:STATEMENT_LOG_CHARS]}"
+            for row in self.top()
+        ]
+        logger.info("Top queries by total time:\n" + '\n'.join(lines))
+
+
+profiler = QueryProfiler()
+
+_current_profile: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar('query_profile', default=None)
+
+
+@contextlib.contextmanager
+def profile_request(name: str) -> Iterator[Optional[RequestProfile]]:
+    """Count the statements one update runs and log a summary when it finishes"""
+    if not QUERY_PROFILING:
+        yield None
+        return
+
+    profile = RequestProfile(name)
+    token = _current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _current_profile.reset(token)
+        _log_summary(profile)
+
+
+def _log_summary(profile: RequestProfile):
+    if not profile.count:
+        return
+
+    elapsed_ms = (time.perf_counter() - profile.started) * 1000
+    shape, repeats = profile.shapes.most_common(1)[0]
+    summary = (
+        f"{profile.name}: {profile.count} queries, {profile.total_ms:.1f}ms of {elapsed_ms:.0f}ms, "
+        f"{len(profile.shapes)} distinct"
+    )
+    if profile.count > QUERY_COUNT_WARN:
+        logger.warning(f"Query count over {QUERY_COUNT_WARN} for {summary}")
+    else:
+        logger.info(f"Queries for {summary}")
+    if repeats >= QUERY_REPEAT_WARN:
+        logger.warning(f"Possible N+1 in {profile.name}: {repeats}x {shape[:STATEMENT_LOG_CHARS]}")
+
+
+def profile_engine(engine):
+    """Hook the profiler into an engine; a no-op unless QUERY_PROFILING is set"""
+    if not QUERY_PROFILING:
+        return
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - conn.info['profile_started'].pop()) * 1000
+        profiler.record(engine, statement, parameters, elapsed_ms, executemany)
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        started = context.connection.info.get('profile_started') if context.connection else None
+        if started:
+            started.pop()
+
+    logger.info(f"Query profiling enabled (slow threshold {QUERY_SLOW_MS:.0f}ms)")
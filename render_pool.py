@@ -0,0 +1,163 @@
+import logging
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from html import unescape
+from html.parser import HTMLParser
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Documents smaller than this are rendered inline; parsing them costs less than the IPC
+RENDER_INLINE_THRESHOLD = int(os.getenv('RENDER_INLINE_THRESHOLD', 32 * 1024))
+RENDER_TIMEOUT = float(os.getenv('RENDER_TIMEOUT', 5))
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', 2))
+RENDER_MAX_CHARS = 12000
+
+_MARKDOWN_SPECIAL = re.compile(r'([_*`\[])')
+_BLANK_LINES = re.compile(r'\n\s*\n\s*\n+')
+_SPACES = re.compile(r'[ \t\r\f\v]+')
+_TAGS = re.compile(r'<[^>]*>')
+
+_SKIP_TAGS = {'script', 'style', 'head', 'title', 'noscript', 'template', 'svg'}
+_BLOCK_TAGS = {'p', 'div', 'br', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+               'table', 'section', 'article', 'header', 'footer', 'blockquote', 'hr'}
+
+
+class _TextExtractor(HTMLParser):
+    """Collects visible text, dropping scripts/styles and keeping block breaks"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in _BLOCK_TAGS:
+            self.parts.append('\n')
+        if tag == 'li':
+            self.parts.append('• ')
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in _BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+
+
+def html_to_text(html: str) -> str:
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return unescape(''.join(parser.parts))
+
+
+def escape_markdown(text: str) -> str:
+    """Escape Telegram (legacy) Markdown control characters"""
+    return _MARKDOWN_SPECIAL.sub(r'\\\1', text)
+
+
+def render_body(content: str, content_type: str = 'text', max_chars: int = RENDER_MAX_CHARS) -> str:
+    """Turn a Graph message body into Telegram-safe Markdown text"""
+    text = html_to_text(content) if content_type.lower() == 'html' else content
+
+    lines = (_SPACES.sub(' ', line).strip() for line in text.splitlines())
+    text = _BLANK_LINES.sub('\n\n', '\n'.join(lines)).strip()
+
+    truncated = len(text) > max_chars
+    if truncated:
+        text = text[:max_chars].rsplit(' ', 1)[0]
+
+    text = escape_markdown(text)
+    if truncated:
+        text += '\n\n… _(truncated)_'
+    return text
+
+
+class RenderPool:
+    """Renders large bodies in worker processes so they never stall the caller
+
+    A render that overruns the timeout gets the cheap fallback, and its worker
+    is killed by restarting the pool: a running future cannot be cancelled.
+    """
+
+    def __init__(self, workers: int = RENDER_WORKERS, inline_threshold: int = RENDER_INLINE_THRESHOLD,
+                 timeout: float = RENDER_TIMEOUT):
+        self.workers = workers
+        self.inline_threshold = inline_threshold
+        self.timeout = timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def render(self, content: str, content_type: str = 'text') -> str:
+        """Render a body; blocks the calling thread (run it off the event loop)"""
+        if len(content) < self.inline_threshold:
+            return render_body(content, content_type)
+
+        executor = self._get_executor()
+        try:
+            future = executor.submit(render_body, content, content_type)
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            logger.warning(f"Rendering a {len(content)} byte {content_type} body timed out; restarting render workers")
+            self._restart(executor)
+            return self._fallback(content, content_type)
+        except BrokenProcessPool:
+            # A worker died (OOM, crash) or was killed by a timeout restart
+            logger.warning(f"Render pool broke while rendering a {len(content)} byte {content_type} body")
+            self._restart(executor)
+            return self._fallback(content, content_type)
+
+    @staticmethod
+    def _fallback(content: str, content_type: str) -> str:
+        """Cheap preview of a bounded prefix when full rendering takes too long"""
+        preview = content[:RENDER_MAX_CHARS]
+        if content_type.lower() == 'html':
+            preview = unescape(_TAGS.sub(' ', preview))
+        preview = _SPACES.sub(' ', preview).strip()[:RENDER_MAX_CHARS // 4]
+        return escape_markdown(preview) + '\n\n… _(preview only, message too large to render)_'
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn keeps workers free of the parent's threads, connections and locks.
+                # Workers still re-import the main module, which is safe because the DB
+                # engine, schema setup and trace exporter only start from entry points.
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def _restart(self, executor: ProcessPoolExecutor):
+        """Kill a pool's workers and let the next render start a fresh one"""
+        with self._lock:
+            # Another thread may already have replaced it
+            if self._executor is not executor:
+                return
+            self._executor = None
+        _terminate(executor)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _terminate(executor: ProcessPoolExecutor):
+    """Stop a pool without waiting for its running tasks, which may never finish"""
+    # ProcessPoolExecutor has no public way to kill busy workers before Python 3.14
+    for process in list((executor._processes or {}).values()):
+        if process.is_alive():
+            process.terminate()
+    executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,125 @@
+import logging
+from typing import List, Optional
+
+from telegram import Message
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = MessageLimit.MAX_TEXT_LENGTH
+
+
+def split_blocks(blocks: List[str], limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Pack text blocks into as few chunks as fit the limit, never reordering them
+
+    The split only depends on the blocks themselves, so re-rendering the same
+    content always produces the same chunks and earlier messages stay stable.
+    A block that is longer than the limit on its own is cut at line breaks,
+    then spaces, or hard-cut as a last resort, never leaving a Markdown escape
+    dangling at the end of a chunk.
+    """
+    chunks = []
+    current = ''
+
+    for block in blocks:
+        for piece in _split_oversized(block, limit):
+            if current and len(current) + len(piece) > limit:
+                chunks.append(current)
+                current = ''
+            current += piece
+
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+
+def _split_oversized(block: str, limit: int) -> List[str]:
+    if len(block) <= limit:
+        return [block]
+
+    pieces = []
+    current = ''
+    for line in block.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                pieces.append(current)
+                current = ''
+            cut = _cut_point(line, limit)
+            pieces.append(line[:cut])
+            line = line[cut:]
+        if len(current) + len(line) > limit:
+            pieces.append(current)
+            current = ''
+        current += line
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def _cut_point(line: str, limit: int) -> int:
+    """Where to cut an over-long line: after the last space, else before any trailing backslash"""
+    cut = max(line.rfind(' ', 0, limit), line.rfind('\t', 0, limit)) + 1
+    if cut > 0:
+        return cut
+
+    # An escape cut from the character it escapes breaks Markdown parsing of both chunks
+    cut = limit
+    while cut > 1 and line[cut - 1] == '\\':
+        cut -= 1
+    return cut if line[cut - 1] != '\\' else limit
+
+
+class ProgressiveMessage:
+    """A reply that is edited in place as more content arrives
+
+    The first render sends a message; later renders edit it, and spill into
+    follow-up messages once the text exceeds Telegram's length limit. Chunks
+    whose text did not change are not re-sent.
+    """
+
+    def __init__(self, reply_to: Message, parse_mode: Optional[str] = ParseMode.MARKDOWN):
+        self.reply_to = reply_to
+        self.parse_mode = parse_mode
+        self.messages: List[Message] = []
+        self._texts: List[str] = []
+
+    async def render(self, blocks: List[str], reply_markup=None):
+        """Show blocks, reusing already-sent messages; markup goes on the last chunk"""
+        chunks = split_blocks(blocks)
+
+        for i, text in enumerate(chunks):
+            markup = reply_markup if i == len(chunks) - 1 else None
+
+            if i >= len(self.messages):
+                message = await self.reply_to.reply_text(
+                    text,
+                    parse_mode=self.parse_mode,
+                    disable_web_page_preview=True,
+                    reply_markup=markup
+                )
+                self.messages.append(message)
+                self._texts.append(text)
+                continue
+
+            if self._texts[i] == text and markup is None:
+                continue
+
+            try:
+                await self.messages[i].edit_text(
+                    text,
+                    parse_mode=self.parse_mode,
+                    disable_web_page_preview=True,
+                    reply_markup=markup
+                )
+            except BadRequest as e:
+                # Telegram rejects edits that change nothing
+                if 'not modified' not in str(e).lower():
+                    raise
+            self._texts[i] = text
+
+        # Content shrank: blank out leftover follow-ups rather than leave stale text
+        for i in range(len(chunks), len(self.messages)):
+            if self._texts[i] != '…':
+                await self.messages[i].edit_text('…')
+                self._texts[i] = '…'
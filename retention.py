@@ -0,0 +1,208 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func
+
+from archive import ArchiveStore
+from database import Session, Email, ArchivedEmail, email_sender, RetentionPolicy, decompress_body
+from partitioning import maintain_partitions
+
+logger = logging.getLogger(__name__)
+
+# Applied to users without their own policy; unset means keep everything
+DEFAULT_MAX_AGE_DAYS = int(os.getenv('RETENTION_MAX_AGE_DAYS', 0)) or None
+DEFAULT_MAX_ROWS = int(os.getenv('RETENTION_MAX_ROWS', 0)) or None
+COMPACT_INTERVAL = int(os.getenv('RETENTION_INTERVAL', 3600))
+COMPACT_BATCH_SIZE = 1000
+
+ARCHIVE_COLUMNS = (
+    Email.id,
+    Email.outlook_id,
+    email_sender,
+    Email.subject,
+    Email.received_at,
+    Email.is_read,
+    Email.has_attachments,
+    Email.folder_id,
+    Email.body_z,
+    Email.body,
+)
+
+
+class RetentionCompactor:
+    """Moves emails past a user's retention policy out of the hot table into the archive"""
+
+    def __init__(self, archive: Optional[ArchiveStore] = None, interval: int = COMPACT_INTERVAL):
+        self.archive = archive or ArchiveStore()
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='retention', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.compact_all()
+            except Exception as e:
+                logger.error(f"Retention pass failed: {e}")
+
+    def get_policy(self, telegram_id: str) -> Dict[str, Optional[int]]:
+        session = Session()
+        try:
+            policy = session.query(RetentionPolicy).filter_by(telegram_id=telegram_id).first()
+            if policy:
+                return {'max_age_days': policy.max_age_days, 'max_rows': policy.max_rows}
+            return {'max_age_days': DEFAULT_MAX_AGE_DAYS, 'max_rows': DEFAULT_MAX_ROWS}
+        finally:
+            session.close()
+
+    def set_policy(self, telegram_id: str, max_age_days: Optional[int], max_rows: Optional[int]):
+        session = Session()
+        try:
+            policy = session.query(RetentionPolicy).filter_by(telegram_id=telegram_id).first()
+            if policy is None:
+                policy = RetentionPolicy(telegram_id=telegram_id)
+                session.add(policy)
+            policy.max_age_days = max_age_days
+            policy.max_rows = max_rows
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error saving retention policy for user {telegram_id}: {e}")
+            raise
+        finally:
+            session.close()
+
+    def compact_all(self) -> int:
+        """Run one compaction pass over every user with stored emails"""
+        session = Session()
+        try:
+            # Partitioned deployments also roll the monthly partitions forward
+            maintain_partitions(session.get_bind())
+            telegram_ids = [row[0] for row in session.query(Email.telegram_id).distinct()]
+        finally:
+            session.close()
+
+        total = 0
+        for telegram_id in telegram_ids:
+            total += self.compact_user(telegram_id)
+
+        if total:
+            logger.info(f"Retention archived {total} emails across {len(telegram_ids)} users")
+        return total
+
+    def compact_user(self, telegram_id: str) -> int:
+        policy = self.get_policy(telegram_id)
+        cutoff = self._cutoff(telegram_id, policy)
+        if cutoff is None:
+            return 0
+
+        moved = 0
+        while True:
+            batch = self._next_batch(telegram_id, cutoff)
+            if not batch:
+                break
+            # Archive first, then delete: a crash in between re-archives the
+            # batch, and archive search de-duplicates by outlook_id.
+            self.archive.append(telegram_id, [record for _, record in batch])
+            self._delete(telegram_id, [email_id for email_id, _ in batch],
+                         [record['outlook_id'] for _, record in batch])
+            moved += len(batch)
+
+        self._mark_compacted(telegram_id)
+        return moved
+
+    def _cutoff(self, telegram_id: str, policy: Dict[str, Optional[int]]) -> Optional[datetime]:
+        """Newest received_at that must leave the hot table (inclusive), or None"""
+        cutoffs = []
+        if policy['max_age_days']:
+            # Everything strictly older than the age limit
+            cutoffs.append(datetime.utcnow() - timedelta(days=policy['max_age_days']) - timedelta(microseconds=1))
+
+        if policy['max_rows']:
+            session = Session()
+            try:
+                row = session.query(Email.received_at)\
+                    .filter(Email.telegram_id == telegram_id)\
+                    .order_by(Email.received_at.desc())\
+                    .offset(policy['max_rows']).limit(1).first()
+            finally:
+                session.close()
+            if row:
+                cutoffs.append(row.received_at)
+
+        return max(cutoffs) if cutoffs else None
+
+    def _next_batch(self, telegram_id: str, cutoff: datetime) -> List:
+        session = Session()
+        try:
+            rows = session.query(*ARCHIVE_COLUMNS)\
+                .filter(Email.telegram_id == telegram_id, Email.received_at <= cutoff)\
+                .order_by(Email.received_at)\
+                .limit(COMPACT_BATCH_SIZE).all()
+        finally:
+            session.close()
+
+        return [(row.id, self._to_record(row)) for row in rows]
+
+    @staticmethod
+    def _to_record(row) -> Dict[str, Any]:
+        body = decompress_body(row.body_z)[1] if row.body_z else (row.body or '')
+        return {
+            'outlook_id': row.outlook_id,
+            'sender': row.sender,
+            'subject': row.subject,
+            'received_at': row.received_at.isoformat(),
+            'is_read': bool(row.is_read),
+            'has_attachments': bool(row.has_attachments),
+            'folder_id': row.folder_id,
+            'body': body,
+        }
+
+    def _delete(self, telegram_id: str, email_ids: List[int], outlook_ids: List[str]):
+        """Drop archived rows from the hot table, leaving tombstones so fetches skip them"""
+        session = Session()
+        try:
+            session.query(Email).filter(Email.telegram_id == telegram_id, Email.id.in_(email_ids))\
+                .delete(synchronize_session=False)
+            tombstoned = {
+                row.outlook_id for row in
+                session.query(ArchivedEmail.outlook_id).filter(ArchivedEmail.outlook_id.in_(outlook_ids))
+            }
+            session.add_all(
+                ArchivedEmail(outlook_id=outlook_id, telegram_id=telegram_id)
+                for outlook_id in set(outlook_ids) - tombstoned
+            )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _mark_compacted(self, telegram_id: str):
+        session = Session()
+        try:
+            policy = session.query(RetentionPolicy).filter_by(telegram_id=telegram_id).first()
+            if policy:
+                policy.last_compacted_at = datetime.utcnow()
+                session.commit()
+        finally:
+            session.close()
+
+    def hot_row_count(self, telegram_id: str) -> int:
+        session = Session()
+        try:
+            return session.query(func.count(Email.id)).filter(Email.telegram_id == telegram_id).scalar()
+        finally:
+            session.close()
@@ -0,0 +1,153 @@
+import logging
+from collections import Counter
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import event, update
+
+from cache import LRUCache
+from database import Session, Email, Sender, MailboxSenderCount, insert_ignore
+from stats import ensure_counters, record_sender_counts
+
+logger = logging.getLogger(__name__)
+
+SENDER_CACHE_SIZE = 50000
+MIGRATE_BATCH_SIZE = 1000
+
+
+class SenderCount(NamedTuple):
+    """One row of the top-senders view"""
+    id: int
+    address: str
+    display_name: Optional[str]
+    count: int
+
+
+def sender_of(email_data: Dict[str, Any]) -> Tuple[str, str]:
+    """(address, display name) of a Graph message, preferring sender over from"""
+    sender = email_data.get('sender') or email_data.get('from') or {}
+    address = sender.get('emailAddress', {})
+    return address.get('address') or '', address.get('name') or ''
+
+
+class SenderDirectory:
+    """Interns sender addresses into the senders table, keeping a hot address -> id map"""
+
+    def __init__(self, cache_size: int = SENDER_CACHE_SIZE):
+        # Ids never change once assigned, so entries need no TTL
+        self.cache = LRUCache(maxsize=cache_size)
+
+    def ids_for(self, session, senders: Dict[str, str]) -> Dict[str, int]:
+        """Map addresses (-> display name) to sender ids, creating missing senders
+
+        Runs inside the caller's session: one lookup, one insert for every
+        unseen address together, and one re-select of the ids they got.
+        """
+        ids = {}
+        missing = {}
+        for address, name in senders.items():
+            key = address.lower()
+            if not key:
+                continue
+            sender_id = self.cache.get(key)
+            if sender_id is None:
+                missing.setdefault(key, name)
+            else:
+                ids[address] = sender_id
+
+        if missing:
+            found = self._lookup(session, list(missing))
+            self._remember(found)
+
+            unseen = [key for key in missing if key not in found]
+            if unseen:
+                # Addresses another worker interns meanwhile are skipped, not errors
+                insert_ignore(session, Sender, [
+                    {'address': key, 'display_name': missing[key] or None} for key in unseen
+                ], ['address'])
+                interned = self._lookup(session, unseen)
+                found.update(interned)
+                # Rows inserted here vanish if the caller rolls back, so only cache them once committed
+                event.listen(session, 'after_commit', lambda _: self._remember(interned), once=True)
+
+            for address in senders:
+                if address.lower() in found:
+                    ids[address] = found[address.lower()]
+
+        return ids
+
+    @staticmethod
+    def interned_addresses(sender_ids: Dict[str, int]) -> Dict[int, str]:
+        """Invert an ids_for() result to sender id -> the address as stored in senders
+
+        Graph may spell one address in several cases; every spelling maps to
+        the same lowercase row, so this never depends on which one came last.
+        """
+        return {sender_id: address.lower() for address, sender_id in sender_ids.items()}
+
+    def _remember(self, ids: Dict[str, int]):
+        for key, sender_id in ids.items():
+            self.cache.set(key, sender_id)
+
+    @staticmethod
+    def _lookup(session, addresses: List[str]) -> Dict[str, int]:
+        rows = session.query(Sender.address, Sender.id).filter(Sender.address.in_(addresses))
+        return {row.address: row.id for row in rows}
+
+    def get(self, sender_id: int) -> Optional[Sender]:
+        session = Session()
+        try:
+            return session.query(Sender).filter_by(id=sender_id).first()
+        finally:
+            session.close()
+
+    def top_senders(self, telegram_id: str, limit: int = 10) -> List[SenderCount]:
+        """Senders with the most stored emails for a user, from the counters /stats also reads"""
+        if not ensure_counters(telegram_id):
+            return []
+
+        session = Session()
+        try:
+            rows = session.query(Sender.id, Sender.address, Sender.display_name, MailboxSenderCount.count)\
+                .join(MailboxSenderCount, MailboxSenderCount.sender_id == Sender.id)\
+                .filter(MailboxSenderCount.telegram_id == telegram_id, MailboxSenderCount.count > 0)\
+                .order_by(MailboxSenderCount.count.desc())\
+                .limit(limit)
+            return [SenderCount(*row) for row in rows]
+        finally:
+            session.close()
+
+    def migrate_legacy(self, batch_size: int = MIGRATE_BATCH_SIZE) -> int:
+        """Move inline sender strings of rows stored before interning onto sender_id"""
+        migrated = 0
+        while True:
+            session = Session()
+            try:
+                rows = session.query(Email.id, Email.telegram_id, Email.sender)\
+                    .filter(Email.sender_id.is_(None), Email.sender.isnot(None), Email.sender != '')\
+                    .limit(batch_size).all()
+                if not rows:
+                    break
+
+                ids = self.ids_for(session, {row.sender: '' for row in rows})
+                session.execute(
+                    update(Email),
+                    [{'id': row.id, 'sender_id': ids[row.sender], 'sender': None} for row in rows]
+                )
+                
+                per_user = {}
+                for row in rows:
+                    per_user.setdefault(row.telegram_id, Counter())[ids[row.sender]] += 1
+                for telegram_id, counts in per_user.items():
+                    record_sender_counts(session, telegram_id, counts)
+                session.commit()
+                migrated += len(rows)
+            except Exception as e:
+                session.rollback()
+                logger.error(f"Error migrating legacy senders: {e}")
+                break
+            finally:
+                session.close()
+
+        if migrated:
+            logger.info(f"Interned senders of {migrated} legacy emails")
+        return migrated
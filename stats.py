@@ -0,0 +1,226 @@
+import logging
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import func, case
+
+from archive import ArchiveStore
+from database import Session, Email, ArchivedEmail, Sender, MailboxStats, MailboxDailyCount, MailboxSenderCount, upsert_counters
+
+logger = logging.getLogger(__name__)
+
+STATS_DAYS = 7
+STATS_TOP_SENDERS = 5
+
+class MailboxStatsSnapshot(NamedTuple):
+    """Everything /stats shows, read from the counter tables only"""
+    total: int
+    unread: int
+    with_attachments: int
+    first_received_at: Optional[datetime]
+    last_received_at: Optional[datetime]
+    daily: List[Tuple[date, int]]
+    top_senders: List[Tuple[str, int]]
+
+
+def record_ingest(session, telegram_id: str, emails: List[Email]):
+    """Fold newly stored emails into the counters, inside the caller's transaction"""
+    if not emails:
+        return
+
+    received = [email.received_at for email in emails if email.received_at]
+    upsert_counters(
+        session, MailboxStats,
+        {'telegram_id': telegram_id},
+        {
+            'total': len(emails),
+            'unread': sum(1 for email in emails if not email.is_read),
+            'with_attachments': sum(1 for email in emails if email.has_attachments),
+        },
+        {
+            'first_received_at': (min(received) if received else None, 'min'),
+            'last_received_at': (max(received) if received else None, 'max'),
+        },
+        on_insert=_first_ingest_values(session, telegram_id, emails)
+    )
+
+    for day, count in Counter(timestamp.date() for timestamp in received).items():
+        upsert_counters(session, MailboxDailyCount, {'telegram_id': telegram_id, 'day': day}, {'count': count})
+
+    record_sender_counts(session, telegram_id, Counter(email.sender_id for email in emails if email.sender_id))
+
+
+def _first_ingest_values(session, telegram_id: str, emails: List[Email]) -> Dict[str, Any]:
+    """backfilled_at for a stats row created by this batch, if the batch is all the user has
+
+    Then the counters are complete from the start and /stats never needs the
+    full rebuild. Users with emails stored before the counters existed still get it.
+    """
+    if session.query(MailboxStats.telegram_id).filter_by(telegram_id=telegram_id).first() is not None:
+        return {}
+
+    outlook_ids = [email.outlook_id for email in emails]
+    earlier = session.query(Email.id)\
+        .filter(Email.telegram_id == telegram_id, Email.outlook_id.notin_(outlook_ids)).first()
+    archived = session.query(ArchivedEmail.outlook_id).filter_by(telegram_id=telegram_id).first()
+    if earlier is None and archived is None:
+        return {'backfilled_at': datetime.utcnow()}
+    return {}
+
+
+def record_sender_counts(session, telegram_id: str, counts: Dict[int, int]):
+    """Credit existing emails to senders, e.g. after legacy addresses are interned"""
+    for sender_id, count in counts.items():
+        upsert_counters(session, MailboxSenderCount, {'telegram_id': telegram_id, 'sender_id': sender_id}, {'count': count})
+
+
+def record_read_changes(session, telegram_id: str, marked_read: int):
+    """Adjust unread after is_read flips (negative when emails are marked unread)"""
+    if marked_read:
+        upsert_counters(session, MailboxStats, {'telegram_id': telegram_id}, {'unread': -marked_read})
+
+
+def ensure_counters(telegram_id: str) -> bool:
+    """Make sure a user's counters include every stored email, rebuilding them once if not
+
+    False when there is nothing to show: no stored emails, or no counters
+    because the rebuild failed.
+    """
+    session = Session()
+    try:
+        stats = session.query(MailboxStats.backfilled_at).filter_by(telegram_id=telegram_id).first()
+        if stats is not None and stats.backfilled_at is not None:
+            return True
+        # Emails stored before the counters existed: count them once. Ingest may
+        # already have created the row from new emails only, so its presence proves nothing.
+        if session.query(Email.id).filter_by(telegram_id=telegram_id).first() is None:
+            return False
+    finally:
+        session.close()
+
+    if rebuild_stats(telegram_id):
+        return True
+    # Fall back to the ingest-only counters, if any; the next call retries the rebuild
+    logger.warning(f"Serving partial mailbox stats for user {telegram_id}")
+    return stats is not None
+
+
+def get_stats(telegram_id: str, days: int = STATS_DAYS, top: int = STATS_TOP_SENDERS) -> Optional[MailboxStatsSnapshot]:
+    """Read a user's statistics: one row plus two short index range scans
+
+    None when ensure_counters() finds nothing to show.
+    """
+    if not ensure_counters(telegram_id):
+        return None
+
+    session = Session()
+    try:
+        stats = session.query(MailboxStats).filter_by(telegram_id=telegram_id).first()
+        if stats is None:
+            return None
+
+        since = datetime.utcnow().date() - timedelta(days=days - 1)
+        daily = session.query(MailboxDailyCount.day, MailboxDailyCount.count)\
+            .filter(MailboxDailyCount.telegram_id == telegram_id, MailboxDailyCount.day >= since)\
+            .order_by(MailboxDailyCount.day.desc()).all()
+
+        top_senders = session.query(Sender.address, MailboxSenderCount.count)\
+            .join(Sender, Sender.id == MailboxSenderCount.sender_id)\
+            .filter(MailboxSenderCount.telegram_id == telegram_id, MailboxSenderCount.count > 0)\
+            .order_by(MailboxSenderCount.count.desc())\
+            .limit(top).all()
+
+        return MailboxStatsSnapshot(
+            total=stats.total,
+            unread=stats.unread,
+            with_attachments=stats.with_attachments,
+            first_received_at=stats.first_received_at,
+            last_received_at=stats.last_received_at,
+            daily=[(row.day, row.count) for row in daily],
+            top_senders=[(row.address, row.count) for row in top_senders]
+        )
+    finally:
+        session.close()
+
+
+def rebuild_stats(telegram_id: str) -> bool:
+    """Recompute a user's counters from the emails table and the archive (one-off full scan)
+
+    Returns False if the rebuild failed and the previous counters were kept.
+    """
+    session = Session()
+    try:
+        # Write the stats row first: its row lock, which record_ingest also takes,
+        # keeps concurrent ingests from committing between the count and the rewrite
+        upsert_counters(session, MailboxStats, {'telegram_id': telegram_id}, {'total': 0})
+
+        totals = session.query(
+            func.count(Email.id),
+            func.sum(case((Email.is_read.is_(True), 0), else_=1)),
+            func.sum(case((Email.has_attachments.is_(True), 1), else_=0)),
+            func.min(Email.received_at),
+            func.max(Email.received_at)
+        ).filter(Email.telegram_id == telegram_id).one()
+
+        days = Counter()
+        for (received_at,) in session.query(Email.received_at)\
+                .filter(Email.telegram_id == telegram_id, Email.received_at.isnot(None))\
+                .yield_per(1000):
+            days[received_at.date()] += 1
+
+        senders = Counter(dict(session.query(Email.sender_id, func.count(Email.id))
+                               .filter(Email.telegram_id == telegram_id, Email.sender_id.isnot(None))
+                               .group_by(Email.sender_id).all()))
+
+        total, unread, with_attachments, first_received_at, last_received_at = totals
+        total, unread, with_attachments = total or 0, unread or 0, with_attachments or 0
+
+        # Retention moved these out of the hot table; they still count as stored mail
+        hot_ids = {outlook_id for (outlook_id,) in session.query(Email.outlook_id).filter(Email.telegram_id == telegram_id)}
+        seen = set()
+        archived_senders = Counter()
+        for record in ArchiveStore().iter_records(telegram_id):
+            outlook_id = record.get('outlook_id')
+            if outlook_id in hot_ids or outlook_id in seen:
+                continue
+            seen.add(outlook_id)
+            total += 1
+            unread += 0 if record.get('is_read') else 1
+            with_attachments += 1 if record.get('has_attachments') else 0
+            if record.get('received_at'):
+                received_at = datetime.fromisoformat(record['received_at'])
+                days[received_at.date()] += 1
+                first_received_at = min(filter(None, (first_received_at, received_at)))
+                last_received_at = max(filter(None, (last_received_at, received_at)))
+            if record.get('sender'):
+                archived_senders[record['sender'].lower()] += 1
+
+        if archived_senders:
+            for sender_id, address in session.query(Sender.id, Sender.address)\
+                    .filter(Sender.address.in_(list(archived_senders))):
+                senders[sender_id] += archived_senders[address]
+
+        for model in (MailboxDailyCount, MailboxSenderCount):
+            session.query(model).filter_by(telegram_id=telegram_id).delete(synchronize_session=False)
+
+        session.query(MailboxStats).filter_by(telegram_id=telegram_id).update({
+            MailboxStats.total: total,
+            MailboxStats.unread: unread,
+            MailboxStats.with_attachments: with_attachments,
+            MailboxStats.first_received_at: first_received_at,
+            MailboxStats.last_received_at: last_received_at,
+            MailboxStats.backfilled_at: datetime.utcnow(),
+        }, synchronize_session=False)
+        session.add_all(MailboxDailyCount(telegram_id=telegram_id, day=day, count=count) for day, count in days.items())
+        session.add_all(MailboxSenderCount(telegram_id=telegram_id, sender_id=sender_id, count=count)
+                        for sender_id, count in senders.items())
+        session.commit()
+        logger.info(f"Rebuilt mailbox stats for user {telegram_id} ({total} emails)")
+        return True
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error rebuilding mailbox stats for user {telegram_id}: {e}")
+        return False
+    finally:
+        session.close()
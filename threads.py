@@ -0,0 +1,106 @@
+import logging
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import update
+
+from database import Session, Email, Thread, ThreadParticipant, insert_ignore, upsert_counters
+
+logger = logging.getLogger(__name__)
+
+
+class ThreadSummary(NamedTuple):
+    """One conversation in the threaded list view"""
+    id: int
+    subject: str
+    latest_sender: str
+    latest_received_at: datetime
+    message_count: int
+    unread_count: int
+    participants: List[str]
+
+
+def record_threads(session, telegram_id: str, emails: List[Email], sender_addresses: Dict[int, str]):
+    """Fold newly stored emails into their thread rows, inside the caller's transaction
+
+    sender_addresses maps sender_id -> address for emails whose inline
+    sender column is empty. The batch is grouped by conversation first, so
+    this runs one upsert per conversation plus one participants insert.
+    """
+    conversations = {}
+    for email in emails:
+        if email.conversation_id:
+            conversations.setdefault(email.conversation_id, []).append(email)
+
+    participants = []
+    for conversation_id, members in conversations.items():
+        latest = max(members, key=lambda e: e.received_at)
+        keys = {'telegram_id': telegram_id, 'conversation_id': conversation_id}
+        upsert_counters(
+            session, Thread, keys,
+            {'message_count': len(members), 'unread_count': sum(1 for e in members if not e.is_read)},
+            latest=('latest_received_at', {
+                'subject': latest.subject,
+                'latest_outlook_id': latest.outlook_id,
+                'latest_sender': _address_of(latest, sender_addresses),
+                'latest_received_at': latest.received_at,
+            })
+        )
+
+        addresses = {_address_of(email, sender_addresses) for email in members}
+        participants.extend({**keys, 'address': address} for address in addresses if address)
+
+    insert_ignore(session, ThreadParticipant, participants, ['telegram_id', 'conversation_id', 'address'])
+
+
+def _address_of(email: Email, sender_addresses: Dict[int, str]) -> str:
+    return email.sender or sender_addresses.get(email.sender_id, '')
+
+
+def record_thread_reads(session, telegram_id: str, conversation_id: str, marked_read: int):
+    """Adjust a thread's unread count after is_read flips (negative when marked unread)"""
+    session.execute(
+        update(Thread)
+        .where(Thread.telegram_id == telegram_id, Thread.conversation_id == conversation_id)
+        .values(unread_count=Thread.unread_count - marked_read)
+    )
+
+
+def get_thread_page(telegram_id: str, offset: int = 0, limit: int = 5) -> Tuple[List[ThreadSummary], bool]:
+    """One page of threads, newest activity first, plus whether more pages follow"""
+    session = Session()
+    try:
+        rows = session.query(
+            Thread.id, Thread.conversation_id, Thread.subject, Thread.latest_sender, Thread.latest_received_at,
+            Thread.message_count, Thread.unread_count
+        ).filter(Thread.telegram_id == telegram_id)\
+            .order_by(Thread.latest_received_at.desc())\
+            .offset(offset).limit(limit + 1).all()
+
+        participants = {}
+        conversation_ids = [row.conversation_id for row in rows[:limit]]
+        if conversation_ids:
+            for conversation_id, address in session.query(ThreadParticipant.conversation_id, ThreadParticipant.address)\
+                    .filter(ThreadParticipant.telegram_id == telegram_id,
+                            ThreadParticipant.conversation_id.in_(conversation_ids)):
+                participants.setdefault(conversation_id, []).append(address)
+    finally:
+        session.close()
+
+    threads = [
+        ThreadSummary(
+            row.id, row.subject, row.latest_sender, row.latest_received_at, row.message_count, row.unread_count,
+            participants=sorted(participants.get(row.conversation_id, []))
+        )
+        for row in rows[:limit]
+    ]
+    return threads, len(rows) > limit
+
+
+def get_conversation_id(telegram_id: str, thread_id: int) -> Optional[str]:
+    session = Session()
+    try:
+        row = session.query(Thread.conversation_id).filter_by(id=thread_id, telegram_id=telegram_id).first()
+        return row.conversation_id if row else None
+    finally:
+        session.close()
@@ -0,0 +1,241 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# '' disables tracing, 'console' prints one latency tree per update, 'file' appends JSON lines
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', '').lower()
+TRACE_FILE = os.getenv('TRACE_FILE', '/tmp/outlook-bot-traces.jsonl')
+# Fraction of root spans (updates, callbacks) that are recorded
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 1.0))
+STATEMENT_MAX_CHARS = 300
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_current_span: contextvars.ContextVar[Optional['Span']] = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """One timed operation; children share the trace_id of the update that caused them"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str] = None,
+                 attributes: Optional[Dict[str, Any]] = None, remote_parent: bool = False):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        # A parent from another process: this span is the local root of the trace
+        self.remote_parent = remote_parent
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+
+    @property
+    def is_local_root(self) -> bool:
+        return self.parent_id is None or self.remote_parent
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException):
+        self.status = 'error'
+        self.attributes['error.type'] = type(error).__name__
+        self.attributes['error.message'] = str(error)[:STATEMENT_MAX_CHARS]
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            if _exporter is not None:
+                _exporter.export(self)
+
+    @property
+    def traceparent(self) -> str:
+        """W3C traceparent header value naming this span as the parent"""
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id,
+            'name': self.name,
+            'startTimeUnixNano': self.start_ns,
+            'endTimeUnixNano': self.end_ns,
+            'durationMs': round(self.duration_ms, 3),
+            'status': self.status,
+            'attributes': self.attributes,
+        }
+
+
+class FileExporter:
+    """Appends finished spans as JSON lines from a background thread"""
+
+    def __init__(self, path: str = TRACE_FILE):
+        self.path = path
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        threading.Thread(target=self._run, name='trace-exporter', daemon=True).start()
+
+    def export(self, span: Span):
+        self._queue.put(span)
+
+    def _run(self):
+        with open(self.path, 'a', buffering=1) as f:
+            while True:
+                span = self._queue.get()
+                try:
+                    f.write(json.dumps(span.to_dict(), default=str) + '\n')
+                except Exception as e:
+                    logger.error(f"Error exporting span {span.name}: {e}")
+
+
+class ConsoleExporter:
+    """Prints each trace as an indented latency breakdown once its local root ends"""
+
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        self._pending: Dict[str, List[Span]] = {}
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self._lock:
+            spans = self._pending.setdefault(span.trace_id, [])
+            spans.append(span)
+            if not span.is_local_root:
+                return
+            del self._pending[span.trace_id]
+
+        children: Dict[Optional[str], List[Span]] = {}
+        for s in spans:
+            children.setdefault(s.parent_id, []).append(s)
+
+        lines = [f"trace {span.trace_id}"]
+
+        def walk(node: Span, depth: int):
+            attributes = ' '.join(f'{k}={v}' for k, v in node.attributes.items() if k != 'db.statement')
+            lines.append(f"{'  ' * depth}{node.duration_ms:9.1f}ms  {node.name}  {attributes}".rstrip())
+            for child in sorted(children.get(node.span_id, []), key=lambda s: s.start_ns):
+                walk(child, depth + 1)
+
+        walk(span, 1)
+        print('\n'.join(lines), file=self.stream, flush=True)
+
+
+def _make_exporter():
+    if TRACE_EXPORTER == 'file':
+        return FileExporter()
+    if TRACE_EXPORTER == 'console':
+        return ConsoleExporter()
+    if TRACE_EXPORTER:
+        logger.warning(f"Unknown TRACE_EXPORTER {TRACE_EXPORTER!r}; tracing disabled")
+    return None
+
+
+# Set by setup_tracing(), so importing this module starts no exporter threads
+_exporter = None
+
+
+def setup_tracing():
+    """Start the exporter chosen by TRACE_EXPORTER; called once by each entry point"""
+    global _exporter
+    if _exporter is None:
+        _exporter = _make_exporter()
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextlib.contextmanager
+def start_span(name: str, attributes: Optional[Dict[str, Any]] = None,
+               traceparent: Optional[str] = None, root: bool = False) -> Iterator[Optional[Span]]:
+    """Time a block as a child of the current span
+
+    Only root=True starts a new trace (subject to sampling), continuing the
+    caller's trace when a traceparent header is given. Without a current
+    span anything else is untraced and yields None, so background work
+    costs nothing.
+    """
+    parent = _current_span.get()
+    if _exporter is None or (parent is None and not root):
+        yield None
+        return
+
+    if parent is not None:
+        span = Span(name, parent.trace_id, parent.span_id, attributes)
+    else:
+        remote = parse_traceparent(traceparent)
+        if remote is None and random.random() >= TRACE_SAMPLE_RATE:
+            yield None
+            return
+        trace_id, parent_id = remote or ('%032x' % random.getrandbits(128), None)
+        span = Span(name, trace_id, parent_id, attributes, remote_parent=parent_id is not None)
+
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end()
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[tuple]:
+    """(trace_id, parent span_id) from a W3C traceparent header, if valid"""
+    match = TRACEPARENT.match((header or '').strip().lower())
+    if not match or set(match.group(1)) == {'0'} or set(match.group(2)) == {'0'}:
+        return None
+    return match.group(1), match.group(2)
+
+
+def current_traceparent() -> Optional[str]:
+    span = _current_span.get()
+    return span.traceparent if span else None
+
+
+def trace_engine(engine):
+    """A db.query span for every statement run inside a traced request"""
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        parent = _current_span.get()
+        if _exporter is None or parent is None:
+            return
+        span = Span('db.query', parent.trace_id, parent.span_id, {
+            'db.operation': statement.lstrip().split(None, 1)[0].upper() if statement.strip() else '',
+            'db.statement': statement[:STATEMENT_MAX_CHARS],
+        })
+        if executemany:
+            span.set_attribute('db.executemany', True)
+        conn.info.setdefault('trace_spans', []).append(span)
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get('trace_spans')
+        if spans:
+            spans.pop().end()
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        spans = context.connection.info.get('trace_spans') if context.connection else None
+        if spans:
+            span = spans.pop()
+            span.record_error(context.original_exception)
+            span.end()
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import UPDATE_WAIT_SECONDS
+from tracing import start_span
+from profiler import profile_request
+
+logger = logging.getLogger(__name__)
+
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 16))
+# Updates accepted but not yet running; PTB blocks polling beyond this
+MAX_PENDING_UPDATES = int(os.getenv('MAX_PENDING_UPDATES', 4096))
+WAIT_SAMPLES = 1000
+METRICS_LOG_INTERVAL = 60
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently across chats, strictly in order within a chat
+
+    Each chat gets a FIFO lock that acts as its serial queue; only the update at
+    the head of a chat's queue competes for one of the shared worker slots. A
+    chat with a long backlog therefore occupies at most one worker.
+    """
+
+    def __init__(self, workers: int = UPDATE_WORKERS, max_pending: int = MAX_PENDING_UPDATES):
+        super().__init__(max_pending)
+        self.workers = workers
+        self._worker_slots = asyncio.Semaphore(workers)
+        self._chat_queues: Dict[Any, asyncio.Lock] = {}
+        self._chat_depths: Dict[Any, int] = {}
+        self._active = 0
+        self._wait_times = deque(maxlen=WAIT_SAMPLES)
+        self._processed = 0
+        self._last_logged = time.monotonic()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat_key = self._chat_key(update)
+        enqueued_at = time.monotonic()
+
+        queue = self._chat_queues.get(chat_key)
+        if queue is None:
+            queue = self._chat_queues[chat_key] = asyncio.Lock()
+        self._chat_depths[chat_key] = self._chat_depths.get(chat_key, 0) + 1
+
+        try:
+            async with queue:
+                async with self._worker_slots:
+                    waited = time.monotonic() - enqueued_at
+                    self._wait_times.append(waited)
+                    UPDATE_WAIT_SECONDS.observe(waited)
+                    self._active += 1
+                    try:
+                        # Everything the handlers do, in this task or via to_thread, nests under this span
+                        attributes = self._span_attributes(update, waited)
+                        name = attributes.get('command') or attributes.get('callback') or 'update'
+                        with start_span('telegram.update', attributes, root=True), profile_request(name):
+                            await coroutine
+                    finally:
+                        self._active -= 1
+                        self._processed += 1
+        finally:
+            self._chat_depths[chat_key] -= 1
+            if not self._chat_depths[chat_key]:
+                del self._chat_depths[chat_key]
+                del self._chat_queues[chat_key]
+            self._maybe_log_metrics()
+
+    async def initialize(self) -> None:
+        logger.info(f"Update processor started with {self.workers} workers")
+
+    async def shutdown(self) -> None:
+        pass
+
+    @staticmethod
+    def _chat_key(update: object) -> Optional[Any]:
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return ('user', update.effective_user.id)
+        # Updates without a chat or user are serialised together
+        return None
+
+    @staticmethod
+    def _span_attributes(update: object, waited: float) -> Dict[str, Any]:
+        attributes = {'queue_wait_ms': round(waited * 1000, 1)}
+        if isinstance(update, Update):
+            if update.effective_chat:
+                attributes['chat_id'] = update.effective_chat.id
+            if update.message and update.message.text and update.message.text.startswith('/'):
+                attributes['command'] = update.message.text.split()[0]
+            elif update.callback_query and update.callback_query.data:
+                attributes['callback'] = update.callback_query.data.split(':', 1)[0]
+        return attributes
+
+    def metrics(self) -> Dict[str, Any]:
+        """Snapshot of queue depths and queue wait times (seconds)"""
+        waits = sorted(self._wait_times)
+
+        def percentile(p):
+            return waits[min(len(waits) - 1, int(len(waits) * p))] if waits else 0.0
+
+        queued = sum(self._chat_depths.values())
+        return {
+            'active': self._active,
+            'queued': queued - self._active,
+            'chats_with_backlog': len(self._chat_depths),
+            'max_chat_depth': max(self._chat_depths.values(), default=0),
+            'processed': self._processed,
+            'wait_p50': percentile(0.50),
+            'wait_p99': percentile(0.99),
+            'wait_max': waits[-1] if waits else 0.0,
+        }
+
+    def _maybe_log_metrics(self):
+        now = time.monotonic()
+        if now - self._last_logged < METRICS_LOG_INTERVAL:
+            return
+        self._last_logged = now
+
+        m = self.metrics()
+        logger.info(
+            f"Updates: {m['active']} active, {m['queued']} queued across {m['chats_with_backlog']} chats "
+            f"(max depth {m['max_chat_depth']}), wait p50={m['wait_p50']*1000:.0f}ms "
+            f"p99={m['wait_p99']*1000:.0f}ms"
+        )
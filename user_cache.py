@@ -0,0 +1,87 @@
+import time
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from cache import LRUCache
+from database import Session, User
+
+# Entries are trusted without touching the DB for REVALIDATE_AFTER seconds.
+# After that a cheap updated_at lookup confirms no other process (e.g. the
+# OAuth callback server) changed the row; the full row is reloaded only if it did.
+USER_CACHE_SIZE = 4096
+USER_CACHE_TTL = 600
+REVALIDATE_AFTER = 5
+
+
+class UserProfile(NamedTuple):
+    telegram_id: str
+    outlook_email: Optional[str]
+    is_connected: bool
+    access_token: Optional[str]
+    expires_at: Optional[datetime]
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+
+
+class UserCache:
+    """Bounded LRU/TTL cache of user profiles, revalidated against users.updated_at"""
+
+    def __init__(self, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL,
+                 revalidate_after: float = REVALIDATE_AFTER):
+        # telegram_id -> (profile or None, checked_at)
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.revalidate_after = revalidate_after
+
+    def get(self, telegram_id: str) -> Optional[UserProfile]:
+        """Return the user's profile, or None if the user does not exist"""
+        entry = self._cache.get(telegram_id)
+        now = time.monotonic()
+
+        if entry is not None:
+            profile, checked_at = entry
+            if now - checked_at < self.revalidate_after:
+                return profile
+            if self._current_stamp(telegram_id) == (profile.updated_at if profile else None):
+                self._cache.set(telegram_id, (profile, now))
+                return profile
+
+        profile = self._load(telegram_id)
+        self._cache.set(telegram_id, (profile, now))
+        return profile
+
+    def invalidate(self, telegram_id: str):
+        """Drop a user's entry after a write"""
+        self._cache.pop(telegram_id)
+
+    def clear(self):
+        self._cache.clear()
+
+    def _current_stamp(self, telegram_id: str) -> Optional[datetime]:
+        session = Session()
+        try:
+            row = session.query(User.updated_at).filter_by(telegram_id=telegram_id).first()
+            return row.updated_at if row else None
+        finally:
+            session.close()
+
+    def _load(self, telegram_id: str) -> Optional[UserProfile]:
+        session = Session()
+        try:
+            user = session.query(User).filter_by(telegram_id=telegram_id).first()
+            if not user:
+                return None
+
+            return UserProfile(
+                telegram_id=user.telegram_id,
+                outlook_email=user.outlook_email,
+                is_connected=bool(user.is_connected),
+                access_token=user.access_token,
+                expires_at=user.expires_at,
+                created_at=user.created_at,
+                updated_at=user.updated_at
+            )
+        finally:
+            session.close()
+
+
+user_cache = UserCache()